@@ -1 +1,4 @@
-from .core.napview_backend import main
\ No newline at end of file
+def main():
+    # imported on call, so that component processes importing napview.core.* under spawn skip the backend
+    from .core.napview_backend import main as backend_main
+    backend_main()
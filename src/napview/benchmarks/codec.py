@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import zlib
+import struct
+import sqlite3
+import argparse
+import tempfile
+import numpy as np
+
+from ..core.sample_codec import SampleCodec
+from .synthetic import create_synthetic_database, synthetic_eeg, write_samples
+
+
+def legacy_database(db_file_path, data, sample_rate):
+    # the previous layout: one row per sample, float32 values zlib-compressed per sample
+    con = sqlite3.connect(db_file_path)
+    con.execute('CREATE TABLE eeg_data ("index" INTEGER PRIMARY KEY, time REAL, data BLOB)')
+    n_channels = data.shape[0]
+    rows = ((i, i / sample_rate, zlib.compress(struct.pack(f'{n_channels}f', *data[:, i].tolist())))
+            for i in range(data.shape[1]))
+    con.executemany('INSERT INTO eeg_data VALUES (?, ?, ?)', rows)
+    con.commit()
+    return con
+
+
+def legacy_read(con, start, end, n_channels):
+    rows = con.execute('SELECT data FROM eeg_data WHERE "index" >= ? AND "index" <= ? ORDER BY "index"', (start, end))
+    return np.array([struct.unpack(f'{n_channels}f', zlib.decompress(data)) for (data,) in rows]).T
+
+
+def codec_variants(n_channels, resolution):
+    scales = [resolution] * n_channels
+    return {
+        'float32_block': SampleCodec(n_channels),
+        'int32': SampleCodec(n_channels, scales=scales, dtype='int32', delta=False),
+        'auto': SampleCodec(n_channels, scales=scales, delta=False),
+        'auto_delta': SampleCodec(n_channels, scales=scales),
+        'auto_delta_lossless': SampleCodec(n_channels, scales=scales, lossless=True),
+    }
+
+
+def measure_codec(codec, data, block_size):
+    blocks = [data[:, i:i + block_size] for i in range(0, data.shape[1], block_size)]
+    start = time.perf_counter()
+    encoded = [codec.encode(block) for block in blocks]
+    encode_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    decoded = np.concatenate([codec.decode(blob) for blob in encoded], axis=1)
+    decode_seconds = time.perf_counter() - start
+    n_bytes = sum(len(blob) for blob in encoded)
+    return {
+        'bytes_per_sample': n_bytes / data.shape[1],
+        'encode_msamples_per_second': data.shape[1] / encode_seconds / 1e6,
+        'decode_msamples_per_second': data.shape[1] / decode_seconds / 1e6,
+        'max_abs_error': float(np.max(np.abs(decoded - data.astype(np.float64)))),
+        'exact': bool(np.array_equal(decoded.astype(np.float32), data)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare sample storage encodings by size and speed.')
+    parser.add_argument('--channels', type=int, default=16)
+    parser.add_argument('--sample-rate', type=int, default=500)
+    parser.add_argument('--minutes', type=float, default=10)
+    parser.add_argument('--resolution', type=float, default=1e-7, help='amplifier resolution in volts (0.1 uV)')
+    parser.add_argument('--output', default=None, help='write the report as json to this path')
+    args = parser.parse_args()
+
+    n_samples = int(args.minutes * 60 * args.sample_rate)
+    continuous = synthetic_eeg(args.channels, args.sample_rate, n_samples)
+    # what an amplifier delivers: integer multiples of its resolution
+    quantized = (np.rint(continuous.astype(np.float64) / args.resolution) * args.resolution).astype(np.float32)
+    block_size = args.sample_rate
+
+    report = {'benchmark': 'codec', 'parameters': vars(args), 'encodings': {}, 'databases': {}}
+    legacy_bytes = np.mean([len(zlib.compress(struct.pack(f'{args.channels}f', *quantized[:, i].tolist())))
+                            for i in range(0, n_samples, max(1, n_samples // 2000))])
+    report['encodings']['legacy_per_sample'] = {'bytes_per_sample': float(legacy_bytes)}
+    for source_name, source in [('continuous', continuous), ('quantized', quantized)]:
+        for name, codec in codec_variants(args.channels, args.resolution).items():
+            report['encodings'][f'{source_name}/{name}'] = measure_codec(codec, source, block_size)
+
+    workdir = tempfile.mkdtemp(prefix='napview_codec_')
+    hours = n_samples / args.sample_rate / 3600
+    con = legacy_database(os.path.join(workdir, 'legacy.db'), quantized, args.sample_rate)
+    window = 10 * 60 * args.sample_rate
+    start = time.perf_counter()
+    legacy_read(con, max(0, n_samples - window), n_samples - 1, args.channels)
+    report['databases']['legacy'] = {
+        'bytes_per_hour': os.path.getsize(os.path.join(workdir, 'legacy.db')) / hours,
+        'read_10min_seconds': time.perf_counter() - start,
+    }
+    con.close()
+
+    codec = SampleCodec(args.channels, scales=[args.resolution] * args.channels, lossless=True)
+    db_file_path = os.path.join(workdir, 'codec.db')
+    db_handler, db = create_synthetic_database(db_file_path, workdir, args.channels, args.sample_rate, codec=codec)
+    write_samples(db_handler, db, quantized, np.arange(n_samples) / args.sample_rate, 0, block_size=block_size)
+    db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+    start = time.perf_counter()
+    db_handler.retrieve_data(max(0, n_samples - window), n_samples - 1)
+    report['databases']['codec'] = {
+        'bytes_per_hour': os.path.getsize(db_file_path) / hours,
+        'read_10min_seconds': time.perf_counter() - start,
+    }
+    report['databases']['size_ratio'] = report['databases']['legacy']['bytes_per_hour'] / report['databases']['codec']['bytes_per_hour']
+    report['databases']['read_speedup'] = report['databases']['legacy']['read_10min_seconds'] / report['databases']['codec']['read_10min_seconds']
+    db.close()
+
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
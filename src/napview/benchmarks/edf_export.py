@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from datetime import datetime, timezone
+
+from ..core.edf_writer import export_database_to_edf
+from .synthetic import make_synthetic_database
+
+
+def measure(function):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def export_with_mne(db_handler, edf_file_path):
+    # the pre-streaming export path, kept here as the reference to compare against
+    import mne
+    eeg_info = db_handler.retrieve_info()
+    total_samples = db_handler.get_total_n_samples()
+    eeg_data = db_handler.retrieve_data(0, total_samples - 1)
+    info = mne.create_info(ch_names=json.loads(eeg_info.channel_names), sfreq=eeg_info.sample_rate,
+                           ch_types=['eeg'] * eeg_info.n_channels)
+    raw = mne.io.RawArray(eeg_data, info, verbose=False)
+    raw.set_meas_date(datetime.now(timezone.utc))
+    mne.export.export_raw(edf_file_path, raw, fmt='edf', overwrite=True, verbose=False)
+
+
+def verify_export(db_handler, edf_file_path):
+    import mne
+    raw = mne.io.read_raw_edf(edf_file_path, preload=True, verbose=False)
+    total_samples = db_handler.get_total_n_samples()
+    original = db_handler.retrieve_data(0, total_samples - 1)
+    exported = raw.get_data()[:, :total_samples]
+    step = (original.max(axis=1) - original.min(axis=1)) / 65535
+    return float(np.max(np.abs(exported - original) / np.maximum(step, 1e-12)[:, np.newaxis]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the streaming EDF export used at shutdown.')
+    parser.add_argument('--channels', type=int, default=8)
+    parser.add_argument('--sample-rate', type=int, default=256)
+    parser.add_argument('--minutes', type=float, default=30)
+    parser.add_argument('--chunk-seconds', type=int, default=60)
+    parser.add_argument('--compare-mne', action='store_true', help='also time the previous MNE RawArray export')
+    parser.add_argument('--verify', action='store_true', help='read the export back with MNE and report the error')
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--output', default=None, help='write the report as json to this path')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='napview_bench_')
+    db_file_path = os.path.join(workdir, 'bench.db')
+    if os.path.exists(db_file_path):
+        os.remove(db_file_path)
+    db_handler = make_synthetic_database(db_file_path, workdir, args.channels, args.sample_rate, args.minutes * 60)
+    n_samples = db_handler.get_total_n_samples()
+
+    report = {
+        'benchmark': 'edf_export',
+        'channels': args.channels,
+        'sample_rate': args.sample_rate,
+        'minutes': args.minutes,
+        'n_samples': n_samples,
+        'db_bytes': os.path.getsize(db_file_path),
+        'results': {},
+    }
+
+    streaming_path = os.path.join(workdir, 'streaming.edf')
+    chunk_size = args.chunk_seconds * args.sample_rate
+    stats, elapsed, peak = measure(lambda: export_database_to_edf(db_handler, streaming_path, chunk_size=chunk_size))
+    report['results']['streaming'] = {
+        'seconds': elapsed,
+        'samples_per_second': n_samples / elapsed,
+        'megabytes_per_second': stats['bytes'] / elapsed / 1e6,
+        'peak_traced_megabytes': peak / 1e6,
+        'edf_bytes': stats['bytes'],
+    }
+    if args.verify:
+        report['results']['streaming']['max_error_in_digital_steps'] = verify_export(db_handler, streaming_path)
+
+    if args.compare_mne:
+        mne_path = os.path.join(workdir, 'mne.edf')
+        _, elapsed, peak = measure(lambda: export_with_mne(db_handler, mne_path))
+        report['results']['mne'] = {
+            'seconds': elapsed,
+            'samples_per_second': n_samples / elapsed,
+            'megabytes_per_second': os.path.getsize(mne_path) / elapsed / 1e6,
+            'peak_traced_megabytes': peak / 1e6,
+            'edf_bytes': os.path.getsize(mne_path),
+        }
+
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+import mne
+import antropy as ant
+import scipy.signal as sp_sig
+import scipy.stats as sp_stats
+from mne.filter import filter_data
+from sklearn.preprocessing import robust_scale
+
+from ..core.edf_writer import EDFWriter
+from ..core.spectral import SpectralCache, staging_spectra
+from ..core.window import EEGWindow
+from ..core.yasa_staging_minimal import (SleepStaging, bandpower_from_psd_ndarray, sliding_window,
+                                          perm_entropy_epochs, higuchi_fd_epochs, petrosian_fd_epochs)
+from .synthetic import synthetic_eeg
+
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+CHANNELS = ['C3', 'EOG1', 'EMG1']
+BANDS = [(0.4, 1, "sdelta"), (1, 4, "fdelta"), (4, 8, "theta"), (8, 12, "alpha"), (12, 16, "sigma"), (16, 30, "beta")]
+# features are stored as float32 by SleepStaging, probabilities come straight from the classifier
+FEATURE_RTOL, FEATURE_ATOL = 1e-4, 1e-6
+PROBA_ATOL = 1e-4
+# the float32 compute mode is checked against the float64 result by the stages it predicts
+FLOAT32_MIN_AGREEMENT = 0.99
+# the spectral cache's spectra (spectra=, as the analysis host stages) against SleepStaging's own Welch by the
+# stages they predict, and a cache filled an epoch at a time against one filled in a single pass. MNE resamples
+# by FFT over the data it is given, so with resampling an epoch's spectra depend on the window by ~1e-4
+HOST_MIN_AGREEMENT = 0.99
+HOST_WARM_COLD_PROBA_ATOL = 1e-3
+# feature group -> antropy's implementation as SleepStaging used it before the batched kernels, timed next to them
+ANTROPY_BASELINES = {
+    'perm_entropy': lambda epochs: np.apply_along_axis(ant.perm_entropy, axis=1, arr=epochs, normalize=True),
+    'higuchi': lambda epochs: np.apply_along_axis(ant.higuchi_fd, axis=1, arr=epochs),
+    'petrosian': lambda epochs: ant.petrosian_fd(epochs, axis=1),
+}
+
+
+def make_raw(source, minutes, seed=0):
+    # 'synthetic' is fed to SleepStaging directly at 100 Hz; 'edf' goes through an EDF file at 256 Hz,
+    # so quantization, reading and resampling are part of the input as they are for a recording
+    sample_rate = 100 if source == 'synthetic' else 256
+    data = synthetic_eeg(len(CHANNELS), sample_rate, int(minutes * 60 * sample_rate), seed=seed).astype(np.float64)
+    data[2] = data[2] * 0.3 + np.random.default_rng(seed).standard_normal(data.shape[1]) * 5e-6  # broadband EMG
+    if source == 'synthetic':
+        return mne.io.RawArray(data, mne.create_info(CHANNELS, sample_rate, ch_types='eeg'), verbose=False)
+    edf_file_path = os.path.join(tempfile.mkdtemp(prefix='napview_features_'), f'{source}_{minutes}min.edf')
+    with EDFWriter(edf_file_path, CHANNELS, sample_rate, data.min(), data.max()) as writer:
+        writer.write_samples(data)
+    return mne.io.read_raw_edf(edf_file_path, preload=True, verbose=False)
+
+
+def timed(timings, name, function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings[name] = timings.get(name, 0) + time.perf_counter() - start
+    return result
+
+
+def time_feature_groups(sls):
+    # the steps of SleepStaging.fit, timed one group at a time over all channels
+    timings = {}
+    sf = sls.sf
+    kwargs_welch = dict(window="hamming", nperseg=int(5 * sf), average="median")
+    features = []
+    for i, c in enumerate(sls.ch_types):
+        dt_filt = timed(timings, 'filter', filter_data, sls.data[i, :], sf, l_freq=0.4, h_freq=30, verbose=False)
+        times, epochs = timed(timings, 'epoching', sliding_window, dt_filt, sf=sf, window=30)
+        feat = timed(timings, 'descriptive', lambda: {
+            "std": np.std(epochs, ddof=1, axis=1),
+            "iqr": sp_stats.iqr(epochs, rng=(25, 75), axis=1),
+            "skew": sp_stats.skew(epochs, axis=1),
+            "kurt": sp_stats.kurtosis(epochs, axis=1),
+            "nzc": ant.num_zerocross(epochs, axis=1),
+        })
+        feat["hmob"], feat["hcomp"] = timed(timings, 'hjorth', ant.hjorth_params, epochs, axis=1)
+        freqs, psd = timed(timings, 'welch', sp_sig.welch, epochs, sf, **kwargs_welch)
+        if c != "emg":
+            bp = timed(timings, 'bandpower', bandpower_from_psd_ndarray, psd, freqs, bands=BANDS)
+            for j, (_, _, b) in enumerate(BANDS):
+                feat[b] = bp[j]
+        feat["perm"] = timed(timings, 'perm_entropy', perm_entropy_epochs, epochs, normalize=True)
+        feat["higuchi"] = timed(timings, 'higuchi', higuchi_fd_epochs, epochs)
+        feat["petrosian"] = timed(timings, 'petrosian', petrosian_fd_epochs, epochs)
+        for name, baseline in ANTROPY_BASELINES.items():
+            timed(timings, f'{name}_antropy', baseline, epochs)
+        features.append(pd.DataFrame(feat).add_prefix(c + "_"))
+
+    features = pd.concat(features, axis=1)
+
+    def smooth():
+        rollc = features.rolling(window=15, center=True, min_periods=1, win_type="triang").mean()
+        rollc[rollc.columns] = robust_scale(rollc, quantile_range=(5, 95))
+        rollp = features.rolling(window=4, min_periods=1).mean()
+        rollp[rollp.columns] = robust_scale(rollp, quantile_range=(5, 95))
+        return rollc, rollp
+
+    timed(timings, 'smoothing', smooth)
+    return timings
+
+
+def run_input(raw, repeats):
+    timings = {}
+    for _ in range(repeats):
+        run = {}
+        sls = timed(run, 'load_resample', SleepStaging, raw, eeg_name=CHANNELS[0], eog_name=CHANNELS[1], emg_name=CHANNELS[2])
+        run.update(time_feature_groups(sls))
+        timed(run, 'fit_total', sls.fit)
+        clf = sls._load_model('auto')
+        X = sls._features[clf.feature_name_]
+        timed(run, 'predict', clf.predict_proba, X)
+        for name, seconds in run.items():
+            timings[name] = min(timings.get(name, np.inf), seconds)
+    features = sls.get_features()
+    proba = sls.predict_proba()
+    return timings, features, proba
+
+
+def kernel_speedups(timings):
+    # antropy seconds over batched kernel seconds, per feature group
+    return {name: timings[f'{name}_antropy'] / timings[name] for name in ANTROPY_BASELINES}
+
+
+def check_float32(raw, proba, repeats):
+    # compute_dtype 'float32': the window, filtering, Welch and feature kernels in single precision
+    window = EEGWindow.from_raw(raw)
+    window = EEGWindow(window.data.astype(np.float32), window.ch_names, window.sfreq)
+    timings = {}
+    for _ in range(repeats):
+        run = {}
+        sls = timed(run, 'load_resample', SleepStaging, window, eeg_name=CHANNELS[0], eog_name=CHANNELS[1], emg_name=CHANNELS[2])
+        timed(run, 'fit_total', sls.fit)
+        for name, seconds in run.items():
+            timings[name] = min(timings.get(name, np.inf), seconds)
+    proba32 = sls.predict_proba()
+    agreement = float(np.mean(proba32.idxmax(axis=1).to_numpy() == proba.idxmax(axis=1).to_numpy()))
+    return {
+        'status': 'pass' if agreement >= FLOAT32_MIN_AGREEMENT else 'fail',
+        'seconds': timings,
+        'stage_agreement': agreement,
+        'max_proba_difference': float(np.max(np.abs(proba32.to_numpy() - proba.to_numpy()))),
+    }
+
+
+def host_spectra(window, warm):
+    # the spectral cache's spectra of the window, per channel. Warm: filled as the analysis host fills it, an
+    # epoch at a time as the recording grows; cold: in a single pass over the whole window
+    samples_per_epoch = int(30 * window.sfreq)
+    n_epochs = window.n_samples // samples_per_epoch
+    cache = SpectralCache(max_epochs=n_epochs)
+    if warm:
+        for epoch in range(1, n_epochs):
+            cache.window_spectra(window.data[:, :epoch * samples_per_epoch], window.sfreq, 0, samples_per_epoch)
+    freqs, psd = cache.window_spectra(window.data[:, :n_epochs * samples_per_epoch], window.sfreq, 0, samples_per_epoch)
+    return {ch: (freqs, staging_spectra(psd[window.index(ch)])) for ch in CHANNELS}
+
+
+def run_host_spectra(raw, repeats):
+    # SleepStaging with spectra from the spectral cache, over whole epochs as the analysis host reads them
+    window = EEGWindow.from_raw(raw)
+    samples_per_epoch = int(30 * window.sfreq)
+    window = EEGWindow(window.data[:, :window.n_samples // samples_per_epoch * samples_per_epoch], window.ch_names, window.sfreq)
+    results = {}
+    for warm in [True, False]:
+        seconds = np.inf
+        for _ in range(repeats):
+            start = time.perf_counter()
+            spectra = host_spectra(window, warm)
+            sls = SleepStaging(window, eeg_name=CHANNELS[0], eog_name=CHANNELS[1], emg_name=CHANNELS[2], spectra=spectra)
+            sls.fit()
+            seconds = min(seconds, time.perf_counter() - start)
+        results['warm' if warm else 'cold'] = (seconds, sls.get_features(), sls.predict_proba())
+    return results
+
+
+def check_host_spectra(results, proba):
+    _, _, warm_proba = results['warm']
+    _, _, cold_proba = results['cold']
+    agreement = float(np.mean(warm_proba.idxmax(axis=1).to_numpy() == proba.idxmax(axis=1).to_numpy()))
+    warm_cold_difference = float(np.max(np.abs(warm_proba.to_numpy() - cold_proba.to_numpy())))
+    passed = agreement >= HOST_MIN_AGREEMENT and warm_cold_difference <= HOST_WARM_COLD_PROBA_ATOL
+    return {
+        'status': 'pass' if passed else 'fail',
+        'seconds': {name: seconds for name, (seconds, _, _) in results.items()},
+        'stage_agreement': agreement,
+        'max_proba_difference': float(np.max(np.abs(warm_proba.to_numpy() - proba.to_numpy()))),
+        'warm_cold_max_proba_difference': warm_cold_difference,
+    }
+
+
+def golden_file_path(key):
+    return os.path.join(GOLDEN_PATH, f'{key}.npz')
+
+
+def save_golden(key, features, proba):
+    os.makedirs(GOLDEN_PATH, exist_ok=True)
+    np.savez_compressed(golden_file_path(key), feature_names=np.array(features.columns, dtype=str),
+                        features=features.to_numpy(np.float32), proba=proba.to_numpy(np.float64),
+                        classes=np.array(proba.columns, dtype=str))
+
+
+def check_golden(key, features, proba):
+    if not os.path.exists(golden_file_path(key)):
+        return {'status': 'missing'}
+    golden = np.load(golden_file_path(key))
+    if list(golden['feature_names']) != list(features.columns) or list(golden['classes']) != list(proba.columns):
+        return {'status': 'fail', 'reason': 'feature or class names differ'}
+    current, expected = features.to_numpy(np.float64), golden['features'].astype(np.float64)
+    if current.shape != expected.shape:
+        return {'status': 'fail', 'reason': f'shape {current.shape} != {expected.shape}'}
+    # tolerance is relative to each feature's own scale, absolute powers and normalized scores differ by decades
+    scale = np.maximum(np.abs(expected).max(axis=0), 1e-12)
+    excess = np.abs(current - expected) - (FEATURE_ATOL * scale + FEATURE_RTOL * np.abs(expected))
+    worst = np.unravel_index(np.argmax(excess), excess.shape)
+    proba_error = float(np.max(np.abs(proba.to_numpy() - golden['proba'])))
+    passed = bool(np.all(excess <= 0)) and proba_error <= PROBA_ATOL
+    return {
+        'status': 'pass' if passed else 'fail',
+        'worst_feature': features.columns[worst[1]],
+        'worst_feature_relative_error': float(np.abs(current - expected)[worst] / scale[worst[1]]),
+        'max_proba_error': proba_error,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time each SleepStaging feature group and check features against golden files, '
+                                                 'with its own spectra and with those of the spectral cache.')
+    parser.add_argument('--sources', nargs='+', default=['synthetic', 'edf'], choices=['synthetic', 'edf'])
+    parser.add_argument('--minutes', type=int, nargs='+', default=[5, 10, 60])
+    parser.add_argument('--repeats', type=int, default=3, help='timings are the best of this many runs')
+    parser.add_argument('--update-golden', action='store_true', help='overwrite the golden files with the current output')
+    parser.add_argument('--output', default=None, help='write the report as json to this path')
+    args = parser.parse_args()
+
+    report = {'benchmark': 'features', 'parameters': vars(args), 'inputs': {}}
+    failed = False
+    for source in args.sources:
+        for minutes in args.minutes:
+            key = f'{source}_{minutes}min'
+            raw = make_raw(source, minutes)
+            timings, features, proba = run_input(raw, args.repeats)
+            host_results = run_host_spectra(raw, args.repeats)
+            _, host_features, host_proba = host_results['warm']
+            if args.update_golden:
+                save_golden(key, features, proba)
+                save_golden(f'{key}_host', host_features, host_proba)
+                equivalence = host_equivalence = {'status': 'updated'}
+            else:
+                equivalence = check_golden(key, features, proba)
+                host_equivalence = check_golden(f'{key}_host', host_features, host_proba)
+            float32 = check_float32(raw, proba, args.repeats)
+            host = dict(check_host_spectra(host_results, proba), equivalence=host_equivalence)
+            failed |= 'fail' in (equivalence['status'], float32['status'], host['status'], host_equivalence['status'])
+            report['inputs'][key] = {'n_epochs': len(features), 'seconds': timings, 'kernel_speedup': kernel_speedups(timings),
+                                     'equivalence': equivalence, 'float32': float32, 'host_spectra': host}
+
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
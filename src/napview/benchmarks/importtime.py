@@ -0,0 +1,121 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+
+# what each process imports before it can do its first piece of work; the components are loaded the way
+# run_pipeline_component loads them, 'staging' adds the modules SleepStaging.fit and the model loader import
+TARGETS = {
+    'backend': 'import napview.core.napview_backend',
+    'producer': "from napview.core.components import load_component_class; load_component_class('producer')",
+    'recorder': "from napview.core.components import load_component_class; load_component_class('recorder')",
+    'analyzer': "from napview.core.components import load_component_class; load_component_class('analyzer')",
+    'visualizer': "from napview.core.components import load_component_class; load_component_class('visualizer')",
+    'archiver': "from napview.core.components import load_component_class; load_component_class('archiver')",
+    'staging': 'import napview.core.yasa_staging_minimal, napview.core.tree_ensemble, antropy, sklearn.preprocessing',
+}
+# libraries whose presence in a process is worth knowing about
+HEAVY_MODULES = ['mne', 'pandas', 'scipy', 'sklearn', 'antropy', 'numba', 'lightgbm', 'joblib',
+                 'matplotlib', 'flask', 'usleep_api', 'brainflow']
+
+
+def parse_importtime(stderr):
+    # "import time: self [us] | cumulative | imported package", in the order the imports finished
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def run_target(statement, env):
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+    return elapsed, parse_importtime(completed.stderr)
+
+
+def measure_target(statement, env, repeats, top, baseline):
+    # cold start is the wall time of a fresh interpreter running the imports, minus a bare interpreter start
+    wall_times = []
+    for _ in range(repeats):
+        elapsed, modules = run_target(statement, env)
+        wall_times.append(elapsed)
+    # cost per top-level package is its largest cumulative entry, modules a bare interpreter loads are left out
+    baseline_seconds, baseline_modules = baseline
+    top_level = {}
+    for name, _, cumulative_us in modules:
+        package = name.split('.')[0]
+        if name not in baseline_modules:
+            top_level[package] = max(top_level.get(package, 0), cumulative_us)
+    slowest = sorted(top_level.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {
+        'cold_start_ms': float(np.median(wall_times) - baseline_seconds) * 1000,
+        'cold_start_min_ms': float(np.min(wall_times) - baseline_seconds) * 1000,
+        'import_ms': sum(self_us for _, self_us, _ in modules) / 1000,
+        'modules': len(modules),
+        'heavy_modules': [name for name in HEAVY_MODULES if name in top_level],
+        'slowest_packages_ms': [[name, cumulative_us / 1000] for name, cumulative_us in slowest],
+    }
+
+
+def compare_reports(report, baseline):
+    comparison = {}
+    for target, current in report['targets'].items():
+        previous = baseline.get('targets', {}).get(target)
+        if previous is None or 'error' in current or 'error' in previous:
+            continue
+        comparison[target] = {
+            'cold_start_ms': {'baseline': previous['cold_start_ms'], 'current': current['cold_start_ms']},
+            'added_heavy_modules': sorted(set(current['heavy_modules']) - set(previous['heavy_modules'])),
+        }
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cold-start import time of the backend and of each component process.')
+    parser.add_argument('--targets', nargs='+', default=list(TARGETS), choices=list(TARGETS))
+    parser.add_argument('--repeats', type=int, default=5, help='cold start is the median of this many fresh interpreters')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest top-level packages to list per target')
+    parser.add_argument('--compare', default=None, help='a previous report to compare against')
+    parser.add_argument('--output', default=None, help='write the report as json to this path')
+    args = parser.parse_args()
+
+    # the child interpreters must import this checkout of napview, installed or not
+    env = dict(os.environ)
+    source_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [source_path, env.get('PYTHONPATH')]))
+
+    runs = [run_target('pass', env) for _ in range(args.repeats)]
+    baseline_seconds = min(elapsed for elapsed, _ in runs)
+    baseline_modules = {name for name, _, _ in runs[0][1]}
+    report = {'benchmark': 'importtime', 'parameters': vars(args), 'python': sys.version.split()[0],
+              'interpreter_start_ms': baseline_seconds * 1000, 'targets': {}}
+    for target in args.targets:
+        try:
+            # one untimed run first, so that bytecode compilation is not counted as start-up
+            run_target(TARGETS[target], env)
+            report['targets'][target] = measure_target(TARGETS[target], env, args.repeats, args.top, (baseline_seconds, baseline_modules))
+        except RuntimeError as e:
+            report['targets'][target] = {'error': str(e)}
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            report['comparison'] = compare_reports(report, json.load(f))
+
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+
+from ..core.napview_backend import ProcessManager, load_config_defaults
+from ..core.database_handler import DatabaseHandler
+from ..core.edf_writer import EDFWriter
+from ..core.helpers import ConfigManager
+from ..core.tracing import metrics_path, now as local_clock, stage_latencies
+from .synthetic import synthetic_channel_names, synthetic_eeg
+from .storage import percentiles
+
+
+# analysis -> the results file it appends to, whether it runs in its own process or in the analysis host
+RESULT_FILES = {'analyzer1': 'yasa_results.txt', 'analyzer2': 'staging_results.txt'}
+COMPARED_METRICS = ['ingest_samples_per_second', 'ingest_ratio', 'late_samples', 'behind_samples', 'db_bytes_per_hour']
+
+
+def write_simulator_edf(edf_file_path, n_channels, sample_rate, seconds):
+    # the Simulator loops over this file, so a minute of data is enough for any run length
+    with EDFWriter(edf_file_path, synthetic_channel_names(n_channels), sample_rate, -500e-6, 500e-6) as writer:
+        for start in range(0, seconds * sample_rate, 10 * sample_rate):
+            writer.write_samples(synthetic_eeg(n_channels, sample_rate, 10 * sample_rate, start_sample=start))
+
+
+def prepare_base_path(base_path, n_channels, sample_rate, args):
+    write_simulator_edf(os.path.join(base_path, 'eeg.edf'), n_channels, sample_rate, args.edf_seconds)
+    config = load_config_defaults(base_path)
+    config.update({
+        'base_path': base_path,
+        'eeg_amp': 'Simulator',
+        'sleep_staging_model': 'YASA',
+        'epoch_length': args.epoch_length,
+        'lsl_stream_name': f'napview_bench_{os.getpid()}_{n_channels}_{sample_rate}',
+        'db_file_path': os.path.join(base_path, 'data', 'db', 'eeg_data.db'),
+        'profiling_roles': args.profile_roles,
+        'profiling_mode': args.profiling_mode,
+        'analysis_host': not args.separate_analyzers,
+        'beds': [{'name': f'bed{i}', 'lsl_stream_name': f'napview_bench_{os.getpid()}_{n_channels}_{sample_rate}_bed{i}'} for i in range(args.beds)],
+        'analysis_workers': args.analysis_workers,
+        'compute_dtype': args.compute_dtype,
+        'simulator_jitter_seconds': args.jitter_ms / 1000,
+    })
+    for dirname in ['db', 'results', 'edfs']:
+        os.makedirs(os.path.join(base_path, 'data', dirname), exist_ok=True)
+    config_manager = ConfigManager(base_path, config)
+    db_handler = DatabaseHandler(base_path)
+    db_handler.setup_database(config['db_file_path'], create_tables=True, role='writer', profile=config.get('storage_profile', 'wal'))
+    db_handler.db.close()
+    return config_manager, config
+
+
+def read_new_results(results_path, offsets):
+    rows = {}
+    for role, file_name in RESULT_FILES.items():
+        file_path = os.path.join(results_path, file_name)
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path, 'r') as f:
+            f.seek(offsets.get(role, 0))
+            lines = f.readlines()
+            offsets[role] = f.tell()
+        rows[role] = [json.loads(line) for line in lines if line.strip()]
+    return rows
+
+
+def read_recorder_stats(base_path):
+    # the recorder counts late samples on the LSL timestamps as they arrive; the stored timestamps are those of
+    # its clock model, which smooths jitter below clock_gap_seconds away
+    stats_file_path = os.path.join(metrics_path(base_path), 'recorder.json')
+    if not os.path.exists(stats_file_path):
+        return {}
+    with open(stats_file_path, 'r') as f:
+        return json.load(f)
+
+
+def measure_bed(base_path, db_file_path, profile):
+    # polled state of one recording: its own database, results files and latencies
+    return {'base_path': base_path, 'db_file_path': db_file_path, 'profile': profile,
+            'db_handler': DatabaseHandler(base_path), 'first_sample': None, 'lags': [], 'offsets': {},
+            'stages': {role: {} for role in RESULT_FILES}}
+
+
+def poll_bed(bed):
+    if bed['first_sample'] is None:
+        if not os.path.exists(bed['db_file_path']):
+            return
+        bed['db_handler'].setup_database(bed['db_file_path'], create_tables=False, role='reader', profile=bed['profile'])
+        if not bed['db_handler'].get_total_n_samples():
+            bed['db_handler'].db.close()
+            return
+        bed['first_sample'] = bed['db_handler'].get_sample_timestamp(0)
+    now = local_clock()
+    most_recent = bed['db_handler'].get_most_recent_timestamp()
+    if most_recent is not None:
+        bed['lags'].append(now - most_recent)
+    for role, rows in read_new_results(os.path.join(bed['base_path'], 'data', 'results'), bed['offsets']).items():
+        for row in rows:
+            for stage, latency in stage_latencies(row.get('trace', {})).items():
+                bed['stages'][role].setdefault(stage, []).append(latency / 1000)
+
+
+def bed_report(bed, n_channels, sample_rate):
+    if bed['first_sample'] is None:
+        return {'error': 'no samples were recorded'}
+    db_handler, db_file_path, stages = bed['db_handler'], bed['db_file_path'], bed['stages']
+    elapsed = local_clock() - bed['first_sample']
+    stored = db_handler.get_total_n_samples()
+    recorder_stats = read_recorder_stats(bed['base_path'])
+    db_bytes = sum(os.path.getsize(path) for path in [db_file_path, f"{db_file_path}-wal"] if os.path.exists(path))
+    report = {
+        'channels': n_channels,
+        'sample_rate': sample_rate,
+        'recorded_seconds': stored / sample_rate,
+        'ingest_samples_per_second': stored / elapsed,
+        'ingest_ratio': stored / (elapsed * sample_rate),
+        'late_samples': recorder_stats.get('late_samples', 0),
+        'clock_segments': recorder_stats.get('clock_segments'),
+        'behind_samples': max(0, int(elapsed * sample_rate) - stored),
+        'db_bytes_per_hour': db_bytes / (stored / sample_rate / 3600),
+        'commit_lag': percentiles(bed['lags']),
+        'epoch_latency': {role: percentiles(values.get('acquired->result_written', [])) for role, values in stages.items()},
+        'stage_latency': {role: {stage: percentiles(values) for stage, values in role_stages.items()} for role, role_stages in stages.items()},
+        'base_path': bed['base_path'],
+    }
+    db_handler.db.close()
+    return report
+
+
+def run_configuration(n_channels, sample_rate, args):
+    base_path = tempfile.mkdtemp(prefix=f'napview_pipeline_{n_channels}ch_{sample_rate}hz_')
+    config_manager, config = prepare_base_path(base_path, n_channels, sample_rate, args)
+
+    process_manager = ProcessManager()
+    profile = config.get('storage_profile', 'wal')
+    if args.beds:
+        process_manager.launch_beds(base_path, config_manager, ['producer', 'recorder', 'analyzer'])
+        beds = {}
+        for name, bed_config_manager in process_manager.beds.items():
+            bed_config = bed_config_manager.load_config()
+            beds[name] = measure_bed(bed_config['base_path'], bed_config['db_file_path'], profile)
+    else:
+        analyzers = ['analyzer1', 'analyzer2'] if args.separate_analyzers else ['analyzer']
+        process_manager.launch_components(base_path, config_manager, ['producer', 'recorder'] + analyzers)
+        beds = {None: measure_bed(base_path, config['db_file_path'], profile)}
+
+    start = time.perf_counter()
+    try:
+        while time.perf_counter() - start < args.duration:
+            time.sleep(args.poll_interval)
+            for bed in beds.values():
+                poll_bed(bed)
+    finally:
+        process_manager.stop_processes()
+
+    if not args.beds:
+        report = bed_report(beds[None], n_channels, sample_rate)
+    else:
+        # every bed streams the same configuration; ingest and latency are reported per bed
+        report = {'beds': {name: bed_report(bed, n_channels, sample_rate) for name, bed in beds.items()}}
+        recorded = [bed for bed in report['beds'].values() if 'error' not in bed]
+        if not recorded:
+            return {'error': 'no samples were recorded'}
+        for metric in COMPARED_METRICS:
+            report[metric] = float(np.mean([bed[metric] for bed in recorded]))
+        report['epoch_latency'] = {role: percentiles([latency for bed in beds.values() for latency in bed['stages'][role].get('acquired->result_written', [])])
+                                   for role in RESULT_FILES}
+        report['base_path'] = base_path
+    if args.profile_roles and 'error' not in report:
+        # with --beds the per-bed components profile into their bed's directory
+        report['profiles'] = sorted(os.path.relpath(os.path.join(root, file), base_path)
+                                    for root, _, files in os.walk(base_path) if os.path.basename(root) == 'profiles' for file in files)
+    return report
+
+
+def compare_reports(report, baseline):
+    comparison = {}
+    for key, current in report['configurations'].items():
+        previous = baseline.get('configurations', {}).get(key)
+        if previous is None or 'error' in current or 'error' in previous:
+            continue
+        deltas = {metric: {'baseline': previous[metric], 'current': current[metric]} for metric in COMPARED_METRICS}
+        for role, values in current['epoch_latency'].items():
+            previous_values = previous['epoch_latency'].get(role)
+            if values and previous_values:
+                deltas[f'{role}_latency_p95_ms'] = {'baseline': previous_values['p95_ms'], 'current': values['p95_ms']}
+        comparison[key] = deltas
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run producer, recorder and analyzers headless and measure throughput and latency.')
+    parser.add_argument('--channels', type=int, nargs='+', default=[8, 64, 256])
+    parser.add_argument('--sample-rates', type=int, nargs='+', default=[100, 500, 2000])
+    parser.add_argument('--duration', type=float, default=180, help='seconds per configuration; the first epochs include analyzer start-up')
+    parser.add_argument('--epoch-length', type=int, default=30)
+    parser.add_argument('--edf-seconds', type=int, default=60, help='length of the synthetic file the Simulator loops over')
+    parser.add_argument('--poll-interval', type=float, default=0.2)
+    parser.add_argument('--separate-analyzers', action='store_true', help='run band power and staging in two processes instead of the analysis host')
+    parser.add_argument('--beds', type=int, default=0, help='record this many simulated beds at once, each with its own stream and database')
+    parser.add_argument('--analysis-workers', type=int, default=None, help='size of the analysis pool with --beds, default one per core')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='delay each chunk the Simulator pushes by up to this much')
+    parser.add_argument('--compute-dtype', default='float64', choices=['float64', 'float32'], help='precision of the analyses')
+    parser.add_argument('--profile-roles', nargs='*', default=[], help='components to profile, e.g. recorder analyzer2')
+    parser.add_argument('--profiling-mode', default='sampler', choices=['sampler', 'cprofile'])
+    parser.add_argument('--compare', default=None, help='a previous report to compare against')
+    parser.add_argument('--output', default=None, help='write the report as json to this path')
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method('spawn', True)
+    report = {'benchmark': 'pipeline', 'parameters': vars(args), 'cpu_count': os.cpu_count(), 'configurations': {}}
+    for n_channels in args.channels:
+        for sample_rate in args.sample_rates:
+            key = f'{n_channels}ch@{sample_rate}Hz'
+            print(f'Running {key} for {args.duration} s...', flush=True)
+            report['configurations'][key] = run_configuration(n_channels, sample_rate, args)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            report['comparison'] = compare_reports(report, json.load(f))
+
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+
+from ..core.database_handler import DatabaseHandler
+from .synthetic import create_synthetic_database, synthetic_eeg, write_samples
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values) * 1000
+    return {'p50_ms': float(np.percentile(values, 50)), 'p95_ms': float(np.percentile(values, 95)),
+            'p99_ms': float(np.percentile(values, 99)), 'max_ms': float(values.max()), 'n': int(values.size)}
+
+
+def writer_process(db_file_path, base_path, profile, n_channels, sample_rate, block_size, duration, results):
+    db_handler = DatabaseHandler(base_path)
+    db = db_handler.setup_database(db_file_path, create_tables=False, role='writer', profile=profile)
+    db_handler.start_checkpoint_scheduler(interval=1)
+    data = synthetic_eeg(n_channels, sample_rate, block_size)
+    commit_latencies = []
+    sample_index = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        timestamps = (sample_index + np.arange(block_size)) / sample_rate
+        block_start = time.perf_counter()
+        write_samples(db_handler, db, data, timestamps, sample_index)
+        commit_latencies.append(time.perf_counter() - block_start)
+        sample_index += block_size
+    elapsed = time.perf_counter() - start
+    db_handler.stop_checkpoint_scheduler()
+    wal_file_path = f"{db_file_path}-wal"
+    results.put(('writer', {
+        'samples': sample_index,
+        'samples_per_second': sample_index / elapsed,
+        'block_commit': percentiles(commit_latencies),
+        'wal_bytes_at_end': os.path.getsize(wal_file_path) if os.path.exists(wal_file_path) else 0,
+    }))
+    db.close()
+
+
+def reader_process(db_file_path, base_path, profile, window_samples, poll_interval, duration, results):
+    db_handler = DatabaseHandler(base_path)
+    db_handler.setup_database(db_file_path, create_tables=False, role='reader', profile=profile)
+    db_handler.retrieve_info()
+    read_latencies = []
+    failures = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        read_start = time.perf_counter()
+        total_samples = db_handler.get_total_n_samples()
+        if total_samples:
+            data = db_handler.retrieve_data(max(0, total_samples - window_samples), total_samples - 1)
+            if data is None:
+                failures += 1
+            else:
+                read_latencies.append(time.perf_counter() - read_start)
+        elif total_samples is None:
+            failures += 1
+        time.sleep(poll_interval)
+    results.put(('reader', {'reads': percentiles(read_latencies), 'failures': failures}))
+
+
+def run_profile(profile, args):
+    workdir = tempfile.mkdtemp(prefix=f'napview_storage_{profile}_')
+    db_file_path = os.path.join(workdir, 'bench.db')
+    db_handler, db = create_synthetic_database(db_file_path, workdir, args.channels, args.sample_rate, profile=profile)
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=writer_process, args=(
+        db_file_path, workdir, profile, args.channels, args.sample_rate, args.block_size, args.duration, results))]
+    for _ in range(args.readers):
+        processes.append(multiprocessing.Process(target=reader_process, args=(
+            db_file_path, workdir, profile, args.window_seconds * args.sample_rate, args.poll_interval, args.duration, results)))
+    for process in processes:
+        process.start()
+    collected = [results.get(timeout=args.duration + 120) for _ in processes]
+    for process in processes:
+        process.join()
+    db.close()
+
+    report = {'db_bytes': os.path.getsize(db_file_path)}
+    for role, values in collected:
+        if role == 'writer':
+            report['writer'] = values
+        else:
+            report.setdefault('readers', []).append(values)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure recorder ingest and analyzer read latency under contention.')
+    parser.add_argument('--profiles', nargs='+', default=['legacy', 'wal'])
+    parser.add_argument('--channels', type=int, default=32)
+    parser.add_argument('--sample-rate', type=int, default=500)
+    parser.add_argument('--block-size', type=int, default=1000, help='samples per recorder transaction')
+    parser.add_argument('--readers', type=int, default=3, help='two analyzers and the GUI server by default')
+    parser.add_argument('--window-seconds', type=int, default=30)
+    parser.add_argument('--poll-interval', type=float, default=0.1)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--output', default=None, help='write the report as json to this path')
+    args = parser.parse_args()
+
+    multiprocessing.set_start_method('spawn', True)
+    report = {'benchmark': 'storage', 'parameters': vars(args), 'profiles': {}}
+    for profile in args.profiles:
+        report['profiles'][profile] = run_profile(profile, args)
+
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
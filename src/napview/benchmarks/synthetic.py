@@ -0,0 +1,65 @@
+import json
+import time
+import numpy as np
+
+from ..core.database_handler import DatabaseHandler
+from ..core.sample_codec import SampleCodec
+
+
+STANDARD_CHANNELS = ['C3', 'C4', 'O1', 'O2', 'F3', 'F4', 'P3', 'P4', 'Fp1', 'Fp2', 'T3', 'T4',
+                     'Cz', 'Fz', 'Pz', 'Oz', 'EOG1', 'EOG2', 'EMG1', 'EMG2']
+
+
+def synthetic_channel_names(n_channels):
+    names = STANDARD_CHANNELS[:n_channels]
+    names += [f'EEG{i:03d}' for i in range(len(names), n_channels)]
+    return names
+
+
+def synthetic_eeg(n_channels, sample_rate, n_samples, seed=0, start_sample=0):
+    # 1/f background plus a 10 Hz alpha rhythm, in volts (~50 uV)
+    rng = np.random.default_rng(seed + start_sample)
+    noise = rng.standard_normal((n_channels, n_samples))
+    background = np.cumsum(noise, axis=1) * 0.05
+    background -= background.mean(axis=1, keepdims=True)
+    t = (start_sample + np.arange(n_samples)) / sample_rate
+    alpha = np.sin(2 * np.pi * 10 * t)[np.newaxis, :] * rng.uniform(0.5, 1.5, (n_channels, 1))
+    return ((background + alpha + 0.5 * noise) * 20e-6).astype(np.float32)
+
+
+def write_samples(db_handler, db, data, timestamps, start_index, block_size=None):
+    # the same storage path the recorder uses: one transaction per encoded block of samples
+    block_size = block_size or data.shape[1]
+    for block_start in range(0, data.shape[1], block_size):
+        block_end = block_start + block_size
+        with db.atomic():
+            db_handler.create_data_block(data[:, block_start:block_end], timestamps[block_start:block_end], start_index + block_start)
+
+
+def create_synthetic_database(db_file_path, base_path, n_channels, sample_rate, profile='wal', codec=None):
+    # by default the codec the recorder uses for a source without a published resolution
+    db_handler = DatabaseHandler(base_path)
+    db = db_handler.setup_database(db_file_path, create_tables=True, profile=profile)
+    db_handler.create_info_entry(
+        recording_id=1,
+        sample_rate=sample_rate,
+        n_channels=n_channels,
+        start_time=time.time(),
+        channel_names=json.dumps(synthetic_channel_names(n_channels)),
+        codec=codec or SampleCodec(n_channels, scales=[1e-8] * n_channels)
+    )
+    return db_handler, db
+
+
+def make_synthetic_database(db_file_path, base_path, n_channels, sample_rate, duration_s, seed=0, block_seconds=10, codec=None):
+    db_handler, db = create_synthetic_database(db_file_path, base_path, n_channels, sample_rate, codec=codec)
+    total_samples = int(duration_s * sample_rate)
+    block = int(block_seconds * sample_rate)
+    for block_start in range(0, total_samples, block):
+        n = min(block, total_samples - block_start)
+        data = synthetic_eeg(n_channels, sample_rate, n, seed=seed, start_sample=block_start)
+        timestamps = (block_start + np.arange(n)) / sample_rate
+        write_samples(db_handler, db, data, timestamps, block_start, block_size=sample_rate)
+    # fold the WAL into the main file so its size reflects the stored recording
+    db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+    return db_handler
@@ -0,0 +1,92 @@
+import json
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import mne
+
+from ..core.window import EEGWindow
+from ..core.yasa_staging_minimal import SleepStaging
+from .synthetic import synthetic_channel_names, synthetic_eeg
+
+
+# the channels the staging analysis compares by noise level before picking one of each type
+CANDIDATES = {'eeg': [0, 1], 'eog': [2, 3], 'emg': [4, 5]}
+
+
+def allocated(counter, function, *args, **kwargs):
+    # numpy reports its buffers to tracemalloc; what a step allocates is its peak above what was held before it
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    result = function(*args, **kwargs)
+    counter[0] += tracemalloc.get_traced_memory()[1] - current
+    return result
+
+
+def mne_preparation(data, ch_names, sample_rate, counter):
+    # the analyzer before EEGWindow: a RawArray per epoch, a Raw copy per candidate channel for its noise
+    # level, and SleepStaging's own copy, resampling and conversion to uV
+    info = mne.create_info(ch_names=ch_names, sfreq=sample_rate, ch_types='eeg')
+    raw = allocated(counter, mne.io.RawArray, data, info, verbose=False)
+    picked = {}
+    for ch_type, rows in CANDIDATES.items():
+        noise = [np.std(allocated(counter, lambda row: raw.copy().pick([ch_names[row]]).get_data(), row)) for row in rows]
+        picked[ch_type] = ch_names[rows[int(np.argmin(noise))]]
+    return allocated(counter, SleepStaging, raw, eeg_name=picked['eeg'], eog_name=picked['eog'], emg_name=picked['emg']).data
+
+
+def window_preparation(data, ch_names, sample_rate, counter):
+    window = allocated(counter, EEGWindow, data, ch_names, sample_rate)
+    picked = {}
+    for ch_type, rows in CANDIDATES.items():
+        noise = [np.std(allocated(counter, window.channel, ch_names[row])) for row in rows]
+        picked[ch_type] = ch_names[rows[int(np.argmin(noise))]]
+    return allocated(counter, SleepStaging, window, eeg_name=picked['eeg'], eog_name=picked['eog'], emg_name=picked['emg']).data
+
+
+def measure(preparation, data, ch_names, sample_rate, repeats):
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = preparation(data, ch_names, sample_rate, [0])
+        seconds.append(time.perf_counter() - start)
+    counter = [0]
+    tracemalloc.start()
+    preparation(data, ch_names, sample_rate, counter)
+    tracemalloc.stop()
+    # bytes allocated per epoch, in copies of the window
+    return result, {'seconds': min(seconds), 'allocated_bytes': counter[0], 'window_copies': counter[0] / data.nbytes}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the per-epoch cost of preparing an analysis window for sleep staging.')
+    parser.add_argument('--channels', type=int, nargs='+', default=[8, 64, 256])
+    parser.add_argument('--sample-rate', type=int, default=500)
+    parser.add_argument('--minutes', type=float, default=10, help='length of the window, ten minutes in the analyzer')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', default=None, help='write the report as json to this path')
+    args = parser.parse_args()
+
+    report = {'benchmark': 'window', 'parameters': vars(args), 'configurations': {}}
+    for n_channels in args.channels:
+        data = synthetic_eeg(n_channels, args.sample_rate, int(args.minutes * 60 * args.sample_rate)).astype(np.float64)
+        ch_names = synthetic_channel_names(n_channels)
+        mne_data, mne_report = measure(mne_preparation, data, ch_names, args.sample_rate, args.repeats)
+        window_data, window_report = measure(window_preparation, data, ch_names, args.sample_rate, args.repeats)
+        report['configurations'][f'{n_channels}ch@{args.sample_rate}Hz'] = {
+            'window_bytes': data.nbytes,
+            'mne': mne_report,
+            'window': window_report,
+            'speedup': mne_report['seconds'] / window_report['seconds'],
+            'window_copies_saved': mne_report['window_copies'] - window_report['window_copies'],
+            'identical': bool(np.array_equal(mne_data, window_data)),
+        }
+
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import os
+import shutil
+import socket
+
+# try:
+#     from database_handler import DatabaseHandler
+#     from helpers import configure_logger, ConfigManager
+# except:
+from .database_handler import DatabaseHandler
+from .helpers import configure_logger, ConfigManager
+
+
+def beds_path(base_path):
+    return os.path.join(base_path, "beds")
+
+
+def bed_path(base_path, name):
+    return os.path.join(beds_path(base_path), name)
+
+
+def find_free_port(start_port):
+    for port in range(start_port, start_port + 5000):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            if s.connect_ex(('localhost', port)) != 0:
+                return port
+    raise RuntimeError("Unable to find a free port after 5000 attempts")
+
+
+def setup_beds(base_path, config):
+    # every bed in config 'beds' ({'name': ..., 'lsl_stream_name': ...}) gets a directory of its own under
+    # base_path/beds with the layout of base_path itself: config.json, database, results and metrics. A bed's
+    # config is the main config plus the stream it records, its database and the port of its visualizer, so the
+    # components run unchanged with the bed directory as their base_path. Returns name -> ConfigManager
+    logger = configure_logger(base_path)
+    bed_config_managers = {}
+    port = config.get('visualizer_port', 8245)
+    for bed in config.get('beds', []):
+        name = bed['name']
+        path = bed_path(base_path, name)
+        for dirname in ['db', 'results', 'edfs', 'metrics']:
+            os.makedirs(os.path.join(path, 'data', dirname), exist_ok=True)
+        for dirname in ['results', 'edfs', 'metrics', 'spectra', 'checkpoints']:
+            dirpath = os.path.join(path, 'data', dirname)
+            for file in os.listdir(dirpath) if os.path.isdir(dirpath) else []:
+                os.remove(os.path.join(dirpath, file))
+
+        sim_input_file_path = os.path.join(base_path, 'eeg.edf')
+        if config.get('eeg_amp') == 'Simulator' and os.path.exists(sim_input_file_path):
+            shutil.copy(sim_input_file_path, os.path.join(path, 'eeg.edf'))
+
+        db_handler = DatabaseHandler(path)
+        db_file_path = db_handler.create_unique_db_filename(os.path.join(path, 'data', 'db', 'eeg_data.db'))
+        db_handler.setup_database(db_file_path, create_tables=True, role='writer',
+                                  profile=config.get('storage_profile', 'wal'))
+        db_handler.db.close()
+
+        port = find_free_port(port + 1)
+        bed_config = {key: value for key, value in config.items() if key != 'beds'}
+        bed_config.update({
+            'base_path': path,
+            'bed': name,
+            'lsl_stream_name': bed.get('lsl_stream_name', name),
+            'db_file_path': db_file_path,
+            'visualizer_port': port,
+        })
+        bed_config_managers[name] = ConfigManager(path, bed_config)
+        logger.info(f"Beds: {name}: stream '{bed_config['lsl_stream_name']}', database {db_file_path}, visualizer port {port}")
+    return bed_config_managers
@@ -0,0 +1,83 @@
+import numpy as np
+
+
+# first byte of a block's clock anchors; blocks with one stored timestamp per sample hold a zlib stream (0x78...)
+CLOCK_ANCHORS = b'C'
+
+
+def encode_anchors(anchors):
+    # rows of (offset of the first sample of a segment within the block, its time, the sample period)
+    return CLOCK_ANCHORS + np.asarray(anchors, dtype='<f8').tobytes()
+
+
+def anchor_timestamps(blob, n_samples):
+    # the timestamp of every sample of a block from its anchors
+    anchors = np.frombuffer(blob, dtype='<f8', offset=len(CLOCK_ANCHORS)).reshape(-1, 3)
+    offsets = anchors[:, 0].astype(np.int64)
+    samples = np.arange(n_samples)
+    segment = np.searchsorted(offsets, samples, side='right') - 1
+    return anchors[segment, 1] + (samples - offsets[segment]) * anchors[segment, 2]
+
+
+class ClockModel:
+    # running linear fit of the LSL timestamps against the sample index. Earlier samples are forgotten with a
+    # half-life, so the period follows the drift between the amplifier's clock and this machine's while the
+    # jitter of single timestamps averages out. A timestamp further than gap_seconds from the fit (samples
+    # lost, a clock reset) starts a new segment, anchored at that sample
+    def __init__(self, sample_rate, halflife_seconds=60, gap_seconds=0.1, min_fit_seconds=10):
+        self.nominal_period = 1 / sample_rate
+        self.decay = 0.5 ** (1 / (halflife_seconds * sample_rate))
+        self.gap_seconds = gap_seconds
+        self.min_fit_samples = min_fit_seconds * sample_rate
+        self.anchor_index = None
+        self.anchor_time = None
+        self.n_segments = 0
+
+    def reanchor(self, index, timestamp):
+        self.anchor_index, self.anchor_time = index, timestamp
+        # weighted sums of 1, x, y, x*x and x*y, x the samples since the anchor and y the seconds since it
+        self.sums = np.zeros(5)
+        self.n_fitted = 0
+        self.n_segments += 1
+
+    def update(self, indices, timestamps):
+        x = (indices - self.anchor_index).astype(np.float64)
+        y = timestamps - self.anchor_time
+        weights = self.decay ** np.arange(len(x) - 1, -1, -1, dtype=np.float64)
+        self.sums = self.sums * self.decay ** len(x) + [weights.sum(), weights @ x, weights @ y, weights @ (x * x), weights @ (x * y)]
+        self.n_fitted += len(x)
+
+    def estimate(self):
+        # (seconds at the anchor, period); the nominal period until min_fit_seconds of samples have been seen
+        weight, sx, sy, sxx, sxy = self.sums
+        if not weight:
+            return 0.0, self.nominal_period
+        mean_x, mean_y = sx / weight, sy / weight
+        variance = sxx / weight - mean_x ** 2
+        period = self.nominal_period
+        if self.n_fitted >= self.min_fit_samples and variance > 0:
+            period = (sxy / weight - mean_x * mean_y) / variance
+        return mean_y - period * mean_x, period
+
+    def predict(self, indices):
+        intercept, period = self.estimate()
+        return self.anchor_time + intercept + (indices - self.anchor_index) * period
+
+    def fit_block(self, timestamps, first_index):
+        # fits the block's timestamps and returns its anchors, one per segment it holds (see encode_anchors)
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        indices = first_index + np.arange(len(timestamps))
+        anchors = []
+        start = 0
+        while start < len(timestamps):
+            if self.anchor_index is None:
+                self.reanchor(indices[start], timestamps[start])
+            jumps = np.flatnonzero(np.abs(timestamps[start:] - self.predict(indices[start:])) > self.gap_seconds)
+            stop = start + jumps[0] if len(jumps) else len(timestamps)
+            if stop > start:
+                self.update(indices[start:stop], timestamps[start:stop])
+                anchors.append((start, float(self.predict(indices[start])), self.estimate()[1]))
+            if stop < len(timestamps):
+                self.reanchor(indices[stop], timestamps[stop])
+            start = stop
+        return anchors
@@ -0,0 +1,63 @@
+import os
+import signal
+import importlib
+
+# try:
+#     from helpers import ConfigManager, attach_log_queue, close_log_queue, configure_logger, flush_log_repeats
+#     from profiling import start_component_profiler
+# except:
+from .helpers import ConfigManager, attach_log_queue, close_log_queue, configure_logger, flush_log_repeats
+from .profiling import start_component_profiler
+
+
+# component classes are named rather than imported: the backend and every spawned process would otherwise import
+# flask, mne and the staging models whether they use them or not. Each process imports only its own class.
+COMPONENT_CLASSES = {
+    'producer': '.data_producer:DataProducer',
+    'recorder': '.data_recorder:DataRecorder',
+    'analyzer': '.data_analyzer:Analyzer',
+    'visualizer': '.data_visualizer:Visualizer',
+    'archiver': '.data_archiver:DataArchiver',
+}
+
+
+def load_component_class(component):
+    module_name, class_name = COMPONENT_CLASSES[component].split(':')
+    return getattr(importlib.import_module(module_name, __package__), class_name)
+
+
+def run_pipeline_component(component, role, config_states=(), log_queue=None, **kwargs):
+    # target of every component process, kept in this module so that unpickling it under spawn stays cheap
+    if log_queue is not None:
+        attach_log_queue(log_queue)
+    for config_state in config_states:
+        ConfigManager.attach(config_state)
+    component_class = load_component_class(component)
+    component = component_class(**kwargs)
+    profiler = start_component_profiler(role, kwargs['base_path'])
+
+    def stop_component():
+        try:
+            component.shutdown()
+        except Exception as e:
+            configure_logger(kwargs['base_path']).error(f"{role}: Error during shutdown: {e}", exc_info=True)
+        if profiler is not None:
+            profiler.stop()
+        flush_log_repeats()
+
+    # ProcessManager stops components with SIGTERM, whose default action kills the process before any of the
+    # above. Exit from the handler itself rather than raising SystemExit: the signal can land inside a callback
+    # from C (numba, lightgbm) where the exception is swallowed and the component keeps running.
+    def stop_and_exit(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        stop_component()
+        close_log_queue()
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop_and_exit)
+    try:
+        component.run()
+    finally:
+        # a SIGTERM from here on would stop the component a second time
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        stop_component()
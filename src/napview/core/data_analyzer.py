@@ -3,19 +3,40 @@ import ast
 import time
 import json
 import numpy as np
-import mne
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 # try:
 #     from database_handler import DatabaseHandler
 #     from helpers import configure_logger, ConfigManager
+#     from spectral import SpectralCache, SPECTRAL_FREQS, compute_epoch_spectra, spectra_path, staging_spectra
+#     from tracing import metrics_path, now, write_metrics_file
+#     from window import EEGWindow
 # except:
 from .database_handler import DatabaseHandler
 from .helpers import configure_logger, ConfigManager
+from .spectral import SpectralCache, SPECTRAL_FREQS, compute_epoch_spectra, spectra_path, staging_spectra
+from .tracing import metrics_path, now, write_metrics_file
+from .window import EEGWindow
+
+
+# mode -> (analysis method, whether it only needs the epoch itself rather than up to ten minutes leading up to it,
+#          whether it reads the spectra of its epochs from the spectral cache)
+ANALYSES = {
+    'U-Sleep': ('analyze_epoch_usleep_scorer', False, False),
+    'YASA': ('analyze_epoch_yasa_scorer', False, True),
+    'yasa_analyzer': ('analyze_epoch_yasa', True, True),
+}
+
+
+def checkpoints_path(base_path):
+    return os.path.join(base_path, "data", "checkpoints")
+
 
 class Analyzer:
 
-    def __init__(self, base_path, mode):
+    def __init__(self, base_path, mode, db_handler=None, spectral_cache=None, bed_paths=()):
 
         self.logger = configure_logger(base_path)
         self.logger.info('Analyzer: started...')
@@ -24,14 +45,45 @@ class Analyzer:
         self.base_path        = base_path
         self.results_path     = os.path.join(base_path, "data", "results")
         self.eeg_data         = None
-        self.info             = None
-        self.analysis_results = []
+        self.window           = None
+        self.ch_names         = None
+        self.trace            = {}
+        self.spectra          = None
+        self.epochs_done      = 0
+        self.channels         = {}
+        self.backfill         = []
+        self.budget           = {'level': 'realtime'}
+        self.failed_attempts  = {}
 
         self.config_manager = ConfigManager(base_path)
         self.config = self.config_manager.load_config(instance=self)
-
-        self.db_handler = DatabaseHandler(self.base_path)
-        self.db_handler.setup_database(self.db_file_path, create_tables=False)
+        # the position in the recording is epochs_done, the results are only kept for the most recent epochs
+        self.analysis_results = deque(maxlen=self.config.get('analysis_results_history', 100))
+        # precision of the samples read for analysis and of everything computed from them, 'float64' or 'float32'
+        self.compute_dtype = np.dtype(self.config.get('compute_dtype', 'float64'))
+        # minutes of recording leading up to an epoch that the analyses read, shortened while behind real time
+        self.context_minutes = 10
+
+        # in 'pool' mode this process hosts the analyses of several beds and has no database of its own
+        if self.mode == 'pool':
+            self.hosts = [Analyzer(bed_path, 'host') for bed_path in bed_paths]
+        elif db_handler is None:
+            self.db_handler = DatabaseHandler(self.base_path)
+            self.db_handler.setup_database(self.db_file_path, create_tables=False, role='reader',
+                                           profile=self.config.get('storage_profile', 'wal'))
+        else:
+            self.db_handler = db_handler
+
+        if spectral_cache is None:
+            persist_path = spectra_path(base_path) if self.config.get('spectral_cache_persist', False) else None
+            self.spectral_cache = SpectralCache(self.config.get('spectral_cache_epochs', 40), persist_path)
+        else:
+            self.spectral_cache = spectral_cache
+
+        # in 'host' mode this process reads each window once and hands it to one analyzer per analysis
+        if self.mode == 'host':
+            self.analyses = [Analyzer(base_path, analysis_mode, db_handler=self.db_handler, spectral_cache=self.spectral_cache)
+                             for analysis_mode in ['yasa_analyzer', self.config.get('sleep_staging_model', 'YASA')]]
 
         if self.mode == 'U-Sleep':
             from usleep_api import USleepAPI
@@ -43,22 +95,16 @@ class Analyzer:
                 self.logger.error(f'Analyzer: Failed to connect to Usleep API: {e}', exc_info=True)
                 self.api = None
 
-    def make_mne_object(self, data, sample_rate):
+    def make_window(self, data, sample_rate):
+        # the samples read from the database, in volts, without copying them
         try:
-            self.info = mne.create_info(
-                ch_names=json.loads(self.eeginfo.channel_names),
-                sfreq=sample_rate,
-                ch_types='eeg'
-            )
-            self.raw = mne.io.RawArray(data, self.info)
+            if self.ch_names is None:
+                self.ch_names = json.loads(self.eeginfo.channel_names)
+            self.window = EEGWindow(data, self.ch_names, sample_rate)
             self.sf = sample_rate
         except Exception as e:
-            self.logger.error(f'Analyzer: Failed to create MNE object: {e}', exc_info=True)
-            self.raw = None
-
-
-    def volts_to_microvolts(self,data):
-        return data * 1e6
+            self.logger.error(f'Analyzer: Failed to create analysis window: {e}', exc_info=True)
+            self.window = None
 
     def calculate_noise_level(self,channel_data):
         if np.all(channel_data == 0):
@@ -73,7 +119,7 @@ class Analyzer:
         best_channel = None
         for channel_name in channel_names:
             try:
-                channel_data = self.raw.copy().pick([channel_name]).get_data()
+                channel_data = self.window.channel(channel_name)
                 noise_level = self.calculate_noise_level(channel_data)
                 if noise_level < lowest_noise:
                     lowest_noise = noise_level
@@ -84,11 +130,15 @@ class Analyzer:
 
 
     def analyze_epoch_usleep_scorer(self, start_time):
+        from .edf_writer import EDFWriter
         small_edf_filepath = os.path.join(self.base_path, "data", "edfs", "temp_edf.edf")
         classifier_results_filepath = os.path.join(self.base_path, "data", "edfs", "temp_results.npy")
         try:
-            mne.export.export_raw(small_edf_filepath, self.raw, fmt='edf', overwrite=True)
+            data = self.window.data
+            with EDFWriter(small_edf_filepath, self.window.ch_names, self.window.sfreq, data.min(axis=1), data.max(axis=1)) as writer:
+                writer.write_samples(data)
             self.logger.info(f'Analyzer: Scorer: Temporary EDF created for scoring: {small_edf_filepath}')
+            self.mark('features_done')
         except Exception as e:
             self.logger.error(f'Analyzer: Scorer: Failed to create temporary EDF: {e}', exc_info=True)
             return None
@@ -104,6 +154,7 @@ class Analyzer:
                 )
                 self.logger.info('Analyzer: Scorer: Usleep epoch scoring complete')
                 results = np.load(classifier_results_filepath) / 12
+                self.mark('prediction_done')
             else:
                 self.logger.error('Analyzer: Scorer: Usleep API not initialized', exc_info=True)
                 results = np.zeros((1, 5))
@@ -122,6 +173,8 @@ class Analyzer:
 
         results_output_filepath = os.path.join(self.base_path, "data", "results", "staging_results.txt")
         try:
+            analysis_result['budget'] = self.budget
+            analysis_result['trace'] = self.mark('result_written')
             with open(results_output_filepath, 'a') as f:
                 json.dump(analysis_result, f)
                 f.write('\n')
@@ -132,10 +185,10 @@ class Analyzer:
 
 
 
-    def analyze_epoch_yasa(self, start_time):
+    def analyze_epoch_yasa(self, start_time, write_result=True):
 
 
-        from .yasa_staging_minimal import bandpower
+        from .yasa_staging_minimal import bandpower_from_psd_ndarray
 
         def find_channel(channels, options):
             for option in options:
@@ -146,44 +199,50 @@ class Analyzer:
 
         try:
             preferred_yasa_channel = self.config.get('preferred_yasa_channel')
-            if preferred_yasa_channel and preferred_yasa_channel in self.raw.ch_names:
+            if preferred_yasa_channel and preferred_yasa_channel in self.window.ch_names:
                 bandpower_channel_name = preferred_yasa_channel
             else:
-                bandpower_channel_name = find_channel(self.raw.ch_names, ["c3", "c4", "o1", "o2"])
+                bandpower_channel_name = find_channel(self.window.ch_names, ["c3", "c4", "o1", "o2"])
                 if not bandpower_channel_name:
-                    bandpower_channel_name = self.raw.ch_names[0]
+                    bandpower_channel_name = self.window.ch_names[0]
 
-            # spindle_channel_name = find_channel(self.raw.ch_names, ["c3", "c4"])
+            # spindle_channel_name = find_channel(self.window.ch_names, ["c3", "c4"])
             # if not spindle_channel_name:
-            #     spindle_channel_name = self.raw.ch_names[0]
+            #     spindle_channel_name = self.window.ch_names[0]
 
-            # eye_movement_channel_name = find_channel(self.raw.ch_names, ["eog"])
+            # eye_movement_channel_name = find_channel(self.window.ch_names, ["eog"])
             # if not eye_movement_channel_name:
-            #     eye_movement_channel_name = find_channel(self.raw.ch_names, ["fp1", "fp2"])
+            #     eye_movement_channel_name = find_channel(self.window.ch_names, ["fp1", "fp2"])
             # if not eye_movement_channel_name:
-            #     eye_movement_channel_name = self.raw.ch_names[0]
+            #     eye_movement_channel_name = self.window.ch_names[0]
 
             if bandpower_channel_name in ["c3", "c4"]:
                 try:
-                    c3_noise = self.calculate_noise_level(self.raw.copy().pick(["c3"]).get_data())
-                    c4_noise = self.calculate_noise_level(self.raw.copy().pick(["c4"]).get_data())
+                    c3_noise = self.calculate_noise_level(self.window.channel("c3"))
+                    c4_noise = self.calculate_noise_level(self.window.channel("c4"))
                     bandpower_channel_name = "c3" if c3_noise < c4_noise else "c4"
                 except Exception as e:
                     self.logger.warning(f'Analyzer: YASA: Failed to calculate noise level for bandpower channels: {e}', exc_info=True)
-                    bandpower_channel_name = self.raw.ch_names[0]
+                    bandpower_channel_name = self.window.ch_names[0]
 
             # if spindle_channel_name in ["c3", "c4"]:
             #     try:
-            #         c3_noise = self.calculate_noise_level(self.raw.copy().pick(["c3"]).get_data())
-            #         c4_noise = self.calculate_noise_level(self.raw.copy().pick(["c4"]).get_data())
+            #         c3_noise = self.calculate_noise_level(self.window.channel("c3"))
+            #         c4_noise = self.calculate_noise_level(self.window.channel("c4"))
             #         spindle_channel_name = "c3" if c3_noise < c4_noise else "c4"
             #     except Exception as e:
             #         self.logger.warning(f'Analyzer: YASA: Failed to calculate noise level for spindle channels: {e}', exc_info=True)
-            #         spindle_channel_name = self.raw.ch_names[0]
+            #         spindle_channel_name = self.window.ch_names[0]
 
-            bandpower_channel = self.raw.copy().pick([bandpower_channel_name]).apply_function(self.volts_to_microvolts)
-            #spindle_channel = self.raw.copy().pick([spindle_channel_name]).apply_function(self.volts_to_microvolts)
-            #eye_movement_channel = self.raw.copy().pick([eye_movement_channel_name]).apply_function(self.volts_to_microvolts)
+            self.channels = {'bandpower': bandpower_channel_name}
+
+            # band powers are computed for these channels in one go; the scalar fields stay those of bandpower_channel_name
+            bandpower_channel_names = [ch for ch in self.config.get('bandpower_channels', []) if ch in self.window.ch_names]
+            bandpower_channel_names = bandpower_channel_names or list(self.window.ch_names)
+            if bandpower_channel_name not in bandpower_channel_names:
+                bandpower_channel_names.append(bandpower_channel_name)
+            #spindle_channel = self.window.pick([spindle_channel_name], scale=1e6)
+            #eye_movement_channel = self.window.pick([eye_movement_channel_name], scale=1e6)
 
             analysis_result = {
                 'start_time': start_time,
@@ -199,14 +258,24 @@ class Analyzer:
             try:
                 bands = [(0.5, 4, 'Delta'), (4, 8, 'Theta'), (8, 12, 'Alpha'),
                          (12, 16, 'Sigma'), (16, 30, 'Beta'), (30, 40, 'Gamma')]
-                bandpower_df = bandpower(bandpower_channel, bands=bands)
+                freqs, psd = self.spectra
+                rows = [self.window.index(ch) for ch in bandpower_channel_names]
+                band_powers = bandpower_from_psd_ndarray(psd[rows, -1], freqs, bands=bands)
+                powers = dict(zip([name for _, _, name in bands], band_powers[:, bandpower_channel_names.index(bandpower_channel_name)]))
                 analysis_result.update({
-                    'alpha_power': bandpower_df['Alpha'].mean(),
-                    'beta_power': bandpower_df['Beta'].mean(),
-                    'theta_power': bandpower_df['Theta'].mean(),
-                    'delta_power': bandpower_df['Delta'].mean(),
-                    'gamma_power': bandpower_df['Gamma'].mean(),
+                    'alpha_power': float(powers['Alpha']),
+                    'beta_power': float(powers['Beta']),
+                    'theta_power': float(powers['Theta']),
+                    'delta_power': float(powers['Delta']),
+                    'gamma_power': float(powers['Gamma']),
                 })
+                # relative power per channel (rows) and band (columns)
+                analysis_result['band_powers'] = {
+                    'channels': bandpower_channel_names,
+                    'bands': [name for _, _, name in bands],
+                    'values': np.round(band_powers.T, 6).tolist(),
+                }
+                self.mark('features_done')
             except Exception as e:
                 self.logger.warning(f'Analyzer: YASA: Failed to compute band power: {e}', exc_info=True)
 
@@ -224,9 +293,14 @@ class Analyzer:
             # except Exception as e:
             #     self.logger.warning(f'Analyzer: YASA: Failed to detect eye movements: {e}', exc_info=True)
 
+            if not write_result:
+                return analysis_result
+
             results_output_filepath = os.path.join(self.base_path, "data", "results", "yasa_results.txt")
 
             try:
+                analysis_result['budget'] = self.budget
+                analysis_result['trace'] = self.mark('result_written')
                 with open(results_output_filepath, 'a') as f:
                     json.dump(analysis_result, f)
                     f.write('\n')
@@ -238,7 +312,7 @@ class Analyzer:
             self.logger.error(f'Analyzer: YASA: Failed to analyze epoch: {e}', exc_info=True)
             return None
 
-    def analyze_epoch_yasa_scorer(self, start_time):
+    def analyze_epoch_yasa_scorer(self, start_time, write_result=True):
 
         from .yasa_staging_minimal import SleepStaging
 
@@ -273,37 +347,40 @@ class Analyzer:
             emg_keywords = ["emg", "chin"]
 
             preferred_yasa_channel = self.config.get('preferred_yasa_channel')
-            if preferred_yasa_channel and preferred_yasa_channel in self.raw.ch_names:
+            if preferred_yasa_channel and preferred_yasa_channel in self.window.ch_names:
                 eeg_channel = preferred_yasa_channel
             else:
                 eeg_keywords = ["c3", "c4", "o1", "o2", "oz", "fp1", "fp2", "f3", "f4", "t3", "t4", "p3", "p4", "cz", "fz", "pz"]
-                eeg_channel = find_channels_by_keywords(self.raw.ch_names, eeg_keywords)
+                eeg_channel = find_channels_by_keywords(self.window.ch_names, eeg_keywords)
                 if not eeg_channel:
-                    eeg_channel = self.raw.ch_names[0]
+                    eeg_channel = self.window.ch_names[0]
                 else:
                     eeg_channel = self.find_lowest_noise_channel(eeg_channel)
 
-            # eeg_channel = find_channels_by_keywords(self.raw.ch_names, eeg_keywords)
+            # eeg_channel = find_channels_by_keywords(self.window.ch_names, eeg_keywords)
             # if not eeg_channel:
-            #     eeg_channel = self.raw.ch_names[0]
+            #     eeg_channel = self.window.ch_names[0]
             # else:
             #     eeg_channel = self.find_lowest_noise_channel(eeg_channel)
 
-            eog_channel = find_channels_by_keywords(self.raw.ch_names, eog_primary_keywords, eog_fallback_keywords)
-            if eog_channel:
-                eog_channel = self.find_lowest_noise_channel(eog_channel)
+            eog_channel = find_channels_by_keywords(self.window.ch_names, eog_primary_keywords, eog_fallback_keywords)
+            eog_channel = self.find_lowest_noise_channel(eog_channel) if eog_channel else None
 
-            emg_channel = find_channels_by_keywords(self.raw.ch_names, emg_keywords)
-            if emg_channel:
-                emg_channel = self.find_lowest_noise_channel(emg_channel)
-
-            raw_microvolts = self.raw.copy().apply_function(self.volts_to_microvolts)
+            emg_channel = find_channels_by_keywords(self.window.ch_names, emg_keywords)
+            emg_channel = self.find_lowest_noise_channel(emg_channel) if emg_channel else None
 
             self.logger.info(f'Analyzer: YASA will now analyse recent eeg data, using channels: EEG: {eeg_channel}, EOG: {eog_channel}, EMG: {emg_channel}')
+            self.channels = {'eeg': eeg_channel, 'eog': eog_channel, 'emg': emg_channel}
+
+            freqs, psd = self.spectra
+            spectra = {ch: (freqs, staging_spectra(psd[self.window.index(ch)])) for ch in [eeg_channel, eog_channel, emg_channel] if ch}
+            # SleepStaging converts the window from volts to uV itself, like the spectra it is given are in uV^2/Hz
+            sls = SleepStaging(self.window, eeg_name=eeg_channel, eog_name=eog_channel, emg_name=emg_channel, spectra=spectra)
+            sls.fit()
+            self.mark('features_done')
 
-            sls = SleepStaging(raw_microvolts, eeg_name=eeg_channel, eog_name=eog_channel, emg_name=emg_channel)
-            
             stage_probs = sls.predict_proba()
+            self.mark('prediction_done')
             latest_epoch_probs = stage_probs.iloc[-1]
 
             analysis_result.update({
@@ -316,12 +393,17 @@ class Analyzer:
         except Exception as e:
             self.logger.error(f'Analyzer: YASA Stager: Failed to perform sleep staging: {e}',exc_info=True)
             try:
-                self.logger.error(f'Channels: {self.raw.ch_names}, eeg: {eeg_channel}, eog: {eog_channel}, emg: {emg_channel}')
+                self.logger.error(f'Channels: {self.window.ch_names}, eeg: {eeg_channel}, eog: {eog_channel}, emg: {emg_channel}')
             except Exception as e:
                 self.logger.error(f'Analyzer: YASA Stager: unable to log channels during exception: {e}',exc_info=True)
 
+        if not write_result:
+            return analysis_result
+
         results_output_filepath = os.path.join(self.base_path, "data", "results", "staging_results.txt")
         try:
+            analysis_result['budget'] = self.budget
+            analysis_result['trace'] = self.mark('result_written')
             with open(results_output_filepath, 'a') as f:
                 json.dump(analysis_result, f)
                 f.write('\n')
@@ -331,49 +413,291 @@ class Analyzer:
 
         return analysis_result
 
+    def warm_up(self):
+        # stage a stretch of noise with the recording's channel layout before the first real epoch, so that
+        # imports, numba compilation and classifier loading do not land on the first result
+        if self.mode not in ('YASA', 'yasa_analyzer') or not self.config.get('analyzer_warm_up_seconds', 120):
+            return
+        start = time.perf_counter()
+        try:
+            channel_names = json.loads(self.eeginfo.channel_names)
+            n_samples = int(self.config.get('analyzer_warm_up_seconds', 120) * self.eeginfo.sample_rate)
+            data = (np.random.default_rng(0).standard_normal((len(channel_names), n_samples)) * 20e-6).astype(self.compute_dtype)
+            self.make_window(data, self.eeginfo.sample_rate)
+            self.spectra = (SPECTRAL_FREQS, compute_epoch_spectra(data, self.eeginfo.sample_rate, self.samples_per_epoch()))
+            if self.mode == 'YASA':
+                self.analyze_epoch_yasa_scorer(None, write_result=False)
+            else:
+                self.analyze_epoch_yasa(None, write_result=False)
+            warm_up_seconds = time.perf_counter() - start
+            self.logger.info(f'Analyzer: {self.mode}: warm-up finished in {warm_up_seconds:.2f} s')
+            os.makedirs(metrics_path(self.base_path), exist_ok=True)
+            write_metrics_file(os.path.join(metrics_path(self.base_path), f'analyzer_{self.mode}.json'),
+                               {'mode': self.mode, 'warm_up_seconds': warm_up_seconds, 'finished': now()})
+        except Exception as e:
+            self.logger.error(f'Analyzer: {self.mode}: warm-up failed: {e}', exc_info=True)
+        finally:
+            self.window = None
+            self.spectra = None
+            self.trace = {}
+
+    def start_trace(self, end_idx):
+        # acquisition time of the sample that closes the epoch, and when the recorder pulled and committed it
+        self.trace = {'acquired': self.db_handler.get_sample_timestamp(end_idx)}
+        self.trace.update(self.db_handler.get_block_trace(end_idx))
+        self.mark('epoch_closed')
+
+    def checkpoint_file_path(self):
+        return os.path.join(checkpoints_path(self.base_path), f'analyzer_{self.mode}.json')
+
+    def save_checkpoint(self):
+        # the last epoch analyzed and the channels each analysis chose for it, rewritten after every epoch. The
+        # spectra of the window are not part of it: the spectral cache keeps them on disk with
+        # spectral_cache_persist, otherwise the first window after a restart is computed once more
+        analyses = self.analyses if self.mode == 'host' else [self]
+        try:
+            os.makedirs(checkpoints_path(self.base_path), exist_ok=True)
+            write_metrics_file(self.checkpoint_file_path(), {
+                'db_file_path': self.db_file_path,
+                'epochs_done': self.epochs_done,
+                'backfill': self.backfill,
+                'channels': {analysis.mode: analysis.channels for analysis in analyses},
+                'written': now(),
+            })
+        except Exception as e:
+            self.logger.warning(f'Analyzer: {self.mode}: failed to save checkpoint: {e}', exc_info=True)
+
+    def load_checkpoint(self):
+        # a restarted analyzer carries on after the last epoch it analyzed, if that was of the same database
+        if not os.path.exists(self.checkpoint_file_path()):
+            return
+        try:
+            with open(self.checkpoint_file_path(), 'r') as f:
+                checkpoint = json.load(f)
+        except Exception as e:
+            self.logger.warning(f'Analyzer: {self.mode}: failed to read checkpoint: {e}', exc_info=True)
+            return
+        if checkpoint.get('db_file_path') != self.db_file_path:
+            return
+        self.epochs_done = checkpoint['epochs_done']
+        self.backfill = [tuple(entry) for entry in checkpoint.get('backfill', [])]
+        for analysis in (self.analyses if self.mode == 'host' else [self]):
+            analysis.channels = checkpoint['channels'].get(analysis.mode, {})
+        self.logger.info(f'Analyzer: {self.mode}: resuming after epoch {self.epochs_done} from checkpoint, channels {checkpoint["channels"]}')
+
+    def mark(self, stage):
+        self.trace[stage] = now()
+        return self.trace
+
     def shutdown(self):
         self.logger.info("Analyzer: Shutting down...")
 
-    def maximize_analysis_epoch(self, start_idx, end_idx, single_epoch=False):
-        try:
-            total_samples = self.db_handler.get_total_n_samples()
-            ten_minutes_samples = 10 * 60 * self.eeginfo.sample_rate
+    def samples_per_epoch(self):
+        return self.epoch_length * self.eeginfo.sample_rate
 
-            if total_samples <= ten_minutes_samples:
-                start_idx_max = max(0, end_idx - (total_samples // self.epoch_length) * self.epoch_length)
-            else:
-                start_idx_max = end_idx - ten_minutes_samples
-                start_idx_max = (start_idx_max // self.epoch_length) * self.epoch_length
-            if single_epoch:
-                start_idx_max = start_idx
+    def analysis_window_start(self, start_idx, end_idx, single_epoch=False):
+        if single_epoch:
+            return start_idx
+        # whole epochs, up to context_minutes of them, ending with the epoch being analyzed
+        n_epochs = min((end_idx + 1) // self.samples_per_epoch(), (self.context_minutes * 60) // self.epoch_length)
+        return end_idx + 1 - n_epochs * self.samples_per_epoch()
 
-            epoch_data = self.db_handler.retrieve_data(start_idx_max, end_idx)
-            self.make_mne_object(epoch_data, self.eeginfo.sample_rate)
+    def spectral_window_start(self, window_start):
+        # the epoch before a window, where there is one, takes the start-up of the spectral stage's filter
+        return max(window_start - self.samples_per_epoch(), 0)
+
+    def maximize_analysis_epoch(self, start_idx, end_idx, single_epoch=False, spectral=False):
+        try:
+            start_idx_max = self.analysis_window_start(start_idx, end_idx, single_epoch)
+            data_start = self.spectral_window_start(start_idx_max) if spectral else start_idx_max
+            epoch_data = self.db_handler.retrieve_data(data_start, end_idx, self.compute_dtype)
+            if spectral:
+                freqs, psd = self.spectral_cache.window_spectra(epoch_data, self.eeginfo.sample_rate, data_start, self.samples_per_epoch())
+                self.spectra = (freqs, psd[:, (start_idx_max - data_start) // self.samples_per_epoch():])
+            self.make_window(epoch_data[:, start_idx_max - data_start:], self.eeginfo.sample_rate)
             return start_idx_max
         except Exception as e:
             self.logger.error(f'Analyzer: Failed to maximize analysis epoch: {e}', exc_info=True)
             return None
 
-    def run(self):
+    def run_analyses(self, executor, start_idx, end_idx, start_time, modes=None):
+        # one read and decode of the widest window any analysis needs, and one pass of the spectral stage over it;
+        # each analysis gets its part of both and a copy of the trace, and they run side by side (numpy, scipy
+        # and lightgbm release the GIL)
+        analyses = [analysis for analysis in self.analyses if modes is None or analysis.mode in modes]
+        window_start = min(self.analysis_window_start(start_idx, end_idx, ANALYSES[analysis.mode][1])
+                           for analysis in analyses)
+        spectral = any(ANALYSES[analysis.mode][2] for analysis in analyses)
+        data_start = self.spectral_window_start(window_start) if spectral else window_start
+        window_data = self.db_handler.retrieve_data(data_start, end_idx, self.compute_dtype)
+        if spectral:
+            freqs, psd = self.spectral_cache.window_spectra(window_data, self.eeginfo.sample_rate, data_start, self.samples_per_epoch())
+        futures = []
+        for analysis in analyses:
+            method, single_epoch, analysis_spectral = ANALYSES[analysis.mode]
+            analysis_start = analysis.analysis_window_start(start_idx, end_idx, single_epoch)
+            analysis.make_window(window_data[:, analysis_start - data_start:], self.eeginfo.sample_rate)
+            if analysis_spectral:
+                analysis.spectra = (freqs, psd[:, (analysis_start - data_start) // self.samples_per_epoch():])
+            analysis.trace = dict(self.trace)
+            analysis.budget = self.budget
+            futures.append(executor.submit(getattr(analysis, method), start_time))
+        results = {}
+        for analysis, future in zip(analyses, futures):
+            try:
+                results[analysis.mode] = future.result()
+            except Exception as e:
+                self.logger.error(f'Analyzer: host: {analysis.mode} failed: {e}', exc_info=True)
+                results[analysis.mode] = None
+            if results[analysis.mode] is not None:
+                analysis.analysis_results.append(results[analysis.mode])
+        return results
 
+    def start_host(self, executor):
         self.eeginfo = self.db_handler.retrieve_info()
+        self.load_checkpoint()
+        for analysis in self.analyses:
+            analysis.eeginfo = self.eeginfo
+        list(executor.map(lambda analysis: analysis.warm_up(), self.analyses))
+
+    def next_epoch(self):
+        # the epoch to analyze next, the analyses to run on it and whether it is backfilled; (None, None, False)
+        # when there is none. The lag is the recording waiting behind the next epoch: from
+        # analysis_lag_reduce_seconds on the analyses read a shorter context and the band-power analysis of the
+        # host pauses, from analysis_lag_skip_seconds on the analyzer skips to the latest epoch. What is left out
+        # is backfilled, oldest first, once the analyzer has caught up; a backfilled epoch's lag is its own, and its
+        # rows are appended to the results files after those of later epochs (budget 'backfilled')
+        analyses = self.analyses if self.mode == 'host' else [self]
+        modes = [analysis.mode for analysis in analyses]
+        total_n_samples = self.db_handler.get_total_n_samples() or 0
+        n_epochs = total_n_samples // self.samples_per_epoch()
+        if n_epochs <= self.epochs_done:
+            if not self.backfill:
+                return None, None, False
+            epoch, modes = self.backfill[0]
+            lag = (total_n_samples - (epoch + 1) * self.samples_per_epoch()) / self.eeginfo.sample_rate
+            self.set_context(analyses, 10)
+            self.budget = {'level': 'backfilling', 'lag_seconds': round(lag, 3), 'context_minutes': 10, 'paused': [],
+                           'skipped_epochs': 0, 'backfilled': True, 'backfill_pending': len(self.backfill)}
+            return epoch, modes, True
+
+        lag = (total_n_samples - (self.epochs_done + 1) * self.samples_per_epoch()) / self.eeginfo.sample_rate
+        level, skipped, paused = 'realtime', 0, []
+        if self.config.get('analysis_budget', True):
+            if lag >= self.config.get('analysis_lag_skip_seconds', 300):
+                level, skipped = 'skipping', n_epochs - 1 - self.epochs_done
+                self.backfill.extend((epoch, modes) for epoch in range(self.epochs_done, n_epochs - 1))
+                self.epochs_done = n_epochs - 1
+            elif lag >= self.config.get('analysis_lag_reduce_seconds', 60) or \
+                    (self.budget['level'] in ('reduced', 'skipping') and lag >= self.epoch_length):
+                # back to real time only once less than an epoch behind
+                level = 'reduced'
+        context_minutes = 10
+        if level != 'realtime':
+            context_minutes = self.config.get('analysis_reduced_context_minutes', 5)
+            if self.mode == 'host' and len(modes) > 1 and 'yasa_analyzer' in modes:
+                # queued for backfill by finish_epoch, once the epoch has been analyzed
+                paused = ['yasa_analyzer']
+                modes = [mode for mode in modes if mode not in paused]
+        if level != self.budget['level'] or skipped:
+            log = self.logger.info if level == 'realtime' else self.logger.warning
+            log(f'Analyzer: {self.mode}: {lag:.1f} s behind real time, {level}: context {context_minutes} min, '
+                f'paused {paused}, {skipped} epochs skipped, {len(self.backfill)} to backfill')
+        self.set_context(analyses, context_minutes)
+        self.budget = {'level': level, 'lag_seconds': round(lag, 3), 'context_minutes': context_minutes, 'paused': paused,
+                       'skipped_epochs': skipped, 'backfilled': False, 'backfill_pending': len(self.backfill) + bool(paused)}
+        return self.epochs_done, modes, False
+
+    def set_context(self, analyses, context_minutes):
+        self.context_minutes = context_minutes
+        for analysis in analyses:
+            analysis.context_minutes = context_minutes
+
+    def finish_epoch(self, backfilled, analysis_seconds):
+        if analysis_seconds > self.epoch_length:
+            self.logger.warning(f'Analyzer: {self.mode}: an epoch took {analysis_seconds:.1f} s to analyze, longer than the epoch itself')
+        if backfilled:
+            self.backfill.pop(0)
+        else:
+            if self.budget.get('paused'):
+                self.backfill.append((self.epochs_done, self.budget['paused']))
+            self.epochs_done += 1
+        self.save_checkpoint()
+
+    def analyze_next_epoch(self, executor):
+        # returns whether there was an epoch to analyze
+        epoch, modes, backfilled = self.next_epoch()
+        if epoch is None:
+            return False
+        start_idx, end_idx, start_time = self.db_handler.find_next_epoch_indices(epoch, self.epoch_length)
+        if start_idx is None:
+            return False
+        self.start_trace(end_idx)
+        started = time.perf_counter()
+        self.analysis_results.append(self.run_analyses(executor, start_idx, end_idx, start_time, modes))
+        self.finish_epoch(backfilled, time.perf_counter() - started)
+        return True
+
+    def run_host(self):
+        with ThreadPoolExecutor(max_workers=len(self.analyses), thread_name_prefix='analysis') as executor:
+            self.start_host(executor)
+            while True:
+                self.analyze_next_epoch(executor)
+                time.sleep(0.1)
+
+    def run_pool(self):
+        # one epoch per bed in turn, so a bed with a backlog cannot hold up the others
+        with ThreadPoolExecutor(max_workers=len(self.hosts[0].analyses), thread_name_prefix='analysis') as executor:
+            for host in self.hosts:
+                host.start_host(executor)
+            while True:
+                if not any([host.analyze_next_epoch(executor) for host in self.hosts]):
+                    time.sleep(0.1)
+
+    def run(self):
 
+        if self.mode == 'pool':
+            return self.run_pool()
+        if self.mode == 'host':
+            return self.run_host()
+        self.start()
         while True:
-            start_idx, end_idx, start_time = self.db_handler.find_next_epoch_indices(len(self.analysis_results), self.epoch_length)
-
-            if start_idx is not None:
-                if self.mode == 'U-Sleep':
-                    self.maximize_analysis_epoch(start_idx, end_idx)
-                    analysis_result = self.analyze_epoch_usleep_scorer(start_time)
-                elif self.mode == 'YASA':
-                    self.maximize_analysis_epoch(start_idx, end_idx)
-                    analysis_result = self.analyze_epoch_yasa_scorer(start_time)
-                elif self.mode == 'yasa_analyzer':
-                    self.maximize_analysis_epoch(start_idx, end_idx, single_epoch=True)
-                    analysis_result = self.analyze_epoch_yasa(start_time)
-                else:
-                    self.logger.error(f'Analyzer: Unknown mode: {self.mode}', exc_info=True)
-                    analysis_result = None
-                if analysis_result is not None:
-                    self.analysis_results.append(analysis_result)
+            self.step()
             time.sleep(0.1)
+
+    def start(self):
+        self.eeginfo = self.db_handler.retrieve_info()
+        self.load_checkpoint()
+        self.warm_up()
+
+    def step(self):
+        # analyzes the next epoch (see next_epoch) if the recording holds all of it; returns whether one was
+        # analyzed. A failed epoch is tried again at the next step, up to analysis_max_attempts times, then dropped
+        # so that it does not hold up every epoch after it
+        epoch, _, backfilled = self.next_epoch()
+        if epoch is None:
+            return False
+        start_idx, end_idx, start_time = self.db_handler.find_next_epoch_indices(epoch, self.epoch_length)
+        if start_idx is None:
+            return False
+        self.start_trace(end_idx)
+        started = time.perf_counter()
+        if self.mode in ANALYSES:
+            method, single_epoch, spectral = ANALYSES[self.mode]
+            self.maximize_analysis_epoch(start_idx, end_idx, single_epoch=single_epoch, spectral=spectral)
+            analysis_result = getattr(self, method)(start_time)
+        else:
+            self.logger.error(f'Analyzer: Unknown mode: {self.mode}', exc_info=True)
+            analysis_result = None
+        if analysis_result is not None:
+            self.analysis_results.append(analysis_result)
+            self.failed_attempts.pop(epoch, None)
+            self.finish_epoch(backfilled, time.perf_counter() - started)
+        else:
+            attempts = self.failed_attempts.pop(epoch, 0) + 1
+            if attempts >= self.config.get('analysis_max_attempts', 3):
+                self.logger.error(f'Analyzer: {self.mode}: epoch {epoch} failed {attempts} times, dropped without a result')
+                self.finish_epoch(backfilled, time.perf_counter() - started)
+            else:
+                self.failed_attempts[epoch] = attempts
+        return analysis_result is not None
@@ -0,0 +1,110 @@
+import os
+import time
+import json
+from datetime import datetime, timezone
+
+# try:
+#     from database_handler import DatabaseHandler
+#     from edf_writer import EDFWriter
+#     from helpers import configure_logger, ConfigManager
+# except:
+from .database_handler import DatabaseHandler
+from .edf_writer import EDFWriter
+from .helpers import configure_logger, ConfigManager
+
+
+def archive_file_path(base_path, db_file_path):
+    # one archive per recording database, so a restarted session never appends to an old night
+    name = os.path.splitext(os.path.basename(db_file_path))[0]
+    return os.path.join(base_path, "data", "archive", f"{name}.edf")
+
+
+def finalize_archive(db_handler, archive_path, chunk_size=None):
+    # append whatever the archiver had not written yet and fix the header; the archive is then complete
+    writer = EDFWriter.resume(archive_path)
+    total_samples = db_handler.get_total_n_samples() or 0
+    chunk_size = chunk_size or writer.samples_per_record * 60
+    next_sample = writer.n_samples_written
+    if total_samples > next_sample:
+        for _, chunk in db_handler.iter_data_chunks(next_sample, total_samples - 1, chunk_size):
+            writer.write_samples(chunk)
+    writer.close(pad=True)
+    return {'n_samples': total_samples, 'n_records': writer.n_records, 'appended_samples': max(0, total_samples - next_sample)}
+
+
+class DataArchiver:
+    def __init__(self, base_path, mode):
+        self.base_path = base_path
+        self.mode = mode
+
+        self.logger = configure_logger(base_path)
+        self.logger.info('Archiver: started...')
+
+        self.config_manager = ConfigManager(base_path)
+        self.config = self.config_manager.load_config(instance=self)
+        self.db_file_path = self.config.get('db_file_path')
+        self.physical_range = self.config.get('edf_archive_physical_range', 5000) / 1e6
+        self.header_interval = self.config.get('edf_archive_header_interval', 10)
+        self.poll_interval = 1
+
+        self.db_handler = DatabaseHandler(base_path)
+        self.db_handler.setup_database(self.db_file_path, create_tables=False, role='reader',
+                                       profile=self.config.get('storage_profile', 'wal'))
+        self.archive_path = archive_file_path(base_path, self.db_file_path)
+        self.writer = None
+
+    def open_archive(self, eeg_info):
+        os.makedirs(os.path.dirname(self.archive_path), exist_ok=True)
+        if os.path.exists(self.archive_path):
+            self.writer = EDFWriter.resume(self.archive_path)
+            self.logger.info(f"Archiver: resumed {self.archive_path} at record {self.writer.n_records}")
+        else:
+            self.writer = EDFWriter(
+                self.archive_path,
+                json.loads(eeg_info.channel_names),
+                eeg_info.sample_rate,
+                -self.physical_range,
+                self.physical_range,
+                start_datetime=datetime.now(timezone.utc),
+            )
+            self.writer.open()
+            self.logger.info(f"Archiver: writing continuous EDF archive to {self.archive_path}")
+
+    def archive_loop(self):
+        chunk_size = self.writer.samples_per_record * 60
+        last_header_update = time.perf_counter()
+        while True:
+            try:
+                total_samples = self.db_handler.get_total_n_samples()
+                next_sample = self.writer.n_samples_written
+                if total_samples is not None and total_samples > next_sample:
+                    for _, chunk in self.db_handler.iter_data_chunks(next_sample, total_samples - 1, chunk_size):
+                        self.writer.write_samples(chunk)
+                    self.writer.file.flush()
+
+                if time.perf_counter() - last_header_update >= self.header_interval:
+                    self.writer.update_header()
+                    self.writer.sync()
+                    last_header_update = time.perf_counter()
+            except Exception as e:
+                self.logger.error(f"Archiver: Error while appending to archive: {e}", exc_info=True)
+            time.sleep(self.poll_interval)
+
+    def run(self):
+        try:
+            eeg_info = self.db_handler.retrieve_info()
+            if eeg_info is None:
+                self.logger.error("Archiver: No recording info found, nothing to archive.")
+                return
+            self.open_archive(eeg_info)
+            self.archive_loop()
+        except Exception as e:
+            self.logger.error(f"Archiver: Error during run: {e}", exc_info=True)
+
+    def shutdown(self):
+        self.logger.info("Archiver: Shutting down...")
+        if self.writer is not None and self.writer.file is not None:
+            # leave the partial record out: finalize_archive appends it together with the remaining tail
+            self.writer.close(pad=False)
+            self.logger.info(f"Archiver: archive header updated ({self.writer.n_records} records)")
+        self.logger.info("Archiver: Shutdown.")
@@ -1,15 +1,24 @@
+import os
 import time
 import socket
 import numpy as np
-import mne
 from pylsl import StreamInfo, StreamOutlet
 from struct import unpack
 from pathlib import Path
 
 # try:
+#     from edf_writer import read_edf_header
 #     from helpers import configure_logger, ConfigManager
+#     from tracing import LatencyHistogram, metrics_path, now, write_metrics_file
 # except:
+from .edf_writer import read_edf_header
 from .helpers import configure_logger, ConfigManager
+from .tracing import LatencyHistogram, metrics_path, now, write_metrics_file
+
+
+EDF_UNITS = {'v': 1, 'mv': 1e-3, 'uv': 1e-6, 'µv': 1e-6, 'nv': 1e-9}
+# samples per push of the Simulator
+SIMULATION_CHUNK_SIZE = 10
 
 
 class DataProducer:
@@ -20,11 +29,41 @@ class DataProducer:
         self.base_path = base_path
         self.config_manager = ConfigManager(base_path)
         self.config = self.config_manager.load_config(instance=self)
+        self.resolutions = None
+        self.offsets = None
+
+        # acquired -> pushed latency, summarized to data/metrics/producer.json for the /metrics endpoint
+        self.push_latency = LatencyHistogram()
+        self.chunks_pushed = 0
+        self.samples_pushed = 0
+        self.stats_interval = 10
+        self.last_stats_report = now()
+        self.stats_file_path = os.path.join(metrics_path(base_path), 'producer.json')
+
+    def load_edf_calibration(self, edf_file_path, channel_names):
+        # digital -> volts for each channel, as MNE applies it when reading the file
+        try:
+            header = read_edf_header(edf_file_path)
+            calibration = {}
+            for i, label in enumerate(header['labels']):
+                unit = EDF_UNITS.get(header['physical_dimensions'][i].lower())
+                if unit is None:
+                    continue
+                physical_min, physical_max = float(header['physical_min'][i]), float(header['physical_max'][i])
+                gain = (physical_max - physical_min) / (header['digital_max'][i] - header['digital_min'][i])
+                offset = physical_min - header['digital_min'][i] * gain
+                calibration[label] = (gain * unit, offset * unit)
+            if all(name in calibration for name in channel_names):
+                self.resolutions = [calibration[name][0] for name in channel_names]
+                self.offsets = [calibration[name][1] for name in channel_names]
+        except Exception as e:
+            self.logger.warning(f"Producer: Could not read EDF calibration, samples will be quantized at the default resolution: {e}")
 
     def load_edf_data(self):
         try:
             self.sim_input_file_path = Path(self.base_path) / "eeg.edf"
             self.logger.info(f"Producer: Attempting to read edf file at {self.sim_input_file_path}.")
+            import mne
             raw = mne.io.read_raw_edf(self.sim_input_file_path, preload=True)
             self.logger.info(f"Producer: Successfully read the EEG file at {self.sim_input_file_path}.")
             self.sample_rate = int(raw.info['sfreq'])
@@ -32,6 +71,7 @@ class DataProducer:
             self.channel_names = raw.info['ch_names']
             data, _ = raw[:, :]
             self.data = data.T
+            self.load_edf_calibration(self.sim_input_file_path, self.channel_names)
             self.logger.info(f"Producer: Loaded EDF file details:")
             self.logger.info(f"     Sample rate: {self.sample_rate} Hz")
             self.logger.info(f"     Number of channels: {self.n_channels}")
@@ -184,8 +224,12 @@ class DataProducer:
             stream_info = StreamInfo(lsl_stream_name, 'EEG', self.n_channels, self.sample_rate, 'float32', 'myuid1234')
             
             channels = stream_info.desc().append_child('channels')
-            for channel_name in self.channel_names:
-                channels.append_child('channel').append_child_value('label', channel_name)
+            for i, channel_name in enumerate(self.channel_names):
+                channel = channels.append_child('channel')
+                channel.append_child_value('label', channel_name)
+                if self.resolutions:
+                    channel.append_child_value('resolution', repr(self.resolutions[i]))
+                    channel.append_child_value('offset', repr(self.offsets[i]))
             self.stream_outlet = StreamOutlet(stream_info)
             self.logger.info(f"Producer: created LSL data stream outlet:\n"
                              f"  Stream name: {stream_info.name()}\n"
@@ -201,36 +245,64 @@ class DataProducer:
 
 
     def push_data_to_lsl(self, data):
+        # the chunk is stamped with the time it reached the producer, on the LSL clock; LSL applies it to the
+        # most recent sample and back-dates the others by the nominal rate
         try:
-            current_time = time.perf_counter()
-            self.stream_outlet.push_chunk(data, timestamp=current_time)
+            acquired = now()
+            self.stream_outlet.push_chunk(data, timestamp=acquired)
+            self.push_latency.add((now() - acquired) * 1000)
+            self.chunks_pushed += 1
+            self.samples_pushed += len(data)
+            if now() - self.last_stats_report >= self.stats_interval:
+                self.report_push_stats()
         except Exception as e:
             self.logger.error(f"Producer: Error pushing data to LSL: {e}", exc_info=True)
 
+    def report_push_stats(self):
+        try:
+            os.makedirs(os.path.dirname(self.stats_file_path), exist_ok=True)
+            write_metrics_file(self.stats_file_path, {
+                'updated': now(),
+                'mode': self.mode,
+                'chunks': self.chunks_pushed,
+                'samples': self.samples_pushed,
+                'acquired->pushed': self.push_latency.to_dict(),
+            })
+        except Exception as e:
+            self.logger.warning(f"Producer: Could not write push statistics: {e}")
+        self.last_stats_report = now()
+
+
+    def simulation_chunks(self, chunk_size=SIMULATION_CHUNK_SIZE):
+        # the EDF's samples [n_samples, n_channels] chunk by chunk, looping over the file without end
+        total_rows = len(self.data)
+        start_idx = 0
+        while True:
+            end_idx = start_idx + chunk_size
+            if end_idx > total_rows:
+                end_idx = end_idx % total_rows
+                yield np.concatenate((self.data[start_idx:], self.data[:end_idx]), axis=0)
+            else:
+                yield self.data[start_idx:end_idx]
+            start_idx = end_idx % total_rows
 
     def send_data_loop(self):
         if self.mode == "Simulator":
             self.logger.info("Producer: Simulation data loop started...")
-            chunk_size = 10
-            interval = chunk_size / self.sample_rate
-            chunk_length = int(self.sample_rate * interval)
-            total_rows = len(self.data)
+            interval = SIMULATION_CHUNK_SIZE / self.sample_rate
+            chunks = self.simulation_chunks(SIMULATION_CHUNK_SIZE)
+            # simulator_jitter_seconds delays each push by up to that much, without shifting the pushes after it
+            jitter_seconds = self.config.get('simulator_jitter_seconds', 0)
+            rng = np.random.default_rng()
+            delay = 0.0
             last_time = time.perf_counter()
-            start_idx = 0
             while True:
                 try:
                     current_time = time.perf_counter()
-                    if current_time - last_time >= interval:
-                        end_idx = start_idx + chunk_length
-                        if end_idx > total_rows:
-                            end_idx = end_idx % total_rows
-                            chunks = np.concatenate((self.data[start_idx:], self.data[:end_idx]), axis=0)
-                        else:
-                            chunks = self.data[start_idx:end_idx]
-                        flat_chunk = chunks.flatten().tolist()
-                        self.push_data_to_lsl([flat_chunk])
-                        last_time = current_time
-                        start_idx = end_idx % total_rows
+                    if current_time - last_time >= interval + delay:
+                        self.push_data_to_lsl(next(chunks).tolist())
+                        last_time = current_time - delay
+                        delay = rng.uniform(0, jitter_seconds) if jitter_seconds else 0.0
                     time.sleep(0.00001)
                 except Exception as e:
                     self.logger.error(f"Producer: Error in simulation data loop: {e}", exc_info=True)
@@ -253,7 +325,7 @@ class DataProducer:
                 try:
                     data = self.board.get_board_data()
                     if data.shape[1] > 0:
-                        self.stream_outlet.push_chunk(data.tolist())
+                        self.push_data_to_lsl(data.tolist())
                     time.sleep(0.000001)
                 except Exception as e:
                     self.logger.error(f"Producer: Error in OpenBCI data loop: {e}", exc_info=True)
@@ -272,7 +344,8 @@ class DataProducer:
             elif self.mode == "Brainvision":
                 self.logger.info("Producer: Attempting to connect to Brainvision amp...")
                 self.connect_brainvision_rda()
-                self.n_channels, self.sample_rate, resolutions, self.channelnames = self.get_amp_info()
+                self.n_channels, self.sample_rate, self.resolutions, self.channelnames = self.get_amp_info()
+                self.offsets = [0.0] * self.n_channels
             elif self.mode == "OpenBCI":
                 self.logger.info("Producer: Attempting to connect to OpenBCI board...")
                 self.setup_openbci()
@@ -1,5 +1,7 @@
+import os
 import time
-from pylsl import resolve_byprop, StreamInlet
+import numpy as np
+from pylsl import resolve_byprop, StreamInlet, proc_clocksync
 from peewee import *
 import json
 
@@ -8,7 +10,10 @@ import json
 #     from helpers import configure_logger, ConfigManager
 # except:
 from .database_handler import DatabaseHandler
+from .sample_codec import SampleCodec
+from .clock_model import ClockModel
 from .helpers import configure_logger, ConfigManager
+from .tracing import metrics_path, now, write_metrics_file
 
 
 class DataRecorder:
@@ -26,7 +31,15 @@ class DataRecorder:
 
         # connect to db
         self.db_handler = DatabaseHandler(base_path)
-        self.db = self.db_handler.setup_database(self.db_file_path, create_tables=False)
+        self.db = self.db_handler.setup_database(self.db_file_path, create_tables=False, role='writer',
+                                                 profile=self.config.get('storage_profile', 'wal'))
+        self.db_handler.start_checkpoint_scheduler()
+
+        # samples that reached the stream late, counted on the LSL timestamps before the clock model smooths
+        # them onto its fit; reported to data/metrics/recorder.json after every block
+        self.late_samples = 0
+        self.previous_timestamp = None
+        self.stats_file_path = os.path.join(metrics_path(base_path), 'recorder.json')
 
     def connect_to_lsl_stream(self):
         lsl_connection_attempts = 0
@@ -42,6 +55,9 @@ class DataRecorder:
                 ('type', 'EEG'),
                 (None, None)
             ]
+            # with several beds any other EEG stream belongs to another bed
+            if self.config.get('bed'):
+                properties = properties[:1]
 
             for prop, value in properties:
                 try:
@@ -73,7 +89,8 @@ class DataRecorder:
 
     def connect_to_stream(self, stream):
 
-        self.inlet = StreamInlet(stream)
+        # clock sync maps the sender's timestamps onto this machine's local_clock, the clock all trace stamps use
+        self.inlet = StreamInlet(stream, processing_flags=proc_clocksync)
         stream_info = self.inlet.info()
         stream_name = stream_info.name()
         stream_uid = stream_info.uid()
@@ -85,14 +102,108 @@ class DataRecorder:
         self.sample_rate = stream_info.nominal_srate()
         self.n_channels = stream_info.channel_count()
 
-        # Get the channel names from the description
+        # Get the channel names, and the amplifier resolution if the source provides it, from the description
         description = stream_info.desc()
         self.channel_names = []
+        resolutions, offsets = [], []
         channels = description.child('channels').first_child()
         for _ in range(stream_info.channel_count()):
             self.channel_names.append(channels.child_value('label'))
+            resolutions.append(channels.child_value('resolution'))
+            offsets.append(channels.child_value('offset'))
             channels = channels.next_sibling()
+        try:
+            self.resolutions = [float(r) for r in resolutions]
+            self.offsets = [float(o) if o else 0.0 for o in offsets]
+            self.logger.info(f"Recorder: stream provides channel resolutions: {self.resolutions}")
+        except ValueError:
+            self.resolutions, self.offsets = None, None
+
+    def build_codec(self):
+        # the source's own resolution makes the integer encoding lossless; otherwise quantize at sample_resolution
+        unit = 1e-6 if self.config.get('eeg_amp') == "customlsl" else 1
+        if self.resolutions:
+            scales = [r * unit for r in self.resolutions]
+            offsets = [o * unit for o in self.offsets]
+            lossless = True
+        else:
+            scales = [self.config.get('sample_resolution', 1e-8)] * self.n_channels
+            offsets = None
+            lossless = self.config.get('sample_codec_lossless', False)
+        return SampleCodec(
+            self.n_channels,
+            scales=scales,
+            offsets=offsets,
+            dtype=self.config.get('sample_codec', 'auto'),
+            delta=self.config.get('sample_codec_delta', True),
+            level=self.config.get('sample_codec_level', 6),
+            lossless=lossless
+        )
 
+    def build_clock_model(self):
+        # blocks store anchors of a fitted clock instead of a timestamp per sample; needs a regular sample rate
+        if not self.config.get('recorder_clock_model', True) or not self.sample_rate:
+            return None
+        return ClockModel(
+            self.sample_rate,
+            halflife_seconds=self.config.get('clock_halflife_seconds', 60),
+            gap_seconds=self.config.get('clock_gap_seconds', 0.1)
+        )
+
+    def write_info(self):
+        self.db_handler.create_info_entry(
+            recording_id=1,
+            sample_rate=self.sample_rate,
+            n_channels=self.n_channels,
+            start_time=self.start_time,
+            channel_names=json.dumps(self.channel_names),
+            codec=self.build_codec()
+        )
+
+    def write_block(self, samples, timestamps, sample_index, in_volt, pulled):
+        data = np.asarray(samples, dtype=np.float64).T
+        if in_volt:
+            data /= 1e6
+        # a block that fails to commit stays buffered and is written again later, so the clock fit and the late
+        # samples count go back to where they were before it
+        clock_state = dict(vars(self.clock_model)) if self.clock_model else None
+        late_state = self.late_samples, self.previous_timestamp
+        try:
+            self.count_late_samples(timestamps)
+            anchors = self.clock_model.fit_block(timestamps, sample_index) if self.clock_model else None
+            with self.db.atomic():
+                self.db_handler.create_data_block(data, timestamps, sample_index, pulled=pulled, anchors=anchors)
+        except Exception:
+            if self.clock_model:
+                vars(self.clock_model).update(clock_state)
+            self.late_samples, self.previous_timestamp = late_state
+            raise
+        self.report_stats(sample_index + len(timestamps))
+        return sample_index + len(timestamps)
+
+    def count_late_samples(self, timestamps):
+        # samples implied by gaps of more than one and a half sample periods between timestamps, i.e. samples
+        # that reached the stream later than the nominal rate or never arrived at all
+        if not self.sample_rate:
+            return
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        if self.previous_timestamp is not None:
+            timestamps = np.concatenate(([self.previous_timestamp], timestamps))
+        gaps = np.diff(timestamps) * self.sample_rate
+        self.late_samples += int(np.sum(np.rint(gaps[gaps > 1.5]) - 1))
+        self.previous_timestamp = timestamps[-1]
+
+    def report_stats(self, samples):
+        try:
+            os.makedirs(os.path.dirname(self.stats_file_path), exist_ok=True)
+            write_metrics_file(self.stats_file_path, {
+                'updated': now(),
+                'samples': samples,
+                'late_samples': self.late_samples,
+                'clock_segments': self.clock_model.n_segments if self.clock_model else None,
+            })
+        except Exception as e:
+            self.logger.warning(f"Recorder: Could not write recorder statistics: {e}")
 
     def receive_data_loop(self):
         self.logger.info("Recorder: Starting to receive data...")
@@ -105,30 +216,42 @@ class DataRecorder:
         else:
             in_volt = False
 
+        # samples are committed as one encoded block per block_seconds (or max_block_samples); a block that fails
+        # to commit stays buffered until it does, so the indices of the database hold no holes
+        block_seconds = self.config.get('recorder_block_seconds', 1.0)
+        max_block_samples = max(1, int(self.sample_rate * block_seconds)) if self.sample_rate else 1000
+        block_samples, block_timestamps = [], []
+        block_started = time.time()
+        self.clock_model = self.build_clock_model()
+        segments = 0
+
         while True:
-            with self.db.atomic():
-                counter = 0
-                while counter < 1000:
-                    try:
-                        chunk, timestamps = self.inlet.pull_chunk()
-                        if chunk:
-                            last_data_received_time = time.time()
-                            for sample, timestamp in zip(chunk, timestamps):
-
-                                if in_volt:
-                                    sample = [s / 1e6 for s in sample]
-
-                                self.db_handler.create_data_entry(sample, timestamp, sample_index)
-                                counter += 1
-                                sample_index += 1
-                        else:
-                            if time.time() - last_data_received_time > 5:
-                                self.logger.warning("Recorder: No data received for more than 5 seconds.")
-                                last_data_received_time = time.time()
-                    except Exception as e:
-                        self.logger.error(f"Recorder: Error receiving data: {e}", exc_info=True)
-                        time.sleep(1)
-            time.sleep(0.00001)
+            try:
+                chunk, timestamps = self.inlet.pull_chunk(timeout=0.05)
+                if chunk:
+                    last_data_received_time = time.time()
+                    last_pulled = now()
+                    if not block_samples:
+                        block_started = time.time()
+                    block_samples.extend(chunk)
+                    block_timestamps.extend(timestamps)
+                else:
+                    if time.time() - last_data_received_time > 5:
+                        self.logger.warning("Recorder: No data received for more than 5 seconds.")
+                        last_data_received_time = time.time()
+
+                while len(block_samples) >= max_block_samples:
+                    sample_index = self.write_block(block_samples[:max_block_samples], block_timestamps[:max_block_samples], sample_index, in_volt, last_pulled)
+                    del block_samples[:max_block_samples], block_timestamps[:max_block_samples]
+                if block_samples and time.time() - block_started >= block_seconds:
+                    sample_index = self.write_block(block_samples, block_timestamps, sample_index, in_volt, last_pulled)
+                    block_samples, block_timestamps = [], []
+                if self.clock_model and self.clock_model.n_segments > max(segments, 1):
+                    self.logger.warning(f"Recorder: timestamps jumped more than {self.clock_model.gap_seconds} s from the fitted clock, new clock segment at sample {self.clock_model.anchor_index}")
+                segments = self.clock_model.n_segments if self.clock_model else 0
+            except Exception as e:
+                self.logger.error(f"Recorder: Error receiving data: {e}", exc_info=True)
+                time.sleep(1)
 
     def shutdown(self):
         self.logger.info("Recorder: Shutting down...")
@@ -136,6 +259,7 @@ class DataRecorder:
             self.inlet.close_stream()
             self.logger.info("Recorder: LSL inlet closed")
         if hasattr(self, 'db'):
+            self.db_handler.stop_checkpoint_scheduler()
             self.db.close()
             self.logger.info("Recorder: Database connection closed")
         self.logger.info("Recorder: Shutdown.")
@@ -146,13 +270,7 @@ class DataRecorder:
             time.sleep(1)
             self.connect_to_lsl_stream()
             self.logger.info("Recorder: LSL inlet opened")
-            self.db_handler.create_info_entry(
-                recording_id=1,
-                sample_rate=self.sample_rate,
-                n_channels=self.n_channels,
-                start_time=self.start_time,
-                channel_names=json.dumps(self.channel_names)
-            )
+            self.write_info()
             self.receive_data_loop()
         except Exception as e:
             self.logger.error(f"Recorder: Error during run: {e}", exc_info=True)
@@ -8,15 +8,21 @@ import time
 from threading import Timer
 
 # try:
+#     from database_handler import DatabaseHandler
 #     from helpers import configure_logger, ConfigManager
+#     from tracing import LatencyHistogram, metrics_path, now, stage_latencies
 # except:
+from .database_handler import DatabaseHandler
 from .helpers import configure_logger, ConfigManager
+from .tracing import LatencyHistogram, metrics_path, now, stage_latencies
 
 
 class Visualizer:
     # Define desired fields as class-level constants
     STAGING_DESIRED_FIELDS = ['n1', 'n2', 'n3', 'rem', 'w']
     YASA_DESIRED_FIELDS = ['alpha_power', 'beta_power', 'theta_power', 'delta_power', 'gamma_power']
+    # points per channel at most in an /eeg response, longer ranges are decimated
+    EEG_MAX_POINTS = 2000
 
     def __init__(self, base_path, mode):
         self.base_path = base_path
@@ -41,6 +47,9 @@ class Visualizer:
         yasa_file_path = os.path.join(self.base_path, "data", "results", "yasa_results.txt")
         self.yasa_data_loader = DataLoader(yasa_file_path, self.YASA_DESIRED_FIELDS, base_path)
 
+        # read-only connection to the recording, opened by the first /eeg request
+        self.db_handler = None
+
     def setup_routes(self):
         @self.app.route('/')
         def home():
@@ -68,6 +77,65 @@ class Visualizer:
                 self.logger.error(f"Error in /data2 endpoint: {e}", exc_info=True)
                 return jsonify({'error': 'An error occurred'}), 500
 
+        @self.app.route('/eeg')
+        def eeg():
+            # /eeg?t0=...&t1=...&channels=C3,C4: samples stamped between t0 and t1, on the clock of the results' x
+            try:
+                t0, t1 = float(request.args['t0']), float(request.args['t1'])
+                channels = request.args['channels'].split(',') if request.args.get('channels') else None
+                return jsonify(self.eeg_range(t0, t1, channels))
+            except Exception as e:
+                self.logger.error(f"Error in /eeg endpoint: {e}", exc_info=True)
+                return jsonify({'error': 'An error occurred'}), 500
+
+        @self.app.route('/metrics')
+        def metrics():
+            try:
+                return jsonify(self.latency_metrics())
+            except Exception as e:
+                self.logger.error(f"Error in /metrics endpoint: {e}", exc_info=True)
+                return jsonify({'error': 'An error occurred'}), 500
+
+    def eeg_range(self, t0, t1, channels=None):
+        if self.db_handler is None:
+            db_handler = DatabaseHandler(self.base_path)
+            if db_handler.setup_database(self.db_file_path, create_tables=False, role='reader',
+                                         profile=self.config.get('storage_profile', 'wal')) is None:
+                return {'error': 'database not available'}
+            self.db_handler = db_handler
+        data, timestamps = self.db_handler.retrieve_time_range(t0, t1, channels)
+        if data is None:
+            return {'error': 'range not available'}
+        step = max(1, -(-len(timestamps) // self.EEG_MAX_POINTS))
+        channel_names = channels or json.loads(self.db_handler.retrieve_info().channel_names)
+        return {
+            'x': timestamps[::step].tolist(),
+            'channels': {name: (data[row, ::step] * 1e6).tolist() for row, name in enumerate(channel_names)},
+            'unit': 'uV',
+            'step': step,
+        }
+
+    def latency_metrics(self):
+        # per-stage latency histograms over all epochs so far, from the traces stored with the results
+        metrics = {'clock': now(), 'results': {}}
+        for name, data_loader in [('staging', self.staging_data_loader), ('yasa', self.yasa_data_loader)]:
+            histograms = {}
+            for trace in data_loader.load_traces():
+                for stages, latency in stage_latencies(trace).items():
+                    histograms.setdefault(stages, LatencyHistogram()).add(latency)
+            metrics['results'][name] = {stages: histogram.to_dict() for stages, histogram in histograms.items()}
+
+        producer_stats_path = os.path.join(metrics_path(self.base_path), 'producer.json')
+        if os.path.exists(producer_stats_path):
+            with open(producer_stats_path, 'r') as f:
+                metrics['producer'] = json.load(f)
+        for mode in ['yasa_analyzer', self.config.get('sleep_staging_model', 'YASA')]:
+            analyzer_stats_path = os.path.join(metrics_path(self.base_path), f'analyzer_{mode}.json')
+            if os.path.exists(analyzer_stats_path):
+                with open(analyzer_stats_path, 'r') as f:
+                    metrics.setdefault('analyzers', {})[mode] = json.load(f)
+        return metrics
+
     def run(self):
         try:
 
@@ -88,22 +156,43 @@ class DataLoader:
         self.data_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), data_file)
         self.desired_fields = desired_fields
         self.logger = configure_logger(base_path)
+        self.served = {}  # start_time -> when the result was first served to the GUI
 
     def load_data(self):
         data = {}
         try:
             with open(self.data_file, 'r') as file:
-                for line in file:
-                    entry = json.loads(line)
-                    x = entry['start_time']
-                    for field, value in entry.items():
-                        if field in self.desired_fields:
-                            if field not in data:
-                                data[field] = []
-                            data[field].append({'x': x, 'y': value})
+                entries = [json.loads(line) for line in file]
+            # backfilled epochs are written after later ones; the analyzer's latest budget decision is the last row's
+            if entries and 'budget' in entries[-1]:
+                data['budget'] = entries[-1]['budget']
+            for entry in sorted(entries, key=lambda entry: entry['start_time']):
+                x = entry['start_time']
+                self.served.setdefault(x, now())
+                for field, value in entry.items():
+                    if field in self.desired_fields:
+                        if field not in data:
+                            data[field] = []
+                        data[field].append({'x': x, 'y': value})
         except Exception as e:
             #self.logger.error(f"Error loading data from {self.data_file}: {e}", exc_info=True)
             # File does not exist, generate one minute of null data
             for field in self.desired_fields:
                 data[field] = [{'x': x, 'y': 0} for x in range(0, 60)]
-        return data
\ No newline at end of file
+        return data
+
+    def load_traces(self):
+        traces = []
+        if not os.path.exists(self.data_file):
+            return traces
+        with open(self.data_file, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # a line the analyzer is still writing
+                if 'trace' in entry:
+                    trace = dict(entry['trace'])
+                    trace['result_served'] = self.served.get(entry['start_time'])
+                    traces.append(trace)
+        return traces
@@ -1,20 +1,30 @@
 from peewee import *
 import zlib
-import struct
+import json
 import numpy as np
 import time
 import os
+import threading
+from pathlib import Path
 
 # try:
 #     from helpers import configure_logger
 # except:
 from .helpers import configure_logger
+from .sample_codec import SampleCodec
+from .clock_model import CLOCK_ANCHORS, anchor_timestamps, encode_anchors
+from .tracing import now
 
 # setup the database via peewee
+# each row holds a block of consecutive samples, encoded by the recording's SampleCodec
 class EEGData(Model):
-    index = IntegerField(primary_key=True)
-    time = DateTimeField()
+    index = IntegerField(primary_key=True)  # index of the first sample in the block
+    n_samples = IntegerField()
+    time = DoubleField(index=True)  # timestamp of the first sample in the block, indexed for lookups by time
     data = BlobField()
+    timestamps = BlobField()  # clock anchors (clock_model), or one timestamp per sample
+    pulled = DoubleField(null=True)  # local_clock when the recorder pulled the block's last sample
+    committed = DoubleField(null=True)  # local_clock when the block was written in its transaction
     class Meta:
         table_name = 'eeg_data'
 
@@ -24,41 +34,126 @@ class EEGInfo(Model):
     start_time   = DateTimeField()
     n_channels   = IntegerField()
     channel_names   = CharField()
+    codec = TextField(null=True)
     class Meta:
         table_name = 'eeg_info'
 
+def bind_models(db):
+    # copies of the models bound to one database, so that a process can keep several recordings open at once
+    class BoundEEGData(EEGData):
+        class Meta:
+            database = db
+            table_name = 'eeg_data'
+
+    class BoundEEGInfo(EEGInfo):
+        class Meta:
+            database = db
+            table_name = 'eeg_info'
+
+    return BoundEEGData, BoundEEGInfo
+
+# sqlite settings per storage profile and connection role. 'wal' lets the recorder commit while the
+# analyzers, archiver and GUI read; 'legacy' is the default rollback journal, kept for comparison.
+STORAGE_PROFILES = {
+    'legacy': {
+        'writer': {},
+        'reader': {},
+    },
+    'wal': {
+        'writer': {
+            'journal_mode': 'wal',
+            'synchronous': 'normal',
+            'cache_size': -64000,
+            'mmap_size': 256 * 1024 * 1024,
+            'temp_store': 'memory',
+            'wal_autocheckpoint': 0,  # checkpoints are run by the scheduler, not in the commit path
+        },
+        'reader': {
+            'cache_size': -32000,
+            'mmap_size': 256 * 1024 * 1024,
+            'query_only': 1,
+        },
+    },
+}
+
+
 class DatabaseHandler:
     def __init__(self, base_path):
         self.logger = configure_logger(base_path)
         self.logger.info('Database Handler: started...')
+        self.checkpoint_thread = None
+        self.checkpoint_stop = threading.Event()
+        self.codec = None
 
     def database_exists(self, db_file_path):
         return os.path.exists(db_file_path)  
 
     def get_total_n_samples(self):
         try:
-            total_samples = EEGData.select().count()
-            return total_samples
+            last_block = self.EEGData.select(self.EEGData.index, self.EEGData.n_samples).order_by(self.EEGData.index.desc()).limit(1).tuples().first()
+            return 0 if last_block is None else last_block[0] + last_block[1]
         except Exception as e:
             self.logger.error(f"Error in get_total_n_samples: {e}", exc_info=True)
             return None
 
     def get_most_recent_timestamp(self):
         try:
-            timestamp = EEGData.select(fn.MAX(EEGData.time)).scalar()
-            return timestamp
+            last_block = self.EEGData.select(self.EEGData.timestamps, self.EEGData.n_samples).order_by(self.EEGData.index.desc()).limit(1).tuples().first()
+            return None if last_block is None else float(self.decode_timestamps(*last_block)[-1])
         except Exception as e:
             self.logger.error(f"Error in get_most_recent_timestamp: {e}", exc_info=True)
             return None
 
     def get_sample_timestamp(self, sample_index):
         try:
-            timestamp = EEGData.select(EEGData.time).where(EEGData.index == sample_index).scalar()
-            return timestamp
+            block = self.find_block(sample_index)
+            if block is None or sample_index >= block.index + block.n_samples:
+                return None
+            return float(self.decode_timestamps(block.timestamps, block.n_samples)[sample_index - block.index])
         except Exception as e:
             self.logger.error(f"Error in get_sample_timestamp: {e}", exc_info=True)
             return None
 
+    def get_block_trace(self, sample_index):
+        try:
+            block = self.find_block(sample_index)
+            return {} if block is None else {'pulled': block.pulled, 'committed': block.committed}
+        except Exception as e:
+            self.logger.error(f"Error in get_block_trace: {e}", exc_info=True)
+            return {}
+
+    def find_block(self, sample_index):
+        # the block containing sample_index is the last one starting at or before it (primary key lookup)
+        return self.EEGData.select().where(self.EEGData.index <= sample_index).order_by(self.EEGData.index.desc()).limit(1).first()
+
+    def find_block_at_time(self, timestamp):
+        # the block containing timestamp is the last one starting at or before it (index on time); blocks are
+        # written in acquisition order, so time increases with the sample index
+        return self.EEGData.select().where(self.EEGData.time <= timestamp).order_by(self.EEGData.time.desc()).limit(1).first()
+
+    def time_range_to_samples(self, t0, t1):
+        # first and last sample index with t0 <= timestamp <= t1, two index lookups and a search in each end block
+        first_block = self.find_block_at_time(t0)
+        if first_block is None:
+            first_block = self.EEGData.select().order_by(self.EEGData.index).limit(1).first()
+        last_block = self.find_block_at_time(t1)
+        if first_block is None or last_block is None:
+            return None, None
+        start = first_block.index + int(np.searchsorted(self.decode_timestamps(first_block.timestamps, first_block.n_samples), t0, side='left'))
+        end = last_block.index + int(np.searchsorted(self.decode_timestamps(last_block.timestamps, last_block.n_samples), t1, side='right')) - 1
+        return (start, end) if end >= start else (None, None)
+
+    def get_codec(self):
+        if self.codec is None:
+            eeg_info = self.retrieve_info()
+            self.codec = SampleCodec.from_json(eeg_info.codec)
+        return self.codec
+
+    def decode_timestamps(self, blob, n_samples):
+        if blob[:len(CLOCK_ANCHORS)] == CLOCK_ANCHORS:
+            return anchor_timestamps(blob, n_samples)
+        return np.frombuffer(zlib.decompress(blob), dtype='<f8')
+
     def create_unique_db_filename(self, filepath):
         base, ext = os.path.splitext(filepath)
         for i in range(1, 100):
@@ -67,29 +162,67 @@ class DatabaseHandler:
                 return new_filepath
         raise ValueError("Cannot create a unique filename.")
 
-    def setup_database(self, db_file_path, create_tables):
+    def setup_database(self, db_file_path, create_tables, role='writer', profile='wal'):
         try:
-            self.db = SqliteDatabase(db_file_path)
-            EEGData._meta.database = self.db
-            EEGInfo._meta.database = self.db
+            pragmas = STORAGE_PROFILES[profile][role]
+            if role == 'reader':
+                read_only_uri = f"{Path(db_file_path).resolve().as_uri()}?mode=ro"
+                self.db = SqliteDatabase(read_only_uri, uri=True, pragmas=pragmas, timeout=10)
+            else:
+                self.db = SqliteDatabase(db_file_path, pragmas=pragmas, timeout=10)
+            self.db_file_path = db_file_path
+            self.EEGData, self.EEGInfo = bind_models(self.db)
             self.db.connect()
-            self.logger.info(f'Database Handler: db connected at {db_file_path}')
+            self.logger.info(f'Database Handler: db connected at {db_file_path} (profile: {profile}, role: {role})')
             if create_tables:
-                self.db.create_tables([EEGData, EEGInfo], safe=True)
+                self.db.create_tables([self.EEGData, self.EEGInfo], safe=True)
                 self.logger.info('Database Handler: new db tables created...')
             return self.db
         except Exception as e:
             self.logger.error(f"Error in setup_database: {e}", exc_info=True)
             return None
 
-    def create_info_entry(self, recording_id, sample_rate, n_channels, start_time, channel_names):
+    def start_checkpoint_scheduler(self, interval=5, truncate_above_bytes=64 * 1024 * 1024):
+        # passive checkpoints never wait for readers; the WAL is only truncated once it has grown large
+        if self.checkpoint_thread is not None or self.db.journal_mode != 'wal':
+            return
+        wal_file_path = f"{self.db_file_path}-wal"
+
+        def checkpoint_loop():
+            while not self.checkpoint_stop.wait(interval):
+                try:
+                    mode = 'PASSIVE'
+                    if os.path.exists(wal_file_path) and os.path.getsize(wal_file_path) > truncate_above_bytes:
+                        mode = 'TRUNCATE'
+                    busy, wal_pages, checkpointed_pages = self.db.execute_sql(f'PRAGMA wal_checkpoint({mode})').fetchone()
+                    if mode == 'TRUNCATE':
+                        self.logger.info(f'Database Handler: WAL truncated (busy: {busy}, pages: {wal_pages})')
+                except Exception as e:
+                    self.logger.error(f"Error in checkpoint scheduler: {e}", exc_info=True)
+            self.db.close()
+
+        self.checkpoint_stop.clear()
+        self.checkpoint_thread = threading.Thread(target=checkpoint_loop, name='wal_checkpoint', daemon=True)
+        self.checkpoint_thread.start()
+        self.logger.info(f'Database Handler: WAL checkpoint scheduler started (every {interval} s)')
+
+    def stop_checkpoint_scheduler(self):
+        if self.checkpoint_thread is None:
+            return
+        self.checkpoint_stop.set()
+        self.checkpoint_thread.join(timeout=10)
+        self.checkpoint_thread = None
+
+    def create_info_entry(self, recording_id, sample_rate, n_channels, start_time, channel_names, codec=None):
         try:
-            EEGInfo.create(
+            self.codec = codec or SampleCodec(n_channels)
+            self.EEGInfo.create(
                 recording_id=recording_id,
                 sample_rate=sample_rate,
                 n_channels=n_channels,
                 start_time=start_time,
-                channel_names=channel_names
+                channel_names=channel_names,
+                codec=self.codec.to_json()
             )
             self.logger.info("Database Handler: EEG amp info created:")
             self.logger.info(f"  Recording ID: {recording_id}")
@@ -97,20 +230,32 @@ class DatabaseHandler:
             self.logger.info(f"  Number of Channels: {n_channels}")
             self.logger.info(f"  Start Time: {start_time}")
             self.logger.info(f"  Channel Names: {channel_names}")
+            self.logger.info(f"  Codec: {self.codec.to_json()}")
         except Exception as e:
             self.logger.error(f"Error in create_info_entry: {e}", exc_info=True)
 
-    def create_data_entry(self, sample, timestamp, sample_index):
-        try:
-            sample_compressed = zlib.compress(struct.pack(f'{len(sample)}f', *sample))
-            EEGData.create(index=sample_index, time=timestamp, data=sample_compressed)
-        except Exception as e:
-            self.logger.error(f"Error in create_data_entry: {e}", exc_info=True)
+    def create_data_block(self, data, timestamps, start_index, pulled=None, anchors=None):
+        # data: [n_channels, n_samples]; with anchors from a ClockModel these are stored instead of the timestamps.
+        # Errors are raised: a lost block would leave a hole in index that retrieval concatenates straight across
+        if anchors is not None:
+            first_time, timestamps_blob = anchors[0][1], encode_anchors(anchors)
+        else:
+            timestamps = np.asarray(timestamps, dtype='<f8')
+            first_time, timestamps_blob = float(timestamps[0]), zlib.compress(timestamps.tobytes())
+        self.EEGData.create(
+            index=start_index,
+            n_samples=data.shape[1],
+            time=first_time,
+            data=self.get_codec().encode(data),
+            timestamps=timestamps_blob,
+            pulled=pulled,
+            committed=now()
+        )
 
     def retrieve_info(self, retries=100):
         for retry_count in range(retries):
             try:
-                eeginfo = EEGInfo.get()
+                eeginfo = self.EEGInfo.get()
                 return eeginfo
             except:
                 self.logger.error(f"Database Handler: Database not found. Attempt {retry_count + 1}/{retries}. Waiting 1 second before retrying...")
@@ -118,21 +263,57 @@ class DatabaseHandler:
         self.logger.error(f"Database Handler: Failed to retrieve EEGInfo after {retries} attempts. Aborting.", exc_info=True)
         return None
 
-    def retrieve_data(self, start, end):
+    def _retrieve_samples(self, start, end, dtype=np.float64):
+        codec = self.get_codec()
+        first_block = self.find_block(start)
+        first_index = start if first_block is None else first_block.index
+        rows = list(self.EEGData.select(self.EEGData.index, self.EEGData.data).where(
+            (self.EEGData.index >= first_index) & (self.EEGData.index <= end)
+        ).order_by(self.EEGData.index).tuples())
+        if not rows:
+            return np.empty((codec.n_channels, 0), dtype=dtype)
+        data = np.concatenate([codec.decode(blob, dtype) for _, blob in rows], axis=1)
+        data_start = rows[0][0]
+        return data[:, max(start - data_start, 0):end - data_start + 1]
+
+    def retrieve_data(self, start, end, dtype=np.float64):
         try:
-            selected_data = EEGData.select().where(
-                (EEGData.index >= start) & (EEGData.index <= end)
-            ).order_by(EEGData.index)
-            self.eeg_info = self.retrieve_info()
-            eeg_data = np.array([
-                struct.unpack(f'{self.eeg_info.n_channels}f', zlib.decompress(data.data))
-                for data in selected_data
-            ])
-            return eeg_data.T
+            return self._retrieve_samples(start, end, dtype)
         except Exception as e:
             self.logger.error(f"Error in retrieve_data: {e}", exc_info=True)
             return None
 
+    def retrieve_time_range(self, t0, t1, channels=None, dtype=np.float64):
+        # samples with t0 <= timestamp <= t1 as (data[n_channels, n_samples], timestamps[n_samples]), optionally
+        # only the channels named (or numbered) in channels
+        try:
+            start, end = self.time_range_to_samples(t0, t1)
+            codec = self.get_codec()
+            if start is None:
+                data, timestamps = np.empty((codec.n_channels, 0), dtype=dtype), np.empty(0)
+            else:
+                rows = list(self.EEGData.select(self.EEGData.index, self.EEGData.data, self.EEGData.timestamps, self.EEGData.n_samples).where(
+                    (self.EEGData.index >= self.find_block(start).index) & (self.EEGData.index <= end)
+                ).order_by(self.EEGData.index).tuples())
+                first = start - rows[0][0]
+                data = np.concatenate([codec.decode(blob, dtype) for _, blob, _, _ in rows], axis=1)[:, first:first + end - start + 1]
+                timestamps = np.concatenate([self.decode_timestamps(blob, n) for _, _, blob, n in rows])[first:first + end - start + 1]
+            if channels is not None:
+                channel_names = json.loads(self.retrieve_info().channel_names)
+                data = data[[channel_names.index(ch) if isinstance(ch, str) else ch for ch in channels]]
+            return data, timestamps
+        except Exception as e:
+            self.logger.error(f"Error in retrieve_time_range: {e}", exc_info=True)
+            return None, None
+
+    def iter_data_chunks(self, start, end, chunk_size):
+        # yields (chunk_start, data[n_channels, n_samples]) without holding more than one chunk in memory
+        for chunk_start in range(start, end + 1, chunk_size):
+            chunk_end = min(chunk_start + chunk_size - 1, end)
+            chunk = self._retrieve_samples(chunk_start, chunk_end)
+            if chunk.shape[1]:
+                yield chunk_start, chunk
+
     def find_next_epoch_indices(self, number_analyzed_epochs, epoch_length_seconds):
         try:
             eeg_info = self.retrieve_info()
@@ -140,7 +321,7 @@ class DatabaseHandler:
             start_sample_index = number_analyzed_epochs * samples_per_epoch
             end_sample_index = start_sample_index + samples_per_epoch - 1
             total_n_samples = self.get_total_n_samples()
-            if total_n_samples is not None and total_n_samples >= end_sample_index:
+            if total_n_samples is not None and total_n_samples > end_sample_index:
                 start_time = self.get_sample_timestamp(start_sample_index)
                 return start_sample_index, end_sample_index, start_time
             else:
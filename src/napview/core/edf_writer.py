@@ -0,0 +1,274 @@
+import os
+import json
+import math
+import numpy as np
+from datetime import datetime, timezone
+
+
+DIGITAL_MIN = -32768
+DIGITAL_MAX = 32767
+ANNOTATION_LABEL = 'EDF Annotations'
+ANNOTATION_SAMPLES = 32  # 64 bytes per record, enough for a time-keeping TAL
+
+
+def _format_field(value, width):
+    text = str(value)
+    if len(text) > width:
+        raise ValueError(f"EDF header value '{text}' does not fit in {width} characters.")
+    return text.ljust(width)
+
+
+def _format_physical(value, width=8, round_up=False):
+    # EDF stores physical limits as 8 ascii characters: round outwards so the range still covers the data
+    for decimals in range(6, -1, -1):
+        factor = 10 ** decimals
+        rounded = math.ceil(value * factor) / factor if round_up else math.floor(value * factor) / factor
+        text = f"{rounded:.{decimals}f}"
+        if len(text) <= width:
+            return text, rounded
+    raise ValueError(f"Physical value {value} cannot be represented in an EDF header.")
+
+
+class EDFWriter:
+    def __init__(self, file_path, channel_names, sample_rate, physical_min, physical_max,
+                 start_datetime=None, physical_dimension='uV', scale=1e6, edf_plus=True, record_duration=1):
+        if float(sample_rate * record_duration) != int(sample_rate * record_duration):
+            raise ValueError(f"Sample rate {sample_rate} Hz does not give whole samples per {record_duration} s record.")
+
+        self.file_path = file_path
+        self.channel_names = list(channel_names)
+        self.n_channels = len(self.channel_names)
+        self.sample_rate = sample_rate
+        self.record_duration = record_duration
+        self.samples_per_record = int(sample_rate * record_duration)
+        self.physical_dimension = physical_dimension
+        self.scale = scale
+        self.edf_plus = edf_plus
+        self.start_datetime = start_datetime or datetime.now(timezone.utc)
+        self.n_records = 0
+        self.file = None
+
+        physical_min = np.broadcast_to(np.asarray(physical_min, dtype=np.float64) * scale, (self.n_channels,))
+        physical_max = np.broadcast_to(np.asarray(physical_max, dtype=np.float64) * scale, (self.n_channels,))
+        self.physical_min_text, self.physical_max_text = [], []
+        for ch in range(self.n_channels):
+            low, high = physical_min[ch], physical_max[ch]
+            if not np.isfinite(low) or not np.isfinite(high):
+                low, high = -1.0, 1.0
+            if high <= low:
+                low, high = low - 1, high + 1
+            self.physical_min_text.append(_format_physical(low, round_up=False)[0])
+            self.physical_max_text.append(_format_physical(high, round_up=True)[0])
+        self._set_physical_range(self.physical_min_text, self.physical_max_text)
+
+        self.n_signals = self.n_channels + (1 if edf_plus else 0)
+        self.header_bytes = 256 * (self.n_signals + 1)
+        self.record_bytes = 2 * (self.n_channels * self.samples_per_record + (ANNOTATION_SAMPLES if edf_plus else 0))
+        self._pending = np.empty((self.n_channels, 0), dtype=np.int16)
+
+    def _set_physical_range(self, physical_min_text, physical_max_text):
+        self.physical_min_text = list(physical_min_text)
+        self.physical_max_text = list(physical_max_text)
+        self.physical_min = np.array([float(value) for value in self.physical_min_text])
+        self.physical_max = np.array([float(value) for value in self.physical_max_text])
+        # stored units -> digital: digital = stored * gain + offset
+        self.gain = (DIGITAL_MAX - DIGITAL_MIN) / (self.physical_max - self.physical_min) * self.scale
+        self.offset = DIGITAL_MIN - self.physical_min * (DIGITAL_MAX - DIGITAL_MIN) / (self.physical_max - self.physical_min)
+
+    @classmethod
+    def resume(cls, file_path, scale=1e6):
+        # reopen a file written by EDFWriter, dropping any incomplete trailing record
+        header = read_edf_header(file_path)
+        labels = header['labels']
+        edf_plus = labels[-1] == ANNOTATION_LABEL
+        n_channels = len(labels) - (1 if edf_plus else 0)
+        writer = cls(file_path, labels[:n_channels],
+                     header['samples_per_record'][0] / header['record_duration'],
+                     -1.0, 1.0, start_datetime=header['start_datetime'],
+                     physical_dimension=header['physical_dimensions'][0], scale=scale,
+                     edf_plus=edf_plus, record_duration=header['record_duration'])
+        writer._set_physical_range(header['physical_min'][:n_channels], header['physical_max'][:n_channels])
+        if writer.header_bytes != header['header_bytes']:
+            raise ValueError(f"{file_path} was not written by napview's EDF writer.")
+
+        n_records = (os.path.getsize(file_path) - writer.header_bytes) // writer.record_bytes
+        writer.file = open(file_path, 'r+b')
+        writer.file.truncate(writer.header_bytes + n_records * writer.record_bytes)
+        writer.file.seek(0, os.SEEK_END)
+        writer.n_records = n_records
+        return writer
+
+    @property
+    def n_samples_written(self):
+        return self.n_records * self.samples_per_record + self._pending.shape[1]
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        self.file = open(self.file_path, 'wb')
+        self.file.write(self._build_header(n_records=-1))
+
+    def _build_header(self, n_records):
+        start = self.start_datetime
+        if self.edf_plus:
+            patient_id = 'X X X X'
+            recording_id = f"Startdate {start.strftime('%d-%b-%Y').upper()} X X X"
+            reserved = 'EDF+C'
+        else:
+            patient_id, recording_id, reserved = '', '', ''
+
+        labels = self.channel_names + ([ANNOTATION_LABEL] if self.edf_plus else [])
+        dimensions = [self.physical_dimension] * self.n_channels + ([''] if self.edf_plus else [])
+        physical_mins = self.physical_min_text + (['-1'] if self.edf_plus else [])
+        physical_maxs = self.physical_max_text + (['1'] if self.edf_plus else [])
+        samples = [self.samples_per_record] * self.n_channels + ([ANNOTATION_SAMPLES] if self.edf_plus else [])
+
+        header = ''.join([
+            _format_field('0', 8),
+            _format_field(patient_id, 80),
+            _format_field(recording_id, 80),
+            _format_field(start.strftime('%d.%m.%y'), 8),
+            _format_field(start.strftime('%H.%M.%S'), 8),
+            _format_field(self.header_bytes, 8),
+            _format_field(reserved, 44),
+            _format_field(n_records, 8),
+            _format_field(self.record_duration, 8),
+            _format_field(self.n_signals, 4),
+        ])
+        header += ''.join(_format_field(label[:16], 16) for label in labels)
+        header += ''.join(_format_field('', 80) for _ in labels)
+        header += ''.join(_format_field(dimension, 8) for dimension in dimensions)
+        header += ''.join(_format_field(value, 8) for value in physical_mins)
+        header += ''.join(_format_field(value, 8) for value in physical_maxs)
+        header += ''.join(_format_field(DIGITAL_MIN, 8) for _ in labels)
+        header += ''.join(_format_field(DIGITAL_MAX, 8) for _ in labels)
+        header += ''.join(_format_field('', 80) for _ in labels)
+        header += ''.join(_format_field(n, 8) for n in samples)
+        header += ''.join(_format_field('', 32) for _ in labels)
+        return header.encode('ascii')
+
+    def to_digital(self, data):
+        digital = np.asarray(data, dtype=np.float64) * self.gain[:, np.newaxis] + self.offset[:, np.newaxis]
+        np.rint(digital, out=digital)
+        np.clip(digital, DIGITAL_MIN, DIGITAL_MAX, out=digital)
+        return digital.astype(np.int16)
+
+    def _annotation_block(self, first_record, n_records):
+        block = np.zeros((n_records, 2 * ANNOTATION_SAMPLES), dtype=np.uint8)
+        for i in range(n_records):
+            onset = (first_record + i) * self.record_duration
+            onset_text = f"{onset:.6f}".rstrip('0').rstrip('.')
+            tal = f"+{onset_text}\x14\x14\x00".encode('ascii')
+            block[i, :len(tal)] = np.frombuffer(tal, dtype=np.uint8)
+        return block
+
+    def _write_records(self, digital):
+        n_records = digital.shape[1] // self.samples_per_record
+        if n_records == 0:
+            return
+        records = digital[:, :n_records * self.samples_per_record]
+        records = records.reshape(self.n_channels, n_records, self.samples_per_record).transpose(1, 0, 2)
+        records = np.ascontiguousarray(records, dtype='<i2').reshape(n_records, -1).view(np.uint8)
+        if self.edf_plus:
+            records = np.concatenate([records, self._annotation_block(self.n_records, n_records)], axis=1)
+        self.file.write(records.tobytes())
+        self.n_records += n_records
+
+    def write_samples(self, data):
+        digital = self.to_digital(data)
+        if self._pending.shape[1]:
+            digital = np.concatenate([self._pending, digital], axis=1)
+        n_complete = (digital.shape[1] // self.samples_per_record) * self.samples_per_record
+        self._write_records(digital[:, :n_complete])
+        self._pending = digital[:, n_complete:].copy()
+
+    def update_header(self):
+        position = self.file.tell()
+        self.file.seek(0)
+        self.file.write(self._build_header(n_records=self.n_records))
+        self.file.seek(position)
+        self.file.flush()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self, pad=True):
+        if self.file is None:
+            return
+        if pad and self._pending.shape[1]:
+            # the digital value of physical zero (clipped to the digital range), not digital 0, which is the middle
+            # of the physical range and would leave a DC step at the end of the file
+            padding = np.repeat(self.to_digital(np.zeros((self.n_channels, 1))), self.samples_per_record - self._pending.shape[1], axis=1)
+            self._write_records(np.concatenate([self._pending, padding], axis=1))
+            self._pending = np.empty((self.n_channels, 0), dtype=np.int16)
+        self.update_header()
+        self.file.close()
+        self.file = None
+
+
+def read_edf_header(file_path):
+    with open(file_path, 'rb') as f:
+        fixed = f.read(256).decode('ascii')
+        n_signals = int(fixed[252:256])
+        signals = f.read(256 * n_signals).decode('ascii')
+
+    def fields(offset, width):
+        # per-signal fields are stored field by field, one column of n_signals entries each
+        start = offset * n_signals
+        return [signals[start + i * width:start + (i + 1) * width].strip() for i in range(n_signals)]
+
+    record_duration = float(fixed[244:252])
+    return {
+        'header_bytes': int(fixed[184:192]),
+        'reserved': fixed[192:236].strip(),
+        'n_records': int(fixed[236:244]),
+        'record_duration': int(record_duration) if record_duration.is_integer() else record_duration,
+        'start_datetime': datetime.strptime(fixed[168:184], '%d.%m.%y%H.%M.%S').replace(tzinfo=timezone.utc),
+        'labels': fields(0, 16),
+        'physical_dimensions': fields(96, 8),
+        'physical_min': fields(104, 8),
+        'physical_max': fields(112, 8),
+        'digital_min': [int(value) for value in fields(120, 8)],
+        'digital_max': [int(value) for value in fields(128, 8)],
+        'samples_per_record': [int(value) for value in fields(216, 8)],
+    }
+
+
+def export_database_to_edf(db_handler, edf_file_path, chunk_size=None, start_datetime=None, edf_plus=True, t0=None, t1=None):
+    # the whole recording, or with t0 and/or t1 only the samples stamped within them (found through the time index)
+    eeg_info = db_handler.retrieve_info()
+    if eeg_info is None:
+        raise ValueError("No EEG information found in the database.")
+
+    total_samples = db_handler.get_total_n_samples()
+    if total_samples is None or total_samples == 0:
+        raise ValueError("No EEG data found in the database.")
+    start, end = 0, total_samples - 1
+    if t0 is not None or t1 is not None:
+        start, end = db_handler.time_range_to_samples(-np.inf if t0 is None else t0, np.inf if t1 is None else t1)
+        if start is None:
+            raise ValueError(f"No EEG data found between {t0} and {t1}.")
+
+    channel_names = json.loads(eeg_info.channel_names)
+    chunk_size = chunk_size or eeg_info.sample_rate * 60
+
+    # first pass: per-channel physical range, one chunk in memory at a time
+    physical_min = np.full(eeg_info.n_channels, np.inf)
+    physical_max = np.full(eeg_info.n_channels, -np.inf)
+    for _, chunk in db_handler.iter_data_chunks(start, end, chunk_size):
+        np.minimum(physical_min, chunk.min(axis=1), out=physical_min)
+        np.maximum(physical_max, chunk.max(axis=1), out=physical_max)
+
+    # second pass: stream data records straight from the database chunks
+    writer = EDFWriter(edf_file_path, channel_names, eeg_info.sample_rate, physical_min, physical_max,
+                       start_datetime=start_datetime, edf_plus=edf_plus)
+    with writer:
+        for _, chunk in db_handler.iter_data_chunks(start, end, chunk_size):
+            writer.write_samples(chunk)
+    return {'n_samples': end - start + 1, 'n_records': writer.n_records, 'bytes': os.path.getsize(edf_file_path)}
@@ -1,19 +1,134 @@
 import os
+import time
+import atexit
 import logging
+import logging.handlers
 import json 
 from pathlib import Path
 import threading 
+import multiprocessing
+
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_REPEAT_INTERVAL = 10
+
+# one process writes napview_log.log: the first one to configure the logger, normally the backend.
+# Processes it launches get its queue through attach_log_queue() and only enqueue records
+log_queue = None
+log_listener = None
+
+
+class RepeatFilter(logging.Filter):
+    # an identical error is written at most once per interval, so an error in a hot loop costs neither disk
+    # nor a traceback; records below ERROR without a traceback always pass. Repeats are counted and written as
+    # one summary, stamped when it is written, once their interval has run out: at the next record of any
+    # message, or at flush() before the process or the log writer stops
+    def __init__(self, handler, interval=LOG_REPEAT_INTERVAL, max_messages=1000):
+        super().__init__()
+        self.handler = handler
+        self.interval = interval
+        self.max_messages = max_messages
+        self.messages = {}  # key -> when the message was last written
+        self.repeats = {}  # key -> (repeats suppressed since, the last of them)
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.levelno, record.pathname, record.lineno, record.getMessage())
+        with self.lock:
+            summaries = self.expired(record.created)
+            suppressed = False
+            if record.levelno >= logging.ERROR or record.exc_info:
+                last_written = self.messages.get(key)
+                suppressed = last_written is not None and record.created - last_written < self.interval
+                if suppressed:
+                    self.repeats[key] = (self.repeats.get(key, (0, None))[0] + 1, record)
+                else:
+                    if len(self.messages) >= self.max_messages:
+                        self.messages = {k: t for k, t in self.messages.items() if record.created - t < self.interval or k in self.repeats}
+                    self.messages[key] = record.created
+        for summary in summaries:
+            self.handler.emit(summary)
+        return not suppressed
+
+    def expired(self, now=None):
+        # summaries of the repeats whose interval has run out, of all of them without now; lock held
+        summaries = []
+        for key, (repeats, record) in list(self.repeats.items()):
+            last_written = self.messages[key]
+            if now is None or now - last_written >= self.interval:
+                del self.repeats[key]
+                message = f"{record.getMessage()} (repeated {repeats} times in the {record.created - last_written:.0f} s after it was written)"
+                summary = logging.makeLogRecord(dict(record.__dict__, msg=message, args=None, exc_info=None, exc_text=None))
+                summary.created = time.time()
+                summary.msecs = (summary.created - int(summary.created)) * 1000
+                summaries.append(summary)
+        return summaries
+
+    def flush(self):
+        with self.lock:
+            summaries = self.expired()
+        for summary in summaries:
+            self.handler.emit(summary)
+
+
+def flush_log_repeats():
+    # the repeat counts this process has not written yet
+    for handler in logging.getLogger('napview_logger').handlers:
+        for log_filter in handler.filters:
+            if isinstance(log_filter, RepeatFilter):
+                log_filter.flush()
+
+
+def close_log_queue():
+    # waits until the records this process put on the writer's queue are handed over; os._exit would drop them
+    if log_queue is not None and log_listener is None:
+        log_queue.close()
+        log_queue.join_thread()
+
+
+def attach_log_queue(queue):
+    global log_queue, log_listener
+    log_queue = queue
+    log_listener = None
+
+
+def get_log_queue(base_path):
+    # the queue of this process's log writer, for the processes it launches
+    configure_logger(base_path)
+    return log_queue
+
+
+def start_log_listener(base_path):
+    # size-based rotation is only safe with a single writer, which is why every other process goes through the queue
+    global log_queue, log_listener
+    base_path = Path(base_path) if not isinstance(base_path, Path) else base_path
+    base_path.mkdir(parents=True, exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(base_path / 'napview_log.log', mode='a',
+                                                   maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(processName)s - %(message)s')
+    handler.setFormatter(formatter)
+    log_queue = multiprocessing.Queue()
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    log_listener.start()
+    atexit.register(stop_log_listener)
+
+
+def stop_log_listener():
+    # the writer's own pending repeat counts are enqueued before the listener writes its last records
+    flush_log_repeats()
+    log_listener.stop()
+
 
 def configure_logger(base_path):
     logger = logging.getLogger('napview_logger')
     if not logger.handlers:  # Avoid adding multiple handlers
         try:
             logger.setLevel(logging.DEBUG)
-            base_path = Path(base_path) if not isinstance(base_path, Path) else base_path
-            base_path.mkdir(parents=True, exist_ok=True)
-            handler = logging.FileHandler(base_path / 'napview_log.log', mode='a')
-            formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(processName)s - %(message)s')
-            handler.setFormatter(formatter)
+            if log_queue is None:
+                start_log_listener(base_path)
+            # records are put on the queue and written by the listener thread, logging never waits for the disk
+            handler = logging.handlers.QueueHandler(log_queue)
+            handler.addFilter(RepeatFilter(handler))
             logger.addHandler(handler)
         except Exception as e:
             print(f"Error configuring logger: {e}")
@@ -21,47 +136,104 @@ def configure_logger(base_path):
 
 
 class ConfigManager:
+    # the config lives in memory; config.json is only read when another process has saved a newer version.
+    # The process that creates the config (with config_defaults) owns a version counter in shared memory,
+    # component processes receive it together with a snapshot of the config at launch, see share() and attach().
+    # A process can hold several configs (the analysis pool serves several beds), hence one state per config path
+    shared_states = {}
+
     def __init__(self, base_path, config_defaults=None):
         self.logger = logging.getLogger('napview_logger')
         self.config_path = os.path.join(base_path, "config.json")
         self.config_lock = threading.RLock()  # Add reentrant lock
+        self.config = {}
+        self.version = 0
+        self.shared_version = None
 
+        state = ConfigManager.shared_states.get(self.config_path)
         if config_defaults:
+            self.shared_version = multiprocessing.Value('Q', 0)
             self.config = config_defaults
             try:
                 self.save_config()
             except Exception as e:
                 self.logger.error(f"Error saving config during initialization: {e}", exc_info=True)
+            # ConfigManagers created later in this process for the same config share its version counter
+            ConfigManager.attach(self.share())
+        elif state is not None:
+            self.shared_version = state['version']
+            self.version = state['config_version']
+            self.config = dict(state['config'])
         else:
             try:
                 self.load_config()
             except Exception as e:
                 self.logger.error(f"Error loading config during initialization: {e}", exc_info=True)
 
+    def share(self):
+        # passed to a component process at launch, see attach()
+        with self.config_lock:
+            return {'config_path': self.config_path, 'config': dict(self.config),
+                    'config_version': self.version, 'version': self.shared_version}
+
+    @classmethod
+    def attach(cls, state):
+        # every ConfigManager created afterwards in this process for the same config starts from the snapshot
+        cls.shared_states[state['config_path']] = state
+
+    def is_current(self):
+        # without a shared version counter there is no notification of changes, so the file is always read
+        return self.shared_version is not None and self.shared_version.value == self.version
+
+    def reload(self):
+        if self.shared_version is not None:
+            self.version = self.shared_version.value
+        if os.path.exists(self.config_path):
+            with open(self.config_path, 'r') as config_file:
+                self.config = json.load(config_file)
+        else:
+            self.config = {}
+
     def load_config(self, instance=None):
         with self.config_lock:
             try:
-                if os.path.exists(self.config_path):
-                    with open(self.config_path, 'r') as config_file:
-                        self.config = json.load(config_file)
-                else:
-                    self.config = {}
+                if not self.is_current():
+                    self.reload()
+                config = dict(self.config)
                 if instance is not None:
-                    for key, value in self.config.items():
+                    for key, value in config.items():
                         setattr(instance, key, value)
-                    setattr(instance, 'config', self.config)
+                    setattr(instance, 'config', config)
             except Exception as e:
                 self.logger.error(f"Error loading config: {e}", exc_info=True)
                 self.config = {}
-            return self.config
+                config = {}
+            return config
 
-    def save_config(self, config_dict=None):
+    def get(self, key, default=None):
         with self.config_lock:
+            if not self.is_current():
+                self.load_config()
+            return self.config.get(key, default)
+
+    def save_config(self, config_dict=None):
+        # without the shared version counter a save would reach config.json but no running component
+        if self.shared_version is None:
+            raise RuntimeError(f"{self.config_path}: config saved by a ConfigManager without shared state; create it "
+                               f"with config defaults, or after ConfigManager.attach() in a component process")
+        with self.config_lock, self.shared_version.get_lock():
             try:
+                # changes saved by other processes since the last read are kept
+                if self.shared_version.value != self.version:
+                    self.reload()
                 if config_dict:
                     self.config.update(config_dict)
-                with open(self.config_path, 'w') as config_file:
+                # written next to the file and renamed, so that no reader ever sees a partly written config
+                temp_config_path = f"{self.config_path}.{os.getpid()}.tmp"
+                with open(temp_config_path, 'w') as config_file:
                     json.dump(self.config, config_file, indent=4)
+                os.replace(temp_config_path, self.config_path)
+                self.shared_version.value += 1
+                self.version = self.shared_version.value
             except Exception as e:
                 self.logger.error(f"Error saving config: {e}", exc_info=True)
-
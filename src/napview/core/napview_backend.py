@@ -5,9 +5,7 @@ import webbrowser
 from pathlib import Path
 import socket
 from http.server import HTTPServer, SimpleHTTPRequestHandler
-from usleep_api import USleepAPI
 import time
-import mne
 import shutil
 from datetime import datetime, timezone
 import threading
@@ -16,19 +14,18 @@ from email.policy import default
 
 
 # try:
-#     from data_producer import DataProducer
-#     from data_recorder import DataRecorder
-#     from data_analyzer import Analyzer
-#     from data_visualizer import Visualizer
+#     from beds import bed_path, setup_beds
+#     from components import run_pipeline_component
 #     from database_handler import DatabaseHandler
-#     from helpers import configure_logger, ConfigManager
+#     from helpers import configure_logger, get_log_queue, ConfigManager
 # except:
-from .data_producer import DataProducer
-from .data_recorder import DataRecorder
-from .data_analyzer import Analyzer
-from .data_visualizer import Visualizer
+from .beds import bed_path, setup_beds
+from .components import run_pipeline_component
+from .data_archiver import archive_file_path, finalize_archive
 from .database_handler import DatabaseHandler
-from .helpers import configure_logger, ConfigManager
+from .edf_writer import export_database_to_edf
+from .profiling import profiles_path
+from .helpers import configure_logger, get_log_queue, ConfigManager
 
 
 def load_config_defaults(base_path):
@@ -56,27 +53,53 @@ def load_config_defaults(base_path):
         'db_file_path': '',
         'board_type': 'Synthetic',
         'openbci_port': 'COM3',
-        "lsl_stream_name": 'napview_EEG_stream'
+        "lsl_stream_name": 'napview_EEG_stream',
+        'storage_profile': 'wal',
+        'edf_archive': False,
+        'edf_archive_physical_range': 5000,
+        'edf_archive_header_interval': 10,
+        'recorder_block_seconds': 1.0,
+        'simulator_jitter_seconds': 0,
+        'recorder_clock_model': True,
+        'clock_halflife_seconds': 60,
+        'clock_gap_seconds': 0.1,
+        'sample_codec': 'auto',
+        'sample_codec_delta': True,
+        'sample_codec_level': 6,
+        'sample_resolution': 1e-8,
+        # any of producer, recorder, analyzer1, analyzer2, visualizer, archiver; analyzer1 or analyzer2 profiles the
+        # analysis host (or the pool processes of beds), which runs both analyses; with beds, every bed's process
+        'profiling_roles': [],
+        'profiling_mode': 'sampler',
+        'profiling_write_interval': 60,
+        'profiling_sample_interval': 0.01,
+        'analyzer_warm_up_seconds': 120,
+        'bandpower_channels': [],
+        'analysis_host': True,
+        'beds': [],
+        'analysis_workers': None,
+        'spectral_cache_epochs': 40,
+        'spectral_cache_persist': False,
+        'compute_dtype': 'float64',
+        'analysis_results_history': 100,
+        'analysis_budget': True,
+        'analysis_lag_reduce_seconds': 60,
+        'analysis_lag_skip_seconds': 300,
+        'analysis_reduced_context_minutes': 5,
+        'analysis_max_attempts': 3
     }
 
 
 class ProcessManager:
     def __init__(self):
         self.processes = {}
+        self.beds = {}
 
-    @staticmethod
-    def run_pipeline_component(component_class, **kwargs):
-        component = component_class(**kwargs)
-        try:
-            component.run()
-        finally:
-            component.shutdown()
-
-    def start_process(self, role, component_class, **kwargs):
+    def start_process(self, role, component, **kwargs):
         if self.is_process_running(role):
             print(f"Process {role} is already running.")
             return
-        process = multiprocessing.Process(target=self.run_pipeline_component, args=(component_class,), kwargs=kwargs)
+        process = multiprocessing.Process(target=run_pipeline_component, args=(component, role), kwargs=kwargs, name=role)
         process.start()
         self.processes[role] = process
 
@@ -101,22 +124,52 @@ class ProcessManager:
     def any_process_running(self):
         return any(process.is_alive() for process in self.processes.values())
 
-    def launch_components(self, base_path, config_manager, components):
+    def launch_components(self, base_path, config_manager, components, bed=None):
         with config_manager.config_lock:
             config_manager.load_config(instance=self)
         component_map = {
-            'producer': (DataProducer, {'mode': self.config.get('eeg_amp', 'Simulator')}),
-            'recorder': (DataRecorder, {'mode': ''}),
-            'analyzer1': (Analyzer, {'mode': 'yasa_analyzer'}),
-            'analyzer2': (Analyzer, {'mode': self.config.get('sleep_staging_model', 'YASA')}),
-            'visualizer': (Visualizer, {'mode': ''})
+            'producer': ('producer', {'mode': self.config.get('eeg_amp', 'Simulator')}),
+            'recorder': ('recorder', {'mode': ''}),
+            'analyzer1': ('analyzer', {'mode': 'yasa_analyzer'}),
+            'analyzer2': ('analyzer', {'mode': self.config.get('sleep_staging_model', 'YASA')}),
+            'analyzer': ('analyzer', {'mode': 'host'}),
+            'visualizer': ('visualizer', {'mode': ''}),
+            'archiver': ('archiver', {'mode': ''})
         }
 
         for component in components:
             if component in component_map:
-                component_class, kwargs = component_map[component]
+                component_name, kwargs = component_map[component]
                 kwargs['base_path'] = base_path
-                self.start_process(component, component_class, **kwargs)
+                kwargs['config_states'] = [config_manager.share()]
+                kwargs['log_queue'] = get_log_queue(base_path)
+                self.start_process(f'{component}:{bed}' if bed else component, component_name, **kwargs)
+
+    def bed_roles(self, component):
+        # the processes of a component that runs once per bed
+        return [f'{component}:{name}' for name in self.beds]
+
+    def launch_beds(self, base_path, config_manager, components):
+        # producer, recorder, visualizer and archiver run once per bed. The analyses of all beds share a pool of
+        # at most one process per core (config 'analysis_workers'), each pool process serving its beds in turn
+        # launching the recorders starts a new session, with a new database per bed; producers launched on their
+        # own (/start_data_producer) keep recording into the current one
+        if not self.beds or 'recorder' in components:
+            self.beds = setup_beds(base_path, config_manager.load_config())
+        for name, bed_config_manager in self.beds.items():
+            self.launch_components(bed_path(base_path, name), bed_config_manager,
+                                   [component for component in components if component != 'analyzer'], bed=name)
+        if 'analyzer' in components:
+            names = list(self.beds)
+            n_workers = min(len(names), config_manager.load_config().get('analysis_workers') or os.cpu_count())
+            for worker in range(n_workers):
+                worker_beds = names[worker::n_workers]
+                self.start_process(f'analyzer_pool{worker}', 'analyzer',
+                                   mode='pool',
+                                   base_path=base_path,
+                                   bed_paths=[bed_path(base_path, name) for name in worker_beds],
+                                   config_states=[config_manager.share()] + [self.beds[name].share() for name in worker_beds],
+                                   log_queue=get_log_queue(base_path))
 
 
 class NapviewRequestHandler(SimpleHTTPRequestHandler):
@@ -170,9 +223,15 @@ class NapviewRequestHandler(SimpleHTTPRequestHandler):
                     response = {'status': 'error', 'message': 'A process is already running'}
                     ready = False
 
+                # with config 'beds' every component except the analysis pool runs once per bed
+                if self.config.get('beds'):
+                    launch = self.process_manager.launch_beds
+                else:
+                    launch = self.process_manager.launch_components
+
                 if ready:
                     try:
-                        self.process_manager.launch_components(self.base_path, self.config_manager, ['producer', 'recorder'])
+                        launch(self.base_path, self.config_manager, ['producer', 'recorder'])
                         response = {'status': 'success', 'message': 'Producer and recorder started'}
                     except Exception as e:
                         self.logger.error(f"GUI: Connection failed: {e}", exc_info=True)
@@ -180,21 +239,37 @@ class NapviewRequestHandler(SimpleHTTPRequestHandler):
                         response = {'status': 'error', 'message': f'Connection failed: {str(e)}'}
                         ready = False
                 if ready:
-                    self.process_manager.launch_components(self.base_path, self.config_manager, ['analyzer1', 'analyzer2', 'visualizer'])
+                    if self.config.get('analysis_host', True) or self.config.get('beds'):
+                        components = ['analyzer', 'visualizer']
+                    else:
+                        components = ['analyzer1', 'analyzer2', 'visualizer']
+                    if self.config.get('edf_archive', False):
+                        components.append('archiver')
+                    launch(self.base_path, self.config_manager, components)
 
             elif self.path == '/check_eeg_file':
                 self.validate_eeg_file()
                 response = {'status': 'eeg file checked'}
 
             elif self.path == '/start_data_producer':
-                if not self.process_manager.is_process_running('producer'):
-                    self.process_manager.launch_components(self.base_path, self.config_manager, ['producer'])
+                # with config 'beds' one producer per bed, as /start launches them
+                if self.config_manager.load_config().get('beds'):
+                    roles, launch = self.process_manager.bed_roles('producer'), self.process_manager.launch_beds
+                else:
+                    roles, launch = ['producer'], self.process_manager.launch_components
+                if not any(self.process_manager.is_process_running(role) for role in roles):
+                    launch(self.base_path, self.config_manager, ['producer'])
                     response = {'status': 'Data producer started'}
                 else:
                     response = {'status': 'Data producer already running'}
 
             elif self.path == '/stop_data_producer':
-                self.process_manager.stop_process('producer')
+                if self.config_manager.load_config().get('beds'):
+                    roles = self.process_manager.bed_roles('producer')
+                else:
+                    roles = ['producer']
+                for role in roles:
+                    self.process_manager.stop_process(role)
 
                 with self.config_manager.config_lock:
                     self.config = self.config_manager.load_config(instance=self)
@@ -211,12 +286,19 @@ class NapviewRequestHandler(SimpleHTTPRequestHandler):
                 os.makedirs(output_directory, exist_ok=True)
                 messages = []
 
-                eeg_result = self.save_eeg_data_as_edf(self.config.get('db_file_path'), output_directory, timestamp)
-                messages.append(eeg_result['message'])
+                # with beds the recordings are in the beds' databases and the main database stays empty
+                if self.config.get('beds'):
+                    eeg_result = self.save_beds(output_directory, timestamp)
+                    messages.extend(eeg_result['messages'])
+                else:
+                    eeg_result = self.save_eeg_data_as_edf(self.config.get('db_file_path'), output_directory, timestamp)
+                    messages.append(eeg_result['message'])
 
                 results_result = self.save_results_files(output_directory, timestamp)
                 messages.extend(results_result['messages'])
 
+                messages.extend(self.save_profiles(output_directory))
+
                 if eeg_result['success'] and results_result['success']:
                     response_status = 'success'
                     messages.append(f"Files were saved in: {output_directory}")
@@ -229,7 +311,7 @@ class NapviewRequestHandler(SimpleHTTPRequestHandler):
                 response = {'status': response_status, 'messages': messages}
 
                 data_path = os.path.join(self.base_path, "data")
-                directories_to_clean = ['db', 'edfs', 'results']
+                directories_to_clean = ['db', 'edfs', 'results', 'metrics', 'checkpoints']
                 for dirname in directories_to_clean:
                     dirpath = os.path.join(data_path, dirname)
                     for root, dirs, files in os.walk(dirpath):
@@ -257,6 +339,22 @@ class NapviewRequestHandler(SimpleHTTPRequestHandler):
                 response = {'status': 'Configuration updated'}
 
 
+            elif self.path == '/export_range':
+                # an EDF of the samples stamped between t0 and t1 (seconds, the clock of the results' start_time)
+                content_length = int(self.headers['Content-Length'])
+                time_range = json.loads(self.rfile.read(content_length).decode('utf-8'))
+                timestamp = time.strftime('%Y%m%d_%H%M%S')
+                output_directory = os.path.join(self.base_path, 'output', timestamp)
+                os.makedirs(output_directory, exist_ok=True)
+                edf_file_path = os.path.join(output_directory, f'excerpt_{timestamp}.edf')
+                try:
+                    export_stats = export_database_to_edf(self.db_handler, edf_file_path, start_datetime=datetime.now(timezone.utc),
+                                                          t0=time_range.get('t0'), t1=time_range.get('t1'))
+                    self.logger.info(f"GUI: excerpt saved to {edf_file_path} ({export_stats['n_samples']} samples)")
+                    response = {'status': 'success', 'message': f"Excerpt saved to {edf_file_path}", 'n_samples': export_stats['n_samples']}
+                except ValueError as ve:
+                    response = {'status': 'error', 'message': str(ve)}
+
             elif self.path == '/upload_eeg_file':
                 content_type = self.headers.get('Content-Type')
                 if content_type and 'multipart/form-data' in content_type:
@@ -318,6 +416,7 @@ class NapviewRequestHandler(SimpleHTTPRequestHandler):
         self.logger.info("Shutdown: Server shut down successfully.")
 
     def validate_usleep_token(self):
+        from usleep_api import USleepAPI
         try:
             self.config = self.config_manager.load_config(instance=self)
             USleepAPI(api_token=self.config['api_token'])
@@ -332,6 +431,7 @@ class NapviewRequestHandler(SimpleHTTPRequestHandler):
         return token_valid
 
     def validate_eeg_file(self):
+        import mne
         try:
             self.config = self.config_manager.load_config(instance=self)
             filename = self.config.get('sim_input_file_path', 'eeg.edf')
@@ -350,32 +450,22 @@ class NapviewRequestHandler(SimpleHTTPRequestHandler):
     def save_eeg_data_as_edf(self, db_file_path, output_directory, timestamp):
         result = {'success': True, 'message': ''}
         try:
-            eeg_info = self.db_handler.retrieve_info()
-            if eeg_info is None:
-                raise ValueError("No EEG information found in the database.")
-
-            total_samples = self.db_handler.get_total_n_samples()
-            if total_samples is None or total_samples == 0:
-                raise ValueError("No EEG data found in the database.")
-
-            end_sample_index = total_samples - 1
-            eeg_data = self.db_handler.retrieve_data(0, end_sample_index)
-            if eeg_data is None:
-                raise ValueError("Failed to retrieve EEG data.")
-
-            channel_names = json.loads(eeg_info.channel_names)
-
-            info = mne.create_info(
-                ch_names=channel_names,
-                sfreq=eeg_info.sample_rate,
-                ch_types=['eeg'] * eeg_info.n_channels
-            )
-            raw = mne.io.RawArray(eeg_data, info)
-            raw.set_meas_date(datetime.now(timezone.utc))
-
             edf_file_path = os.path.join(output_directory, f'recording_{timestamp}.edf')
-            mne.export.export_raw(edf_file_path, raw, fmt='edf', overwrite=True)
-            self.logger.info(f"Shutdown: EEG data saved to {edf_file_path}")
+            export_start = time.perf_counter()
+            archive_path = archive_file_path(self.base_path, db_file_path)
+            export_stats = None
+            if os.path.exists(archive_path):
+                try:
+                    export_stats = finalize_archive(self.db_handler, archive_path)
+                    shutil.move(archive_path, edf_file_path)
+                    self.logger.info(f"Shutdown: finalized EDF archive, appended {export_stats['appended_samples']} samples")
+                except Exception as e:
+                    self.logger.error(f"Shutdown: Failed to finalize EDF archive {archive_path}, exporting from database instead: {e}", exc_info=True)
+                    export_stats = None
+            if export_stats is None:
+                export_stats = export_database_to_edf(self.db_handler, edf_file_path, start_datetime=datetime.now(timezone.utc))
+            self.logger.info(f"Shutdown: EEG data saved to {edf_file_path} ({export_stats['n_samples']} samples, "
+                             f"{export_stats['n_records']} records, {time.perf_counter() - export_start:.1f} s)")
             result['message'] = f"EEG data saved to {edf_file_path}"
 
         except ValueError as ve:
@@ -389,6 +479,51 @@ class NapviewRequestHandler(SimpleHTTPRequestHandler):
 
         return result
 
+    def save_beds(self, output_directory, timestamp):
+        # recording and results of every bed, in a directory per bed
+        result = {'success': bool(self.process_manager.beds), 'messages': []}
+        for name, bed_config_manager in self.process_manager.beds.items():
+            bed_output_directory = os.path.join(output_directory, name)
+            os.makedirs(bed_output_directory, exist_ok=True)
+            try:
+                bed_config = bed_config_manager.load_config()
+                db_handler = DatabaseHandler(bed_config['base_path'])
+                db_handler.setup_database(bed_config['db_file_path'], create_tables=False, role='reader',
+                                          profile=bed_config.get('storage_profile', 'wal'))
+                export_database_to_edf(db_handler, os.path.join(bed_output_directory, f'recording_{timestamp}.edf'),
+                                       start_datetime=datetime.now(timezone.utc))
+                db_handler.db.close()
+                results_path = os.path.join(bed_config['base_path'], 'data', 'results')
+                for file in os.listdir(results_path):
+                    shutil.copy2(os.path.join(results_path, file), os.path.join(bed_output_directory, f'{name}_{file}'))
+                # the profiles of the bed's own processes (config 'profiling_roles')
+                bed_profiles_path = profiles_path(bed_config['base_path'])
+                if os.path.isdir(bed_profiles_path) and os.listdir(bed_profiles_path):
+                    shutil.copytree(bed_profiles_path, os.path.join(bed_output_directory, 'profiles'))
+                result['messages'].append(f"Bed {name} saved to {bed_output_directory}")
+            except Exception as e:
+                self.logger.error(f"Shutdown: Failed to save bed {name}: {e}", exc_info=True)
+                result['success'] = False
+                result['messages'].append(f"An error occurred while saving bed {name}.")
+        return result
+
+    def save_profiles(self, output_directory):
+        # profiles of earlier sessions that never reached shutdown are kept, and saved with this one
+        messages = []
+        source_directory = profiles_path(self.base_path)
+        if not os.path.isdir(source_directory) or not os.listdir(source_directory):
+            return messages
+        try:
+            destination_directory = os.path.join(output_directory, 'profiles')
+            os.makedirs(destination_directory, exist_ok=True)
+            for file_name in os.listdir(source_directory):
+                shutil.move(os.path.join(source_directory, file_name), os.path.join(destination_directory, file_name))
+            self.logger.info(f"Shutdown: Moved component profiles to {destination_directory}")
+            messages.append(f"Profiles saved to {destination_directory}")
+        except Exception as e:
+            self.logger.error(f"Shutdown: Failed to save profiles: {e}", exc_info=True)
+        return messages
+
     def save_results_files(self, output_directory, timestamp):
         result = {'success': True, 'messages': []}
         try:
@@ -414,6 +549,10 @@ class NapviewRequestHandler(SimpleHTTPRequestHandler):
                 self.logger.warning(warning_msg)
                 result['messages'].append(warning_msg)
 
+            producer_stats_file = os.path.join(self.base_path, 'data', 'metrics', 'producer.json')
+            if os.path.exists(producer_stats_file):
+                shutil.copy2(producer_stats_file, os.path.join(output_directory, f'producer_metrics_{timestamp}.json'))
+
         except Exception as e:
             self.logger.error(f"Shutdown: Unexpected error while saving results files: {e}", exc_info=True)
             result['success'] = False
@@ -453,13 +592,16 @@ def main():
         os.makedirs(os.path.join(data_path, "results"), exist_ok=True)
         os.makedirs(os.path.join(data_path, "edfs"), exist_ok=True)
         os.makedirs(os.path.join(data_path, "output"), exist_ok=True)
+        os.makedirs(os.path.join(data_path, "archive"), exist_ok=True)
+        os.makedirs(os.path.join(data_path, "metrics"), exist_ok=True)
+        os.makedirs(os.path.join(data_path, "profiles"), exist_ok=True)
         logger.info(f'Data directories created in {base_path}')
     except Exception as e:
         logger.error(f'Failed to create data directories in {base_path} : {str(e)}', exc_info=True)
 
     data_path = os.path.join(base_path, "data")
     for root, dirs, files in os.walk(data_path):
-        if root == os.path.join(data_path, "db"):
+        if root in (os.path.join(data_path, "db"), os.path.join(data_path, "archive"), profiles_path(base_path)):
             continue
         for file in files:
             file_path = os.path.join(root, file)
@@ -506,7 +648,8 @@ def main():
 
     db_handler = DatabaseHandler(base_path)
     db_file_path = db_handler.create_unique_db_filename(f"{base_path}/data/db/eeg_data.db")
-    db_handler.setup_database(db_file_path, create_tables=True)
+    db_handler.setup_database(db_file_path, create_tables=True, role='writer',
+                              profile=config_manager.config.get('storage_profile', 'wal'))
     config_manager.save_config({'db_file_path': db_file_path})
 
     root_dir = Path(__file__).resolve().parent
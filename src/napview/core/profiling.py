@@ -0,0 +1,142 @@
+import os
+import sys
+import time
+import marshal
+import cProfile
+import threading
+from collections import Counter
+
+# try:
+#     from helpers import configure_logger, ConfigManager
+# except:
+from .helpers import configure_logger, ConfigManager
+
+
+def profiles_path(base_path):
+    return os.path.join(base_path, "data", "profiles")
+
+
+class CProfileProfiler:
+    # deterministic profile of the component's main thread, readable with pstats / snakeviz
+    extension = 'prof'
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+
+    def start(self):
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+
+    def write(self, file_path):
+        # snapshot_stats reads the counters without disabling the profiler
+        self.profiler.snapshot_stats()
+        with open(file_path, 'wb') as f:
+            marshal.dump(self.profiler.stats, f)
+
+
+class StackSampler:
+    # samples the main thread's stack every interval seconds; written as folded stacks
+    # ("outer;inner;leaf count"), the input format of flamegraph.pl and speedscope
+    extension = 'folded'
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.thread_id = threading.main_thread().ident
+        self.stacks = Counter()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        if stack:
+            with self.lock:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def sample_loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.sample_loop, name='stack_sampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+
+    def write(self, file_path):
+        with self.lock:
+            lines = [f"{stack} {count}\n" for stack, count in self.stacks.most_common()]
+        with open(file_path, 'w') as f:
+            f.writelines(lines)
+
+
+class ComponentProfiler:
+    def __init__(self, role, base_path, mode='sampler', write_interval=60, sample_interval=0.01):
+        self.role = role
+        self.logger = configure_logger(base_path)
+        self.profiler = CProfileProfiler() if mode == 'cprofile' else StackSampler(sample_interval)
+        self.write_interval = write_interval
+        os.makedirs(profiles_path(base_path), exist_ok=True)
+        session = time.strftime('%Y%m%d_%H%M%S')
+        self.file_path = os.path.join(profiles_path(base_path), f"{role}_{session}.{self.profiler.extension}")
+        self.stop_event = threading.Event()
+        self.writer_thread = None
+
+    def write(self):
+        # written next to the file and renamed, so an interrupted write never leaves a broken profile
+        try:
+            self.profiler.write(f"{self.file_path}.tmp")
+            os.replace(f"{self.file_path}.tmp", self.file_path)
+        except Exception as e:
+            self.logger.error(f"Profiler: {self.role}: failed to write {self.file_path}: {e}", exc_info=True)
+
+    def write_loop(self):
+        while not self.stop_event.wait(self.write_interval):
+            self.write()
+
+    def start(self):
+        self.profiler.start()
+        self.writer_thread = threading.Thread(target=self.write_loop, name='profile_writer', daemon=True)
+        self.writer_thread.start()
+        self.logger.info(f"Profiler: {self.role}: profiling to {self.file_path}")
+
+    def stop(self):
+        self.stop_event.set()
+        self.profiler.stop()
+        self.write()
+        self.logger.info(f"Profiler: {self.role}: profile written to {self.file_path}")
+
+
+def profiling_role_names(role):
+    # the names config 'profiling_roles' selects a process by: its role without the bed ('producer:bed1' is a
+    # producer), and analyzer1 and analyzer2 for the analysis host and the pool processes of beds, which run both
+    role = role.split(':')[0]
+    if role == 'analyzer' or role.startswith('analyzer_pool'):
+        return {role, 'analyzer', 'analyzer1', 'analyzer2'}
+    return {role}
+
+
+def start_component_profiler(role, base_path):
+    # returns a running profiler when config 'profiling_roles' names this role, otherwise None
+    config = ConfigManager(base_path).load_config()
+    if not profiling_role_names(role) & set(config.get('profiling_roles', [])):
+        return None
+    profiler = ComponentProfiler(
+        role.replace(':', '_'),
+        base_path,
+        mode=config.get('profiling_mode', 'sampler'),
+        write_interval=config.get('profiling_write_interval', 60),
+        sample_interval=config.get('profiling_sample_interval', 0.01)
+    )
+    profiler.start()
+    return profiler
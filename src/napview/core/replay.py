@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+# try:
+#     import tracing
+#     from data_analyzer import Analyzer
+#     from data_producer import DataProducer, SIMULATION_CHUNK_SIZE
+#     from data_recorder import DataRecorder
+#     from database_handler import DatabaseHandler
+#     from helpers import ConfigManager
+#     from napview_backend import load_config_defaults
+# except:
+from . import tracing
+from .data_analyzer import Analyzer
+from .data_producer import DataProducer, SIMULATION_CHUNK_SIZE
+from .data_recorder import DataRecorder
+from .database_handler import DatabaseHandler
+from .helpers import ConfigManager
+from .napview_backend import load_config_defaults
+
+
+RESULT_FILES = ['yasa_results.txt', 'staging_results.txt']
+
+
+class VirtualClock:
+    # the replayed recording's time in seconds, set by the harness as samples are produced instead of passing
+    # on its own; stands in for pylsl.local_clock in tracing.now() while a replay runs
+    def __init__(self, start_time=0.0):
+        self.time = start_time
+
+    def __call__(self):
+        return self.time
+
+
+class Replay:
+    # producer, recorder and analyzers of a Simulator session in one process and on a virtual clock: the EDF is
+    # chunked as the producer chunks it, stored block by block through the recorder's write_block, and every
+    # epoch is analyzed as soon as the recording holds it. There is no LSL, no sleeping and no polling, so an
+    # hour of recording takes as long as its analyses take, and the results files receive the rows a live run
+    # of the same file and config writes, with stage stamps and timestamps on the virtual clock
+    def __init__(self, edf_file_path, base_path=None, config=None, start_time=0.0):
+        self.base_path = base_path or tempfile.mkdtemp(prefix='napview_replay_')
+        self.clock = VirtualClock(start_time)
+        self.start_time = start_time
+        self.config = self.prepare_base_path(edf_file_path, config or {})
+
+        self.producer = DataProducer(self.base_path, 'Simulator')
+        self.producer.load_edf_data()
+        self.recorder = DataRecorder(self.base_path, 'Simulator')
+        # what connect_to_stream reads from the stream info of the producer's outlet
+        self.recorder.sample_rate = self.producer.sample_rate
+        self.recorder.n_channels = self.producer.n_channels
+        self.recorder.channel_names = self.producer.channel_names
+        self.recorder.resolutions = self.producer.resolutions
+        self.recorder.offsets = self.producer.offsets
+        self.recorder.start_time = start_time
+        self.recorder.clock_model = self.recorder.build_clock_model()
+        self.recorder.write_info()
+        # the chunks the producer's send_data_loop pushes
+        self.chunks = self.producer.simulation_chunks(SIMULATION_CHUNK_SIZE)
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='analysis')
+        self.analyzers = None
+        self.samples_produced = 0
+        self.sample_index = 0
+        self.epoch_seconds = []
+
+    def prepare_base_path(self, edf_file_path, config):
+        db_file_path = os.path.join(self.base_path, 'data', 'db', 'eeg_data.db')
+        if os.path.exists(db_file_path):
+            raise ValueError(f"{self.base_path} already holds a recording, replays need a base path of their own")
+        for dirname in ['db', 'results', 'edfs']:
+            os.makedirs(os.path.join(self.base_path, 'data', dirname), exist_ok=True)
+        edf_target_path = os.path.join(self.base_path, 'eeg.edf')
+        if os.path.abspath(edf_file_path) != os.path.abspath(edf_target_path):
+            shutil.copyfile(edf_file_path, edf_target_path)
+        session_config = load_config_defaults(self.base_path)
+        session_config.update(config)
+        session_config.update({'base_path': self.base_path, 'eeg_amp': 'Simulator', 'db_file_path': db_file_path})
+        # every component created in this process starts from this config, as launched components do
+        ConfigManager.attach(ConfigManager(self.base_path, session_config).share())
+        db_handler = DatabaseHandler(self.base_path)
+        db_handler.setup_database(db_file_path, create_tables=True, role='writer', profile=session_config.get('storage_profile', 'wal'))
+        db_handler.db.close()
+        return session_config
+
+    def start_analyzers(self):
+        # the analysis host by default, or the two analyzers of a session without it
+        if self.config.get('analysis_host', True):
+            host = Analyzer(self.base_path, 'host')
+            host.start_host(self.executor)
+            return [lambda: host.analyze_next_epoch(self.executor)]
+        analyzers = [Analyzer(self.base_path, mode) for mode in ['yasa_analyzer', self.config.get('sleep_staging_model', 'YASA')]]
+        for analyzer in analyzers:
+            analyzer.start()
+        return [analyzer.step for analyzer in analyzers]
+
+    def analyze_available_epochs(self):
+        for step in self.analyzers:
+            while True:
+                start = time.perf_counter()
+                if not step():
+                    break
+                self.epoch_seconds.append(time.perf_counter() - start)
+
+    def run(self, seconds=None):
+        # replays seconds more of the recording, by default one pass over the EDF, and returns the timing of the
+        # run; the recording ends with a partial block, as when the recorder stops
+        sample_rate = self.producer.sample_rate
+        end = self.samples_produced + int((seconds or len(self.producer.data) / sample_rate) * sample_rate)
+        max_block_samples = max(1, int(sample_rate * self.config.get('recorder_block_seconds', 1.0)))
+        block_samples, block_timestamps = [], []
+        epochs_before = len(self.epoch_seconds)
+        first_sample = self.samples_produced
+
+        live_clock = tracing.clock
+        tracing.clock = self.clock
+        try:
+            if self.analyzers is None:
+                self.analyzers = self.start_analyzers()
+            # the analyzers' warm-up is not part of the replay's speed
+            started = time.perf_counter()
+            while self.samples_produced < end:
+                # the samples go through LSL as float32, stamped with the time the chunk was acquired and
+                # back-dated by the nominal rate
+                chunk = next(self.chunks)[:end - self.samples_produced].astype(np.float32)
+                first = self.samples_produced
+                self.samples_produced += len(chunk)
+                self.clock.time = self.start_time + self.samples_produced / sample_rate
+                block_samples.extend(chunk)
+                block_timestamps.extend(self.start_time + (first + 1 + np.arange(len(chunk))) / sample_rate)
+                while len(block_samples) >= max_block_samples or (block_samples and self.samples_produced == end):
+                    self.sample_index = self.recorder.write_block(block_samples[:max_block_samples], block_timestamps[:max_block_samples],
+                                                                  self.sample_index, False, self.clock())
+                    del block_samples[:max_block_samples], block_timestamps[:max_block_samples]
+                    self.analyze_available_epochs()
+        finally:
+            tracing.clock = live_clock
+
+        wall_seconds = time.perf_counter() - started
+        epoch_seconds = self.epoch_seconds[epochs_before:]
+        epoch_length = self.config.get('epoch_length', 30)
+        report = {
+            'base_path': self.base_path,
+            'recorded_seconds': self.samples_produced / sample_rate,
+            'wall_seconds': wall_seconds,
+            'speed': (self.samples_produced - first_sample) / sample_rate / wall_seconds,
+            # epochs analyzed by the analysis host, or epochs times analyses without it
+            'analysis_steps': len(epoch_seconds),
+        }
+        if epoch_seconds:
+            # the share of an epoch's length left once it is analyzed, what a live run has to spare
+            report['epoch_seconds'] = {f'p{q}': float(np.percentile(epoch_seconds, q)) for q in [50, 95, 99, 100]}
+            report['real_time_margin'] = {quantile: 1 - value / epoch_length for quantile, value in report['epoch_seconds'].items()}
+        return report
+
+    def results(self):
+        # the rows each results file received, by file name, in the order of their epochs: backfilled epochs are
+        # written after later ones
+        rows = {}
+        for file_name in RESULT_FILES:
+            file_path = os.path.join(self.base_path, 'data', 'results', file_name)
+            if os.path.exists(file_path):
+                with open(file_path, 'r') as f:
+                    rows[file_name] = sorted((json.loads(line) for line in f if line.strip()), key=lambda row: row['start_time'])
+        return rows
+
+    def shutdown(self):
+        self.executor.shutdown()
+        self.recorder.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay an EDF through the recorder and analyzers on a virtual clock.')
+    parser.add_argument('edf_file_path')
+    parser.add_argument('--seconds', type=float, default=None, help='length of the replay, by default one pass over the file')
+    parser.add_argument('--base-path', default=None, help='an empty directory for the replay, by default a new temporary one')
+    parser.add_argument('--config', default=None, help='json file of config values to replay with')
+    parser.add_argument('--output', default=None, help='write the report and the results rows as json to this path')
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+    replay = Replay(args.edf_file_path, base_path=args.base_path, config=config)
+    try:
+        report = replay.run(args.seconds)
+    finally:
+        replay.shutdown()
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'report': report, 'results': replay.results()}, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
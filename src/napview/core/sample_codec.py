@@ -0,0 +1,101 @@
+import json
+import zlib
+import struct
+import numpy as np
+
+
+# block header: codec version, encoding flags, n_channels, n_samples
+BLOCK_HEADER = struct.Struct('<BBHI')
+CODEC_VERSION = 1
+
+DTYPE_FLOAT32 = 0
+DTYPE_INT16 = 1
+DTYPE_INT32 = 2
+FLAG_DELTA = 0x10
+FLAG_ZLIB = 0x20
+
+DTYPES = {DTYPE_FLOAT32: np.dtype('<f4'), DTYPE_INT16: np.dtype('<i2'), DTYPE_INT32: np.dtype('<i4')}
+INTEGER_LIMITS = [(DTYPE_INT16, np.iinfo(np.int16)), (DTYPE_INT32, np.iinfo(np.int32))]
+
+
+class SampleCodec:
+    """Encodes blocks of samples [n_channels, n_samples] as digital integers plus per-channel scale.
+
+    Values are stored as round((x - offset) / scale) in the narrowest integer type that holds the block,
+    optionally delta-encoded along time, and the whole block is zlib-compressed. A block that does not
+    fit int32, or that would not decode exactly while ``lossless`` is set, is stored as float32 instead.
+    """
+
+    def __init__(self, n_channels, scales=None, offsets=None, dtype='auto', delta=True, level=6, lossless=False):
+        self.n_channels = n_channels
+        self.scales = None if scales is None else np.asarray(scales, dtype=np.float64).reshape(n_channels, 1)
+        self.offsets = np.zeros((n_channels, 1)) if offsets is None else np.asarray(offsets, dtype=np.float64).reshape(n_channels, 1)
+        self.dtype = dtype if self.scales is not None else 'float32'
+        self.delta = delta
+        self.level = level
+        self.lossless = lossless
+
+    def to_json(self):
+        return json.dumps({
+            'version': CODEC_VERSION,
+            'n_channels': self.n_channels,
+            'scales': None if self.scales is None else self.scales.ravel().tolist(),
+            'offsets': self.offsets.ravel().tolist(),
+            'dtype': self.dtype,
+            'delta': self.delta,
+            'level': self.level,
+            'lossless': self.lossless,
+        })
+
+    @classmethod
+    def from_json(cls, text):
+        settings = json.loads(text)
+        return cls(settings['n_channels'], scales=settings['scales'], offsets=settings['offsets'],
+                   dtype=settings['dtype'], delta=settings['delta'], level=settings['level'],
+                   lossless=settings['lossless'])
+
+    def _quantize(self, data):
+        digital = np.rint((data - self.offsets) / self.scales)
+        if self.lossless:
+            decoded = (digital * self.scales + self.offsets).astype(np.float32)
+            if not np.array_equal(decoded, data.astype(np.float32)):
+                return None, None
+        values = np.diff(digital, axis=1, prepend=0) if self.delta else digital
+        if not np.all(np.isfinite(values)):
+            return None, None
+        low, high = values.min(initial=0), values.max(initial=0)
+        for code, limits in INTEGER_LIMITS:
+            if self.dtype in ('auto', DTYPES[code].name) and limits.min <= low and high <= limits.max:
+                return code, values.astype(DTYPES[code])
+            if self.dtype == DTYPES[code].name:
+                break
+        return None, None
+
+    def encode(self, data):
+        data = np.asarray(data, dtype=np.float64)
+        n_channels, n_samples = data.shape
+        code, values, flags = None, None, 0
+        if self.dtype != 'float32':
+            code, values = self._quantize(data)
+            if code is not None and self.delta:
+                flags |= FLAG_DELTA
+        if code is None:
+            code, values = DTYPE_FLOAT32, data.astype(DTYPES[DTYPE_FLOAT32])
+        payload = np.ascontiguousarray(values).tobytes()
+        if self.level:
+            payload = zlib.compress(payload, self.level)
+            flags |= FLAG_ZLIB
+        return BLOCK_HEADER.pack(CODEC_VERSION, code | flags, n_channels, n_samples) + payload
+
+    def decode(self, blob, dtype=np.float64):
+        version, flags, n_channels, n_samples = BLOCK_HEADER.unpack_from(blob)
+        payload = memoryview(blob)[BLOCK_HEADER.size:]
+        if flags & FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+        code = flags & 0x0F
+        values = np.frombuffer(payload, dtype=DTYPES[code]).reshape(n_channels, n_samples)
+        if code == DTYPE_FLOAT32:
+            return values.astype(dtype)
+        if flags & FLAG_DELTA:
+            values = np.cumsum(values, axis=1, dtype=np.int64)
+        return (values * self.scales + self.offsets).astype(dtype, copy=False)
@@ -0,0 +1,129 @@
+import os
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+import numpy as np
+
+
+# the spectra every analysis reads: per-epoch, per-channel Welch PSDs in uV^2/Hz of the recording resampled to
+# 100 Hz and high-passed at 0.4 Hz. These are the parameters of SleepStaging.fit, except for its 30 Hz low-pass:
+# the cache keeps 30-40 Hz for the band-power analysis, and staging_spectra applies the low-pass to the spectra
+# given to SleepStaging
+SPECTRAL_SAMPLE_RATE = 100
+SPECTRAL_HIGH_PASS = 0.4
+SPECTRAL_STAGING_LOW_PASS = 30
+SPECTRAL_WELCH = dict(window='hamming', nperseg=5 * SPECTRAL_SAMPLE_RATE, average='median')
+SPECTRAL_FREQS = np.fft.rfftfreq(SPECTRAL_WELCH['nperseg'], 1 / SPECTRAL_SAMPLE_RATE)
+
+
+def spectra_path(base_path):
+    return os.path.join(base_path, "data", "spectra")
+
+
+def resample_data(data, sf, target_sf):
+    # MNE resamples in double precision only, float32 data are resampled as float64 and returned as float32.
+    # A single-precision polyphase resampler pads the edges with zeros, which distorts the last epoch
+    from mne.filter import resample
+    if data.dtype == np.float64:
+        return resample(data, up=target_sf, down=sf, npad='auto', verbose=False)
+    return resample(data.astype(np.float64), up=target_sf, down=sf, npad='auto', verbose=False).astype(data.dtype)
+
+
+def fir_filter(data, sf, l_freq, h_freq):
+    # mne.filter.filter_data for float64 data. MNE filters double precision only; float32 data get the same FIR
+    # filter, zero-phase with odd-reflected edges as MNE pads them, applied by overlap-add in single precision
+    from mne.filter import filter_data, create_filter
+    if data.dtype == np.float64:
+        return filter_data(data, sf, l_freq=l_freq, h_freq=h_freq, verbose=False)
+    import scipy.signal as sp_sig
+    h = create_filter(None, sf, l_freq, h_freq, verbose=False).astype(data.dtype)
+    n_edge = max(min(len(h), data.shape[-1]) - 1, 0)
+    padded = np.pad(data, [(0, 0)] * (data.ndim - 1) + [(n_edge, n_edge)], mode='reflect', reflect_type='odd')
+    shift = (len(h) - 1) // 2 + n_edge
+    filtered = sp_sig.oaconvolve(padded, h.reshape((1,) * (data.ndim - 1) + (-1,)), mode='full', axes=-1)
+    return filtered[..., shift:shift + data.shape[-1]]
+
+
+def compute_epoch_spectra(data, sf, samples_per_epoch):
+    # data[n_channels, n_samples] in volts holding whole epochs -> psd[n_channels, n_epochs, n_freqs], in the
+    # precision of data
+    import scipy.signal as sp_sig
+    data = data * 1e6
+    if sf != SPECTRAL_SAMPLE_RATE:
+        data = resample_data(data, sf, SPECTRAL_SAMPLE_RATE)
+    data = fir_filter(data, SPECTRAL_SAMPLE_RATE, SPECTRAL_HIGH_PASS, None)
+    epoch_samples = int(round(samples_per_epoch * SPECTRAL_SAMPLE_RATE / sf))
+    n_epochs = data.shape[1] // epoch_samples
+    epochs = data[:, :n_epochs * epoch_samples].reshape(data.shape[0], n_epochs, epoch_samples)
+    _, psd = sp_sig.welch(epochs, SPECTRAL_SAMPLE_RATE, **SPECTRAL_WELCH)
+    return psd
+
+
+@lru_cache(maxsize=1)
+def staging_gain():
+    # power response at SPECTRAL_FREQS of the 30 Hz low-pass of SleepStaging.fit's 0.4-30 Hz band-pass. Its
+    # transition band is 7.5 Hz wide, far wider than a Welch bin, so filtering the spectra equals filtering the data
+    from mne.filter import create_filter
+    h = create_filter(None, SPECTRAL_SAMPLE_RATE, None, SPECTRAL_STAGING_LOW_PASS, verbose=False)
+    response = np.exp(-2j * np.pi * np.outer(SPECTRAL_FREQS, np.arange(len(h))) / SPECTRAL_SAMPLE_RATE) @ h
+    return np.abs(response) ** 2
+
+
+def staging_spectra(psd):
+    # psd[..., n_freqs] from the cache -> the spectra of the data as SleepStaging.fit filters them, 0.4-30 Hz
+    return psd * staging_gain().astype(psd.dtype)
+
+
+class SpectralCache:
+    # spectra by epoch index, least recently used dropped first once max_epochs are held. With persist_path
+    # every spectrum is also written there and read back when it has been dropped, e.g. after a restart.
+    # Resampling and filtering distort the edges of the data they are given, so an epoch is only kept once it
+    # was computed with an epoch of the recording on either side of it
+    def __init__(self, max_epochs=40, persist_path=None):
+        self.max_epochs = max_epochs
+        self.persist_path = persist_path
+        self.spectra = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if persist_path:
+            os.makedirs(persist_path, exist_ok=True)
+
+    def lookup(self, epoch):
+        psd = self.spectra.get(epoch)
+        if psd is not None:
+            self.spectra.move_to_end(epoch)
+        elif self.persist_path and os.path.exists(os.path.join(self.persist_path, f'{epoch}.npy')):
+            psd = np.load(os.path.join(self.persist_path, f'{epoch}.npy'))
+            self.store(epoch, psd, persist=False)
+        return psd
+
+    def store(self, epoch, psd, persist=True):
+        self.spectra[epoch] = psd
+        self.spectra.move_to_end(epoch)
+        while len(self.spectra) > self.max_epochs:
+            self.spectra.popitem(last=False)
+        if persist and self.persist_path:
+            np.save(os.path.join(self.persist_path, f'{epoch}.npy'), psd)
+
+    def window_spectra(self, data, sf, first_sample, samples_per_epoch):
+        # data[n_channels, n_samples] in volts, whole epochs starting at sample first_sample of the recording.
+        # Returns freqs and psd[n_channels, n_epochs, n_freqs], computing only the epochs not kept before
+        first_epoch = first_sample // samples_per_epoch
+        n_epochs = data.shape[1] // samples_per_epoch
+        with self.lock:
+            psds = [self.lookup(first_epoch + i) for i in range(n_epochs)]
+            missing = [i for i, psd in enumerate(psds) if psd is None]
+            if missing:
+                # the epoch before the first missing one, where there is one, takes the start-up of the filter
+                context = max(missing[0] - 1, 0)
+                computed = compute_epoch_spectra(data[:, context * samples_per_epoch:], sf, samples_per_epoch)
+                for i in missing:
+                    psds[i] = computed[:, i - context]
+                    # the newest epoch is computed again with the next one; the first epoch of data without the one
+                    # before it is only kept at the start of the recording
+                    if i < n_epochs - 1 and (i > context or first_epoch + i == 0):
+                        self.store(first_epoch + i, psds[i])
+            self.misses += len(missing)
+            self.hits += n_epochs - len(missing)
+            return SPECTRAL_FREQS, np.stack(psds, axis=1)
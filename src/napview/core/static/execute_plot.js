@@ -13,6 +13,10 @@ class DataPlotter {
             const response = await fetch(this.config.endpoint);
             const data = await response.json();
 
+            if (this.config.statusId) {
+                showBudget(this.config.statusId, data.budget);
+            }
+
             this.dataSets = [];
             for (const fieldName of this.config.fields) {
                 const fieldData = data[fieldName].map(entry => ({
@@ -46,12 +50,38 @@ class DataPlotter {
     }
 }
 
+// what the analyzer leaves out while it is behind real time, hidden while it keeps up
+function showBudget(statusId, budget) {
+    const status = document.getElementById(statusId);
+    if (!budget || (budget.level === 'realtime' && !budget.backfill_pending)) {
+        status.style.display = 'none';
+        return;
+    }
+    const parts = [];
+    if (!budget.backfilled && budget.level !== 'realtime') {
+        parts.push(`analysis ${budget.lag_seconds.toFixed(0)} s behind real time (${budget.level})`);
+        parts.push(`context ${budget.context_minutes} min`);
+    }
+    if (budget.skipped_epochs) {
+        parts.push(`skipped ${budget.skipped_epochs} epochs`);
+    }
+    if (budget.paused && budget.paused.length) {
+        parts.push(`paused ${budget.paused.join(', ')}`);
+    }
+    if (budget.backfill_pending) {
+        parts.push(`${budget.backfill_pending} epochs to backfill`);
+    }
+    status.textContent = parts.join(' | ');
+    status.style.display = 'block';
+}
+
 // Configure the charts
 const chart1Config = {
     endpoint: '/data1',
     fields: ['n1', 'n2', 'n3', 'rem', 'w'],
     labels: ["probability", "time", "N1", "N2", "N3", "REM", "W"],
-    colors: ["#2222ff", "#2ca02c", "#800080", "#d62728", "#ee7f0e"]
+    colors: ["#2222ff", "#2ca02c", "#800080", "#d62728", "#ee7f0e"],
+    statusId: 'analysisStatus'
 };
 
 const chart2Config = {
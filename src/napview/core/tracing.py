@@ -0,0 +1,83 @@
+import os
+import json
+import bisect
+from pylsl import local_clock
+
+
+# every stage is stamped with pylsl.local_clock(), the clock LSL uses for sample timestamps, so stamps taken
+# in different processes (and sample timestamps after clock sync) can be subtracted from each other
+TRACE_STAGES = ['acquired', 'pushed', 'pulled', 'committed', 'epoch_closed',
+                'features_done', 'prediction_done', 'result_written', 'result_served']
+
+# upper bucket edges in milliseconds
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 60000, 120000]
+
+
+# the clock now() reads; the replay harness (replay.py) swaps in its virtual clock for the length of a replay
+clock = local_clock
+
+
+def now():
+    return clock()
+
+
+def metrics_path(base_path):
+    return os.path.join(base_path, "data", "metrics")
+
+
+def stage_latencies(trace):
+    # milliseconds between consecutive stages that are present, plus end to end from acquisition
+    latencies = {}
+    present = [stage for stage in TRACE_STAGES if trace.get(stage) is not None]
+    for previous, stage in zip(present, present[1:]):
+        latencies[f'{previous}->{stage}'] = (trace[stage] - trace[previous]) * 1000
+    if len(present) > 1:
+        latencies[f'{present[0]}->{present[-1]}'] = (trace[present[-1]] - trace[present[0]]) * 1000
+    return latencies
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value_ms):
+        self.counts[bisect.bisect_left(self.buckets, value_ms)] += 1
+        self.count += 1
+        self.total += value_ms
+        self.max = max(self.max, value_ms)
+
+    def quantile(self, q):
+        # upper edge of the bucket holding the q-th value
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for edge, count in zip(self.buckets + [self.max], self.counts):
+            seen += count
+            if seen >= rank:
+                return min(edge, self.max)
+        return self.max
+
+    def to_dict(self):
+        # [upper edge in ms, count] pairs, a list so that JSON serializers keep the order
+        edges = self.buckets + ['inf']
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count if self.count else None,
+            'p50_ms': self.quantile(0.5),
+            'p95_ms': self.quantile(0.95),
+            'max_ms': self.max if self.count else None,
+            'buckets': [[edge, count] for edge, count in zip(edges, self.counts)],
+        }
+
+
+def write_metrics_file(file_path, metrics):
+    # written next to the file and renamed, so a reader never sees half a file
+    temp_file_path = f"{file_path}.tmp"
+    with open(temp_file_path, 'w') as f:
+        json.dump(metrics, f)
+    os.replace(temp_file_path, file_path)
@@ -0,0 +1,150 @@
+import os
+import sys
+import glob
+import math
+import numpy as np
+
+
+# the staging classifiers are fixed LightGBM multiclass ensembles; exported to flat arrays they are evaluated
+# with numpy alone, without importing lightgbm, joblib and sklearn or loading their native libraries
+CLASSIFIERS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "classifiers")
+MISSING_TYPES = {'None': 0, 'Zero': 1, 'NaN': 2}
+ZERO_THRESHOLD = 1e-35  # LightGBM's kZeroThreshold
+
+
+def exported_path(joblib_path):
+    return os.path.splitext(joblib_path)[0] + '.npz'
+
+
+def export_lightgbm(joblib_path, npz_path=None):
+    # nodes and leaves of every tree, numbered as LightGBM numbers them (split_index, leaf_index), in flat
+    # arrays with per-tree offsets. A child >= 0 is a node of the same tree, a child < 0 is the leaf ~child
+    import joblib
+    clf = joblib.load(joblib_path)
+    model = clf.booster_.dump_model()
+    if model['average_output']:
+        raise ValueError(f"{joblib_path}: averaged (random forest) output is not supported")
+
+    arrays = {name: [] for name in ['split_feature', 'threshold', 'left_child', 'right_child', 'default_left',
+                                    'missing_type', 'leaf_value', 'root', 'node_offset', 'leaf_offset']}
+    n_nodes = n_leaves = 0
+    for tree in model['tree_info']:
+        nodes, leaves = {}, {}
+
+        def walk(node):
+            if 'leaf_index' in node or 'split_index' not in node:
+                leaves[node.get('leaf_index', 0)] = node['leaf_value']
+                return ~node.get('leaf_index', 0)
+            if node['decision_type'] != '<=':
+                raise ValueError(f"{joblib_path}: {node['decision_type']} splits are not supported")
+            nodes[node['split_index']] = (node['split_feature'], node['threshold'], walk(node['left_child']),
+                                          walk(node['right_child']), node['default_left'],
+                                          MISSING_TYPES[node['missing_type']])
+            return node['split_index']
+
+        arrays['root'].append(walk(tree['tree_structure']))
+        arrays['node_offset'].append(n_nodes)
+        arrays['leaf_offset'].append(n_leaves)
+        for index in range(len(nodes)):
+            for name, value in zip(['split_feature', 'threshold', 'left_child', 'right_child', 'default_left', 'missing_type'], nodes[index]):
+                arrays[name].append(value)
+        arrays['leaf_value'].extend(leaves[index] for index in range(len(leaves)))
+        n_nodes += len(nodes)
+        n_leaves += len(leaves)
+
+    npz_path = npz_path or exported_path(joblib_path)
+    np.savez_compressed(
+        npz_path,
+        feature_names=np.array(model['feature_names'], dtype=str),
+        classes=np.array(clf.classes_, dtype=str),
+        num_class=model['num_tree_per_iteration'],
+        split_feature=np.array(arrays['split_feature'], dtype=np.int32),
+        threshold=np.array(arrays['threshold'], dtype=np.float64),
+        left_child=np.array(arrays['left_child'], dtype=np.int32),
+        right_child=np.array(arrays['right_child'], dtype=np.int32),
+        default_left=np.array(arrays['default_left'], dtype=bool),
+        missing_type=np.array(arrays['missing_type'], dtype=np.int8),
+        leaf_value=np.array(arrays['leaf_value'], dtype=np.float64),
+        root=np.array(arrays['root'], dtype=np.int32),
+        node_offset=np.array(arrays['node_offset'], dtype=np.int64),
+        leaf_offset=np.array(arrays['leaf_offset'], dtype=np.int64),
+    )
+    return npz_path
+
+
+class TreeEnsemble:
+    # stands in for the LGBMClassifier in SleepStaging: feature_name_, classes_, predict and predict_proba
+    def __init__(self, npz_path):
+        with np.load(npz_path) as model:
+            a = {name: model[name] for name in model.files}
+        self.feature_name_ = a['feature_names'].tolist()
+        self.classes_ = a['classes']
+        self.num_class = int(a['num_class'])
+
+        # one index space for the nodes of all trees followed by their leaves. A leaf is a node that compares
+        # feature 0 with +inf and leads to itself, so a fixed number of passes takes every row to its leaf
+        n_nodes, n_leaves = len(a['split_feature']), len(a['leaf_value'])
+        tree_of_node = np.repeat(np.arange(len(a['root'])), np.diff(np.append(a['node_offset'], n_nodes)))
+
+        def global_index(child):
+            return np.where(child >= 0, child + a['node_offset'][tree_of_node], n_nodes + ~child + a['leaf_offset'][tree_of_node])
+
+        leaves = np.arange(n_nodes, n_nodes + n_leaves)
+        self.feature = np.concatenate([a['split_feature'], np.zeros(n_leaves, dtype=np.int32)])
+        self.threshold = np.concatenate([a['threshold'], np.full(n_leaves, np.inf)])
+        self.left = np.concatenate([global_index(a['left_child']), leaves])
+        self.right = np.concatenate([global_index(a['right_child']), leaves])
+        self.default_left = np.concatenate([a['default_left'], np.ones(n_leaves, dtype=bool)])
+        self.missing_type = np.concatenate([a['missing_type'], np.zeros(n_leaves, dtype=np.int8)])
+        self.leaf_value = np.concatenate([np.zeros(n_nodes), a['leaf_value']])
+        self.root = np.where(a['root'] >= 0, a['root'] + a['node_offset'], n_nodes + ~a['root'] + a['leaf_offset'])
+        # longest path from a root, the number of passes needed
+        depth = np.zeros(n_nodes + n_leaves, dtype=np.int64)
+        for node in range(n_nodes - 1, -1, -1):
+            depth[node] = 1 + max(depth[self.left[node]] if self.left[node] < n_nodes else 0,
+                                  depth[self.right[node]] if self.right[node] < n_nodes else 0)
+        self.max_depth = int(depth[self.root].max())
+        self.only_missing_none = bool(np.all(a['missing_type'] == MISSING_TYPES['None']))
+
+    def raw_score(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        n_rows = X.shape[0]
+        if self.only_missing_none:
+            # LightGBM reads NaN as zero when no split has a missing-value direction
+            X = np.where(np.isnan(X), 0.0, X)
+        rows = np.arange(n_rows)[:, None]
+        node = np.broadcast_to(self.root, (n_rows, len(self.root)))
+        for _ in range(self.max_depth):
+            value = X[rows, self.feature[node]]
+            if self.only_missing_none:
+                go_left = value <= self.threshold[node]
+            else:
+                missing_type = self.missing_type[node]
+                value = np.where(np.isnan(value) & (missing_type != MISSING_TYPES['NaN']), 0.0, value)
+                missing = ((missing_type == MISSING_TYPES['Zero']) & (np.abs(value) <= ZERO_THRESHOLD)) | \
+                          ((missing_type == MISSING_TYPES['NaN']) & np.isnan(value))
+                go_left = np.where(missing, self.default_left[node], value <= self.threshold[node])
+            node = np.where(go_left, self.left[node], self.right[node])
+        # tree t adds to class t % num_class; summed in tree order, as LightGBM sums them
+        per_class = self.leaf_value[node].reshape(n_rows, -1, self.num_class)
+        return np.cumsum(per_class, axis=1)[:, -1, :]
+
+    def predict_proba(self, X):
+        raw = self.raw_score(X)
+        # LightGBM's softmax with the C library's exp, numpy's vectorized exp can differ in the last bit
+        shifted = raw - raw.max(axis=1, keepdims=True)
+        exp = np.fromiter(map(math.exp, shifted.ravel()), dtype=np.float64, count=shifted.size).reshape(shifted.shape)
+        return exp / np.cumsum(exp, axis=1)[:, -1:]
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+def main():
+    # python -m napview.core.tree_ensemble [classifier.joblib ...], by default every shipped classifier
+    for joblib_path in sys.argv[1:] or sorted(glob.glob(os.path.join(CLASSIFIERS_PATH, '*.joblib'))):
+        print(f"{joblib_path} -> {export_lightgbm(joblib_path)}")
+
+
+if __name__ == '__main__':
+    main()
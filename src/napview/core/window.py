@@ -0,0 +1,38 @@
+import numpy as np
+
+
+class EEGWindow:
+    # what the analyses read of a window of the recording: data[n_channels, n_samples] in volts, the channel
+    # names and the sample rate. Holds the array it is given without copying it, so a window over the samples
+    # read from the database costs nothing; the analyses take views of single channels and copy only what
+    # they change. MNE Raw objects are converted at the edges (from_raw), not per epoch
+    def __init__(self, data, ch_names, sfreq):
+        if data.shape[0] != len(ch_names):
+            raise ValueError(f"{data.shape[0]} rows of data for {len(ch_names)} channel names")
+        # float32 windows stay float32 (compute_dtype), anything else is analyzed as float64
+        self.data = data if data.dtype in (np.float32, np.float64) else np.asarray(data, dtype=np.float64)
+        self.ch_names = list(ch_names)
+        self.sfreq = sfreq
+        self._rows = {name: row for row, name in enumerate(self.ch_names)}
+
+    @classmethod
+    def from_raw(cls, raw):
+        return cls(raw.get_data(), raw.ch_names, raw.info['sfreq'])
+
+    @property
+    def n_samples(self):
+        return self.data.shape[1]
+
+    def index(self, name):
+        return self._rows[name]
+
+    def channel(self, name):
+        # a view, not a copy
+        return self.data[self._rows[name]]
+
+    def pick(self, names, scale=None):
+        # a copy of the rows of names, scaled in place rather than into a second copy
+        data = np.take(self.data, [self._rows[name] for name in names], axis=0)
+        if scale is not None:
+            data *= scale
+        return data
@@ -3,20 +3,25 @@
 import os
 import mne
 import glob
-import joblib
 import logging
+import itertools
+from math import factorial, log
 import numpy as np
 import pandas as pd
-import antropy as ant
 import scipy.signal as sp_sig
 import scipy.stats as sp_stats
-import matplotlib.pyplot as plt
-from mne.filter import filter_data
-from sklearn.preprocessing import robust_scale
-from scipy.integrate import simpson
+from scipy.integrate import simpson, trapezoid
+
+from .spectral import fir_filter, resample_data
+from .window import EEGWindow
 
 logger = logging.getLogger("yasa")
 
+# classifiers loaded by _load_model, by file path; a process stages every epoch with the same one
+_loaded_models = {}
+# numba kernels, compiled by the first call that needs them
+_compiled_kernels = {}
+
 
 
 def bandpower_from_psd(
@@ -301,7 +306,7 @@ def sliding_window(data, sf, window, step=None, axis=-1):
         step = int(step)
 
     assert step >= 1, "Stepsize may not be zero or negative."
-    assert window < data.shape[axis], "Sliding window size may not exceed size of selected axis"
+    assert window <= data.shape[axis], "Sliding window size may not exceed size of selected axis"
 
     # Define output shape
     shape = list(data.shape)
@@ -372,6 +377,99 @@ def bandpower_from_psd_ndarray(psd, freqs, bands=[(0.5, 4, "Delta"), (4, 8, "The
     return bp
 
 
+def perm_entropy_epochs(epochs, order=3, delay=1, normalize=False):
+    """Permutation entropy of every row of ``epochs``, shape (n_epochs, n_samples).
+
+    Same result as :py:func:`antropy.perm_entropy` applied to each row. The ordinal pattern of
+    every window is encoded from its pairwise comparisons, ties ranked by position as a stable
+    argsort ranks them, and the pattern probabilities are summed in antropy's order.
+    """
+    epochs = np.asarray(epochs, dtype=np.result_type(epochs, np.float32))
+    n_epochs, n_samples = epochs.shape
+    n_embed = n_samples - (order - 1) * delay
+    assert n_embed > 0, "Epochs are too short for the given order and delay."
+    columns = [epochs[:, i * delay:i * delay + n_embed] for i in range(order)]
+    pairs = list(itertools.combinations(range(order), 2))
+    key = np.zeros((n_epochs, n_embed), dtype=np.uint8 if len(pairs) <= 8 else np.int64)
+    for bit, (i, j) in enumerate(pairs):
+        key |= (columns[j] < columns[i]).astype(key.dtype) << bit
+    # comparison key of each pattern, listed in the order of antropy's pattern hash sum(argsort[k] * order**k)
+    patterns = {}
+    for ranks in itertools.permutations(range(order)):
+        hashval = sum(i * order ** rank for i, rank in enumerate(ranks))
+        patterns[hashval] = sum((ranks[j] < ranks[i]) << bit for bit, (i, j) in enumerate(pairs))
+    n_keys = 2 ** len(pairs)
+    offsets = (np.arange(n_epochs, dtype=np.int64) * n_keys)[:, None]
+    counts = np.bincount((key + offsets).ravel(), minlength=n_epochs * n_keys).reshape(n_epochs, n_keys)
+    p = counts[:, [patterns[hashval] for hashval in sorted(patterns)]] / n_embed
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_p = np.where(p > 0, np.log2(p), 0.0)
+    pe = -(p * log_p).sum(axis=1)
+    if normalize:
+        pe /= np.log2(factorial(order))
+        pe = np.minimum(np.maximum(pe, 0.0), 1.0)
+    return pe
+
+
+def _higuchi_fd_epochs(epochs, kmax):
+    # antropy's _higuchi_fd and _linear_regression, looped over the epochs inside one compiled call. The
+    # sums are float64 for float32 epochs as well
+    n_epochs, n_times = epochs.shape
+    hfd = np.empty(n_epochs)
+    x_reg = np.empty(kmax)
+    y_reg = np.empty(kmax)
+    for e in range(n_epochs):
+        for k in range(1, kmax + 1):
+            m_lm = 0.0
+            for m in range(k):
+                ll = 0.0
+                n_max = (n_times - m - 1) // k
+                for j in range(1, n_max + 1):
+                    ll += abs(epochs[e, m + j * k] - epochs[e, m + (j - 1) * k])
+                ll /= k
+                ll *= (n_times - 1) / (k * n_max)
+                m_lm += ll
+            m_lm /= k
+            x_reg[k - 1] = log(1.0 / k)
+            y_reg[k - 1] = log(m_lm) if m_lm > 0 else -np.inf
+        sx2 = 0.0
+        sx = 0.0
+        sy = 0.0
+        sxy = 0.0
+        for j in range(kmax):
+            sx2 += x_reg[j] ** 2
+            sx += x_reg[j]
+            sxy += x_reg[j] * y_reg[j]
+            sy += y_reg[j]
+        hfd[e] = (kmax * sxy - sx * sy) / (kmax * sx2 - sx ** 2 + 1e-9)
+    return hfd
+
+
+def higuchi_fd_epochs(epochs, kmax=10):
+    """Higuchi fractal dimension of every row of ``epochs``, shape (n_epochs, n_samples).
+
+    Same result as :py:func:`antropy.higuchi_fd` applied to each row, compiled with numba (a
+    dependency of antropy) on first use.
+    """
+    if "higuchi_fd_epochs" not in _compiled_kernels:
+        from numba import njit
+        _compiled_kernels["higuchi_fd_epochs"] = njit(cache=True)(_higuchi_fd_epochs)
+    epochs = np.ascontiguousarray(epochs, dtype=np.result_type(epochs, np.float32))
+    return _compiled_kernels["higuchi_fd_epochs"](epochs, int(kmax))
+
+
+def petrosian_fd_epochs(epochs):
+    """Petrosian fractal dimension of every row of ``epochs``, shape (n_epochs, n_samples).
+
+    Same result as :py:func:`antropy.petrosian_fd` with ``axis=1``.
+    """
+    epochs = np.asarray(epochs)
+    n = epochs.shape[1]
+    # sign changes of the first derivative
+    nzc_deriv = np.diff(np.signbit(np.diff(epochs, axis=1)), axis=1).sum(axis=1)
+    return np.log10(n) / (np.log10(n) + np.log10(n / (n + 0.4 * nzc_deriv)))
+
+
 class SleepStaging:
     """
     Automatic sleep staging of polysomnography data.
@@ -384,8 +482,8 @@ class SleepStaging:
 
     Parameters
     ----------
-    raw : :py:class:`mne.io.BaseRaw`
-        An MNE Raw instance.
+    raw : :py:class:`napview.core.window.EEGWindow` or :py:class:`mne.io.BaseRaw`
+        The data, in Volts, as an EEGWindow or an MNE Raw instance.
     eeg_name : str
         The name of the EEG channel in ``raw``. Preferentially a central
         electrode referenced either to the mastoids (C4-M1, C3-M2) or to the
@@ -404,6 +502,10 @@ class SleepStaging:
         * ``'age'``: age of the participant, in years.
         * ``'male'``: sex of the participant (1 or True = male, 0 or
           False = female)
+    spectra : dict or None
+        Precomputed Welch spectra per channel name, ``(freqs, psd)`` with ``psd`` of shape
+        (n_epochs, n_freqs) in uV^2/Hz, one row per 30-seconds epoch. Used instead of computing
+        the spectra in :py:meth:`fit`, see :py:mod:`napview.core.spectral`.
 
     Notes
     -----
@@ -510,7 +612,7 @@ class SleepStaging:
     `FAQ <https://raphaelvallat.com/yasa/build/html/faq.html>`_.
     """
 
-    def __init__(self, raw, eeg_name, *, eog_name=None, emg_name=None, metadata=None):
+    def __init__(self, raw, eeg_name, *, eog_name=None, emg_name=None, metadata=None, spectra=None):
         # Type check
         assert isinstance(eeg_name, str)
         assert isinstance(eog_name, (str, type(None)))
@@ -525,9 +627,11 @@ class SleepStaging:
                 metadata["male"] = int(metadata["male"])
                 assert metadata["male"] in [0, 1], "male must be 0 or 1."
 
-        # Validate Raw instance and load data
-        assert isinstance(raw, mne.io.BaseRaw), "raw must be a MNE Raw object."
-        sf = raw.info["sfreq"]
+        # Validate the window, converting an MNE Raw instance at the door
+        if isinstance(raw, mne.io.BaseRaw):
+            raw = EEGWindow.from_raw(raw)
+        assert isinstance(raw, EEGWindow), "raw must be an EEGWindow or a MNE Raw object."
+        sf = raw.sfreq
         ch_names = np.array([eeg_name, eog_name, emg_name])
         ch_types = np.array(["eeg", "eog", "emg"])
         keep_chan = []
@@ -540,17 +644,17 @@ class SleepStaging:
         # Subset
         ch_names = ch_names[keep_chan].tolist()
         ch_types = ch_types[keep_chan].tolist()
-        # Keep only selected channels (creating a copy of Raw)
-        raw_pick = raw.copy().pick(ch_names)
 
-        # Downsample if sf != 100
+        # Keep only selected channels (one copy of their rows), downsample if sf != 100
+        # and convert to microVolts, in place on the copy or the resampled data. The data
+        # keep the precision of the window, float64 or float32
         assert sf > 80, "Sampling frequency must be at least 80 Hz."
         if sf != 100:
-            raw_pick.resample(100, npad="auto")
-            sf = raw_pick.info["sfreq"]
-
-        # Get data and convert to microVolts
-        data = raw_pick.get_data(units=dict(eeg="uV", emg="uV", eog="uV", ecg="uV"))
+            data = resample_data(raw.pick(ch_names), sf, 100)
+            data *= 1e6
+            sf = 100.0
+        else:
+            data = raw.pick(ch_names, scale=1e6)
 
         # Extract duration of recording in minutes
         duration_minutes = data.shape[1] / sf / 60
@@ -567,6 +671,7 @@ class SleepStaging:
         self.ch_types = ch_types
         self.data = data
         self.metadata = metadata
+        self.spectra = spectra
 
     def fit(self):
         """Extract features from data.
@@ -575,6 +680,11 @@ class SleepStaging:
         -------
         self : returns an instance of self.
         """
+        # antropy (numba) and sklearn are only needed here, importing them with the module
+        # would add their start-up cost to every process that only needs bandpower()
+        import antropy as ant
+        from sklearn.preprocessing import robust_scale
+
         #######################################################################
         # MAIN PARAMETERS
         #######################################################################
@@ -604,9 +714,7 @@ class SleepStaging:
         for i, c in enumerate(self.ch_types):
             # Preprocessing
             # - Filter the data
-            dt_filt = filter_data(
-                self.data[i, :], sf, l_freq=freq_broad[0], h_freq=freq_broad[1], verbose=False
-            )
+            dt_filt = fir_filter(self.data[i, :], sf, l_freq=freq_broad[0], h_freq=freq_broad[1])
             # - Extract epochs. Data is now of shape (n_epochs, n_samples).
             times, epochs = sliding_window(dt_filt, sf=sf, window=30)
 
@@ -624,7 +732,11 @@ class SleepStaging:
             }
 
             # Calculate spectral power features (for EEG + EOG)
-            freqs, psd = sp_sig.welch(epochs, sf, **kwargs_welch)
+            if self.spectra is not None:
+                freqs, psd = self.spectra[self.ch_names[i]]
+                assert psd.shape[0] == epochs.shape[0], "spectra must have one row per epoch."
+            else:
+                freqs, psd = sp_sig.welch(epochs, sf, **kwargs_welch)
             if c != "emg":
                 bp = bandpower_from_psd_ndarray(psd, freqs, bands=bands)
                 for j, (_, _, b) in enumerate(bands):
@@ -641,12 +753,12 @@ class SleepStaging:
             # Add total power
             idx_broad = np.logical_and(freqs >= freq_broad[0], freqs <= freq_broad[1])
             dx = freqs[1] - freqs[0]
-            feat["abspow"] = np.trapz(psd[:, idx_broad], dx=dx)
+            feat["abspow"] = trapezoid(psd[:, idx_broad], dx=dx)
 
             # Calculate entropy and fractal dimension features
-            feat["perm"] = np.apply_along_axis(ant.perm_entropy, axis=1, arr=epochs, normalize=True)
-            feat["higuchi"] = np.apply_along_axis(ant.higuchi_fd, axis=1, arr=epochs)
-            feat["petrosian"] = ant.petrosian_fd(epochs, axis=1)
+            feat["perm"] = perm_entropy_epochs(epochs, normalize=True)
+            feat["higuchi"] = higuchi_fd_epochs(epochs)
+            feat["petrosian"] = petrosian_fd_epochs(epochs)
 
             # Convert to dataframe
             feat = pd.DataFrame(feat).add_prefix(c + "_")
@@ -754,8 +866,18 @@ class SleepStaging:
         # Check that file exists
         assert os.path.isfile(path_to_model), "File does not exist."
         logger.info("Using pre-trained classifier: %s" % path_to_model)
-        # Load using Joblib
-        clf = joblib.load(path_to_model)
+        # Load once per process, as the numpy tree ensemble where the classifier has been exported
+        # (python -m napview.core.tree_ensemble), otherwise using Joblib
+        if path_to_model not in _loaded_models:
+            from .tree_ensemble import TreeEnsemble, exported_path
+
+            if os.path.isfile(exported_path(path_to_model)):
+                _loaded_models[path_to_model] = TreeEnsemble(exported_path(path_to_model))
+            else:
+                import joblib
+
+                _loaded_models[path_to_model] = joblib.load(path_to_model)
+        clf = _loaded_models[path_to_model]
         # Validate features
         self._validate_predict(clf)
         return clf